@@ -0,0 +1,110 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+###############################################################################
+# bench/cdc.py
+#
+#   Content defined chunking benchmark. Generates a synthetic file, mutates
+#   it (inserts, deletes and overwrites) and reports the deduplication ratio
+#   and the throughput of the chunker (compared with fixed size chunks).
+#
+#   Usage: bench/cdc.py [size_mb] [avg_chunk_kb] [edits]
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import StringIO
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import chirribackup.cdc
+
+
+def mutate(data, edits, rnd):
+    data = bytearray(data)
+    for i in range(0, edits):
+        pos = rnd.randint(0, len(data) - 1)
+        op = rnd.choice([ "insert", "delete", "overwrite" ])
+        n = rnd.randint(1, 64)
+        if op == "insert":
+            data[pos:pos] = os.urandom(n)
+        elif op == "delete":
+            del data[pos:pos + n]
+        else:
+            data[pos:pos + n] = os.urandom(len(data[pos:pos + n]))
+    return str(data)
+
+
+def fixed_split(data, size):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def chunks(splitter):
+    l = []
+    for c in splitter:
+        l.append((hashlib.sha512(c).digest(), len(c)))
+    return l
+
+
+def dedup(old, new):
+    known = set([ h for h, s in old ])
+    total = sum([ s for h, s in new ])
+    reused = sum([ s for h, s in new if h in known ])
+    return float(reused) / float(total) if total > 0 else 1.0
+
+
+def main(argv):
+    size = int(argv[0]) if len(argv) > 0 else 32
+    avg = int(argv[1]) if len(argv) > 1 else 1024
+    edits = int(argv[2]) if len(argv) > 2 else 10
+    rnd = random.Random(42)
+
+    print "Generating %d MiB of data with %d edits (average chunk %d KiB)" % (size, edits, avg)
+    original = os.urandom(size * 1024 * 1024)
+    mutated = mutate(original, edits, rnd)
+
+    chunker = chirribackup.cdc.Chunker(avg * 1024)
+    t = time.time()
+    a = chunks(chunker.split(StringIO.StringIO(original)))
+    b = chunks(chunker.split(StringIO.StringIO(mutated)))
+    t = time.time() - t
+
+    print ""
+    print "%-8s %10s %10s %10s" % ("method", "chunks", "dedup", "MiB/s")
+    print "%-8s %10s %10s %10s" % ("-" * 8, "-" * 10, "-" * 10, "-" * 10)
+    print "%-8s %10d %9.2f%% %10.2f" % (
+                "cdc", len(b), dedup(a, b) * 100.0,
+                (len(original) + len(mutated)) / t / (1024.0 * 1024.0))
+
+    t = time.time()
+    a = chunks(fixed_split(original, avg * 1024))
+    b = chunks(fixed_split(mutated, avg * 1024))
+    t = time.time() - t
+    print "%-8s %10d %9.2f%% %10.2f" % (
+                "fixed", len(b), dedup(a, b) * 100.0,
+                (len(original) + len(mutated)) / t / (1024.0 * 1024.0))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
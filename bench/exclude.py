@@ -0,0 +1,136 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+###############################################################################
+# bench/exclude.py
+#
+#   Exclude matcher benchmark. Generates a set of exclude rules (literals,
+#   wildcards, anchored wildcards and regexes) and a list of paths, and
+#   compares the old rule by rule loop with chirribackup.exclude's
+#   ExcludeMatcher (checking that both give the same results).
+#
+#   Usage: bench/exclude.py [rules] [paths]
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import fnmatch
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import chirribackup.exclude
+
+WORDS = [ "src", "lib", "build", "node_modules", "cache", "tmp", "doc", "test",
+          "include", "vendor", "home", "user", "photos", "music", "project",
+          ".git", "__pycache__", "target", "dist", "bin" ]
+EXTS = [ "c", "h", "py", "pyc", "o", "txt", "jpg", "mp3", "js", "html", "log" ]
+
+
+def gen_rules(n, rnd):
+    rules = []
+    for i in range(0, n):
+        t = rnd.choice([ "literal", "wildcard", "suffix", "anchored", "middle", "re" ])
+        w = "%s%d" % (rnd.choice(WORDS), rnd.randint(0, 50))
+        ic = rnd.randint(0, 3) == 0
+        if t == "literal":
+            rules.append((0, "%s/%s.%s" % (w, rnd.choice(WORDS), rnd.choice(EXTS)), 0))
+        elif t == "wildcard":
+            rules.append((1, "*%d.%s" % (rnd.randint(0, 999), rnd.choice(EXTS)), ic))
+        elif t == "suffix":
+            rules.append((1, w, ic))
+        elif t == "middle":
+            rules.append((1, "%s?/f%d*" % (w[:-1], rnd.randint(0, 99)), ic))
+        elif t == "anchored":
+            rules.append((1, "/%s/*.%s" % (w, rnd.choice(EXTS)), ic))
+        else:
+            rules.append((2, "^%s/(%s|%s)[0-9]+/" % (w, rnd.choice(WORDS), rnd.choice(WORDS)), ic))
+    return rules
+
+
+def gen_paths(n, rnd):
+    for i in range(0, n):
+        depth = rnd.randint(1, 6)
+        p = [ "%s%d" % (rnd.choice(WORDS), rnd.randint(0, 50)) for j in range(0, depth) ]
+        p.append("f%d.%s" % (rnd.randint(0, 999), rnd.choice(EXTS)))
+        yield "/".join(p)
+
+
+class NaiveMatcher(object):
+    """the old algorithm (a loop over every rule)"""
+
+    def __init__(self, rules):
+        self.xl = []
+        for expr_type, exclude, ignore_case in rules:
+            if expr_type > 0:
+                if expr_type == 1:
+                    exclude = fnmatch.translate(exclude)
+                    if exclude.startswith("\\/"):
+                        exclude = "^" + exclude[2:]
+                    else:
+                        exclude = "(\\A|\\/)" + exclude
+                exclude = re.compile(exclude, re.IGNORECASE if ignore_case else 0)
+            self.xl.append(exclude)
+
+    def match(self, path):
+        for x in self.xl:
+            if isinstance(x, basestring):
+                if path == x:
+                    return True
+            elif x.search(path) is not None:
+                return True
+        return False
+
+
+def main(argv):
+    nrules = int(argv[0]) if len(argv) > 0 else 500
+    npaths = int(argv[1]) if len(argv) > 1 else 1000000
+    rnd = random.Random(42)
+
+    rules = gen_rules(nrules, rnd)
+    paths = list(gen_paths(npaths, rnd))
+    print "%d rules, %d paths" % (nrules, npaths)
+
+    xm = chirribackup.exclude.ExcludeMatcher()
+    for expr_type, exclude, ignore_case in rules:
+        xm.add(exclude, expr_type, ignore_case)
+    xm.compile()
+    naive = NaiveMatcher(rules)
+
+    print ""
+    print "%-8s %10s %10s %12s" % ("method", "excluded", "seconds", "paths/s")
+    print "%-8s %10s %10s %12s" % ("-" * 8, "-" * 10, "-" * 10, "-" * 12)
+    results = {}
+    for name, m in [ ("naive", naive), ("matcher", xm) ]:
+        t = time.time()
+        results[name] = [ m.match(p) for p in paths ]
+        t = time.time() - t
+        print "%-8s %10d %10.2f %12.0f" % (name, results[name].count(True), t, npaths / t)
+
+    print ""
+    print "matcher stats: %s" % xm.stats_format()
+    if results["naive"] != results["matcher"]:
+        print "ERROR: results differ!"
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
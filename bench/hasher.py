@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+###############################################################################
+# bench/hasher.py
+#
+#   ChirriHasher benchmark. Reports hashing throughput for several block
+#   sizes, comparing the old behaviour (hexdigest after every update) with
+#   the lazy digest calculation.
+#
+#   Usage: bench/hasher.py [size_mb]
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import hashlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import chirribackup.crypto
+
+
+class EagerHasher(object):
+    """hasher that calculates the digest after every update (old behaviour)"""
+
+    def __init__(self):
+        self.hasher = hashlib.sha512()
+        self.nbytes = 0
+        self.hash = self.hasher.hexdigest()
+
+    def update(self, data):
+        self.hasher.update(data)
+        self.nbytes = self.nbytes + len(data)
+        self.hash = self.hasher.hexdigest()
+
+
+def run(hasher_class, data, blocksize):
+    t = time.time()
+    h = hasher_class()
+    for i in range(0, len(data), blocksize):
+        h.update(data[i:i + blocksize])
+    h.hash
+    return len(data) / (time.time() - t) / (1024.0 * 1024.0)
+
+
+def main(argv):
+    size = int(argv[0]) if len(argv) > 0 else 64
+    data = os.urandom(size * 1024 * 1024)
+
+    print "Hashing %d MiB of data" % size
+    print ""
+    print "%10s %12s %12s" % ("block", "eager MiB/s", "lazy MiB/s")
+    print "%10s %12s %12s" % ("-" * 10, "-" * 12, "-" * 12)
+    for blocksize in [ 512, 4096, 65536, 1024 * 1024 ]:
+        print "%10d %12.2f %12.2f" % (
+                blocksize,
+                run(EagerHasher, data, blocksize),
+                run(chirribackup.crypto.ChirriHasher, data, blocksize))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
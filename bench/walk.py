@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+# -*- coding: UTF-8 -*-
+###############################################################################
+# bench/walk.py
+#
+#   Filesystem walker benchmark. Generates a tree of empty files (if it does
+#   not exist yet) and compares the old recursive discovery (listdir, one
+#   realpath/abspath/lstat per entry) with chirribackup.walker.
+#
+#   Usage: bench/walk.py [files] [tree_dir]
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import chirribackup.walker
+
+FILES_PER_DIR = 100
+DIRS_PER_DIR  = 10
+
+
+def generate(root, files):
+    """creates 'files' empty files in a tree below 'root'"""
+    n = 0
+    queue = [ root ]
+    while n < files:
+        d = queue.pop(0)
+        for i in range(0, DIRS_PER_DIR):
+            sd = os.path.join(d, "d%d" % i)
+            os.mkdir(sd)
+            queue.append(sd)
+        for i in range(0, FILES_PER_DIR):
+            if n >= files:
+                break
+            open(os.path.join(d, "f%d" % i), "w").close()
+            n += 1
+
+
+def walk_recursive(base, target_path = "."):
+    """the old algorithm of Snapshot.run_discover_files()"""
+    base = os.path.realpath(base)
+    path = os.path.abspath(os.path.join(base, target_path))
+    target_path = path[len(os.path.join(base, "")):]
+    statinfo = os.lstat(os.path.join(base, path))
+    n = 1
+    if stat.S_ISDIR(statinfo.st_mode):
+        for f in os.listdir(path):
+            n += walk_recursive(base, os.path.join(target_path, f))
+    return n
+
+
+def walk_iterative(base):
+    n = 1
+    for rel_path, abs_path, statinfo in chirribackup.walker.walk(os.path.realpath(base)):
+        n += 1
+    return n
+
+
+def main(argv):
+    files = int(argv[0]) if len(argv) > 0 else 1000000
+    root = argv[1] if len(argv) > 1 else None
+
+    tmp = None
+    if root is None:
+        tmp = root = tempfile.mkdtemp(prefix = "chirri-walk-")
+    try:
+        if not os.path.exists(os.path.join(root, "d0")):
+            print "Generating tree with %d files in '%s'" % (files, root)
+            generate(root, files)
+
+        print "scandir: %s" % ("yes" if chirribackup.walker.scandir is not None else "no (os.listdir)")
+        print ""
+        print "%-10s %10s %10s %12s" % ("method", "entries", "seconds", "entries/s")
+        print "%-10s %10s %10s %12s" % ("-" * 10, "-" * 10, "-" * 10, "-" * 12)
+        for name, func in [ ("recursive", walk_recursive), ("walker", walk_iterative) ]:
+            t = time.time()
+            n = func(root)
+            t = time.time() - t
+            print "%-10s %10d %10.2f %12.0f" % (name, n, t, n / t)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
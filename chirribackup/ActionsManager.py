@@ -45,6 +45,9 @@ action_handlers = {
             "check"    : "DbCheck",
             "rebuild"  : "DbRebuild",
             "status"   : "DbStatus",
+            "stats"    : {
+                "compression" : "DbStatsCompression",
+            },
             "config"   : {
                 "save"   : "DbConfigSave",
                 "delete" : "DbConfigDelete",
@@ -154,7 +157,7 @@ def invoke(args):
         # commit changes
         if action.ldb is not None:
             logger.debug("Commiting changes")
-            action.ldb.connection.commit()
+            action.ldb.commit()
 
     except ActionInvocationException, ex:
         raise
@@ -162,7 +165,7 @@ def invoke(args):
     except exceptions.Exception, ex:
         if action.ldb is not None:
             logger.debug("Trying to rollback")
-            action.ldb.connection.rollback()
+            action.ldb.rollback()
         else:
             logger.warning("Cannot rollback")
 
@@ -27,6 +27,7 @@
 ###############################################################################
 
 from chirribackup.Logger import logger
+import chirribackup.compression
 import chirribackup.storage.BaseStorage
 import chirribackup.snapshot
 import json
@@ -37,7 +38,125 @@ import sqlite3
 
 from chirribackup.exceptions import ChirriException, ConfigNotFoundException
 
-DB_VERSION = 2
+DB_VERSION = 3
+
+# sqlite3 prepared statements cache size (python default is 100)
+CACHED_STATEMENTS = 1024
+
+# accepted values for the pragma keys
+PRAGMA_VALUES = {
+    "journal_mode" : [ "delete", "truncate", "persist", "memory", "wal", "off" ],
+    "synchronous"  : [ "off", "normal", "full", "extra" ],
+}
+
+# basic configuration keys
+STATUS_KEYS = {
+    # db_version
+    #   Database version.
+    "db_version" :       { "save": 0, "type": "int", "value": DB_VERSION },
+    # status
+    #   Database status. One of following values:
+    #       0  downloading file list
+    #       1  downloading snapshots and info
+    #       2  select snapshot to restore
+    #       3  restoring snapshot
+    #     100  normal operations
+    "status" :           { "save": 0, "type": "int", "value": 100 },
+    # last_snapshot_id
+    #   Well, it does not contain really the latest, it actually
+    #   contains the biggest snapshot_id assigned.
+    "last_snapshot_id" : { "save": 0, "type": "int", "value": 0 },
+    # last_exclude_id
+    #   It contains the latest exclude id assigned.
+    "last_exclude_id"  : { "save": 0, "type": "int", "value": 0 },
+    # last_config_id
+    #   It contains the latest config id assigned.
+    "last_config_id"   : { "save": 0, "type": "int", "value": 0 },
+    # rebuild_snapshot
+    #   When running 'db rebuild', this attribute contains the target
+    #   snapshot that must be restored.
+    "rebuild_snapshot" : { "save": 0, "type": "int", "value": None },
+    # storage_type
+    #   storage backend used for backups. Take a look at
+    #   chirribackup/storage/*.py
+    "storage_type" :     { "save": 1, "type": "str", "value": None },
+    # compression
+    #   storage compression
+    "compression" :      { "save": 1, "type": "str", "value": None },
+    # compression_level, compression_threads
+    #   Compression level and number of threads (only zstd) used by the
+    #   storage compression algorithm. None means the codec default.
+    "compression_level" :   { "save": 1, "type": "int", "value": None },
+    "compression_threads" : { "save": 1, "type": "int", "value": None },
+    # compression_sampling
+    #   If True, chunks are not compressed when the ratio observed for files
+    #   of the same type (or the ratio of a small sample of the chunk) shows
+    #   that they are not compressible.
+    "compression_sampling" : { "save": 1, "type": "bool", "value": True },
+    # compression_candidates
+    #   Comma separated list of compression algorithms that may be used
+    #   instead of 'compression' (only if 'compression_sampling' is True).
+    #   Big chunks are sampled with each one, choosing the fastest
+    #   algorithm that compresses almost as well as the best one.
+    "compression_candidates" : { "save": 1, "type": "str", "value": None },
+    # snapshot_compression
+    #   If True, new chunks are compressed while they are copied during
+    #   snapshots, instead of being copied uncompressed and compressed
+    #   later during sync (saving a full write and read of new data).
+    "snapshot_compression" : { "save": 1, "type": "bool", "value": False },
+    # snapshot_desc_format
+    #   Format of the snapshot descriptions uploaded: 'txt' (CSV), 'json' or
+    #   'bin' (compact binary format, see chirribackup/bindesc.py; it is
+    #   uploaded as 'snapshot-N.bin' and older versions cannot read it).
+    "snapshot_desc_format" : { "save": 1, "type": "str", "value": "txt" },
+    # cdc_min_file_size
+    #   Files with this size or bigger are split in content defined chunks
+    #   (see chirribackup/cdc.py). None disables chunking.
+    "cdc_min_file_size" :  { "save": 1, "type": "int", "value": None },
+    # cdc_avg_chunk_size
+    #   Average size of the content defined chunks.
+    "cdc_avg_chunk_size" : { "save": 1, "type": "int", "value": 1048576 },
+    # single_pass_min_size
+    #   New files with this size or bigger are hashed and copied to the
+    #   chunks directory in a single read pass (the copy is dropped if the
+    #   chunk already exists). Smaller files are hashed first and copied
+    #   only when needed. None disables single pass mode.
+    "single_pass_min_size" : { "save": 1, "type": "int", "value": 65536 },
+    # hash_jobs
+    #   Number of threads used for hashing files during snapshots. If 1,
+    #   files are hashed in the main thread. None or 0 means one thread
+    #   for each CPU.
+    "hash_jobs" :        { "save": 1, "type": "int", "value": None },
+    # compress_jobs
+    #   Number of threads compressing chunks during sync. None or 0 means
+    #   one thread for each CPU.
+    "compress_jobs" :    { "save": 1, "type": "int", "value": None },
+    # sync_jobs
+    #   Number of chunks transferred at the same time during sync. None or 0
+    #   means the default of the storage backend (see the sync_jobs
+    #   attribute of each storage manager).
+    "sync_jobs" :        { "save": 1, "type": "int", "value": None },
+    # restore_jobs
+    #   Number of chunks downloaded (and files written) at the same time
+    #   when restoring an snapshot. None or 0 means the default of the
+    #   storage backend (sync_jobs attribute of each storage manager).
+    "restore_jobs" :     { "save": 1, "type": "int", "value": None },
+    # db_journal_mode, db_synchronous, db_cache_size, db_mmap_size
+    #   SQLite pragmas applied when opening the local database (see
+    #   https://www.sqlite.org/pragma.html). WAL with synchronous NORMAL
+    #   only fsyncs on checkpoints. None keeps the SQLite default.
+    "db_journal_mode" :  { "save": 1, "type": "str", "value": "wal" },
+    "db_synchronous" :   { "save": 1, "type": "str", "value": "normal" },
+    "db_cache_size" :    { "save": 1, "type": "int", "value": -65536 },
+    "db_mmap_size" :     { "save": 1, "type": "int", "value": 268435456 },
+    # db_commit_rows, db_commit_seconds
+    #   Long operations (snapshots and syncs) commit their work when this
+    #   number of rows has been changed or these seconds have passed since
+    #   the last commit.
+    "db_commit_rows" :   { "save": 1, "type": "int", "value": 10000 },
+    "db_commit_seconds" : { "save": 1, "type": "int", "value": 10 },
+}
+
 
 class LocalDatabase(object):
 
@@ -47,45 +166,16 @@ class LocalDatabase(object):
     chunks_dir = None
     connection = None
 
+    # write batching (see maybe_commit())
+    commit_hooks        = None
+    commit_rows         = None
+    commit_seconds      = None
+    last_commit_changes = None
+    last_commit_tstamp  = None
 
-    def __create_tables(self, storage_type):
-        c = self.connection.cursor()
 
-        # basic configuration keys
-        status_keys = {
-            # db_version
-            #   Database version.
-            "db_version" :       { "save": 0, "type": "int", "value": DB_VERSION },
-            # status
-            #   Database status. One of following values:
-            #       0  downloading file list
-            #       1  downloading snapshots and info
-            #       2  select snapshot to restore
-            #       3  restoring snapshot
-            #     100  normal operations
-            "status" :           { "save": 0, "type": "int", "value": 100 },
-            # last_snapshot_id
-            #   Well, it does not contain really the latest, it actually
-            #   contains the biggest snapshot_id assigned.
-            "last_snapshot_id" : { "save": 0, "type": "int", "value": 0 },
-            # last_exclude_id
-            #   It contains the latest exclude id assigned.
-            "last_exclude_id"  : { "save": 0, "type": "int", "value": 0 },
-            # last_config_id
-            #   It contains the latest config id assigned.
-            "last_config_id"   : { "save": 0, "type": "int", "value": 0 },
-            # rebuild_snapshot
-            #   When running 'db rebuild', this attribute contains the target
-            #   snapshot that must be restored.
-            "rebuild_snapshot" : { "save": 0, "type": "int", "value": None },
-            # storage_type
-            #   storage backend used for backups. Take a look at
-            #   chirribackup/storage/*.py
-            "storage_type" :     { "save": 1, "type": "str", "value": None },
-            # compression
-            #   storage compression
-            "compression" :      { "save": 1, "type": "str", "value": None },
-        }
+    def __create_tables(self, storage_type):
+        status_keys = dict(STATUS_KEYS)
 
         # Create temporary sm for adding specific configuration keys
         sm = chirribackup.storage.BaseStorage.GetStorageManager(
@@ -97,7 +187,17 @@ class LocalDatabase(object):
                 raise ChirriException("storage key '%s' already exists in basic status_keys." % sk)
             status_keys[sk] = v
 
-        # Create table
+        # Create tables and populate status table
+        self.create_tables()
+        for k,v in status_keys.items():
+            self.config_attrib_new(k, v["save"], v["type"], v["value"])
+
+
+    def create_tables(self):
+        """create missing tables (it is also used for upgrading old dbs)"""
+        c = self.connection.cursor()
+
+        # TABLE: status (key)
         c.execute('''
                 CREATE TABLE IF NOT EXISTS status (
                     key             TEXT PRIMARY KEY,
@@ -105,8 +205,6 @@ class LocalDatabase(object):
                     type            VARCHAR(8) NOT NULL CHECK (type = "int" OR type = "str" OR type = "bool"),
                     value           TEXT
                 )''')
-        for k,v in status_keys.items():
-            self.config_attrib_new(k, v["save"], v["type"], v["value"])
 
         # TABLE: file_data (hash, size)
         #   hash
@@ -130,7 +228,7 @@ class LocalDatabase(object):
         #   deleted
         #     Deletion scheduled
         #   compression
-        #     Compression algorithm used (NULL, lzma, ...)
+        #     Compression algorithm used (NULL, lzma, zstd, ...)
         c.execute('''
                 CREATE TABLE IF NOT EXISTS file_data (
                     hash            TEXT,
@@ -148,6 +246,9 @@ class LocalDatabase(object):
         #       Snapshot id (view table "snapshots")
         #   path, perm, uid, gid, mtime
         #       File metadata
+        #   inode, ctime
+        #       Local file metadata, only used for detecting changes (NULL
+        #       means unknown)
         #   hash, size
         #       Associated content (view table "file_data")
         #   status
@@ -172,9 +273,18 @@ class LocalDatabase(object):
                     gid             INTEGER,
                     mtime           INTEGER,
                     status          INTEGER,
+                    inode           INTEGER,
+                    ctime           INTEGER,
                     PRIMARY KEY (snapshot, path)
                 )''')
 
+        # INDEX: file_ref_hash (snapshot, hash, path)
+        #   Used for walking the refs of a snapshot grouped by content (see
+        #   Snapshot.refs())
+        c.execute('''
+                CREATE INDEX IF NOT EXISTS file_ref_hash
+                    ON file_ref (snapshot, hash, path)''')
+
         # TABLE: snapshots
         #   snapshot
         #       Snapshot id
@@ -188,7 +298,10 @@ class LocalDatabase(object):
         #         4 - snapshot prepared for upload
         #         5 - uploaded
         #   compression
-        #     Compression algorithm used (NULL, lzma, ...)
+        #     Compression algorithm used (NULL, lzma, zstd, ...)
+        #   desc_format
+        #     Format of the uploaded description (NULL or 'txt', 'json' or
+        #     'bin')
         #   delete
         #     Deletion scheduled
         c.execute(
@@ -200,6 +313,7 @@ class LocalDatabase(object):
                     finished_tstamp INTEGER,
                     signed_tstamp   INTEGER,
                     compression     VARCHAR(8),
+                    desc_format     VARCHAR(8),
                     deleted         INTEGER NOT NULL DEFAULT 0
                 )
             """)
@@ -241,6 +355,90 @@ class LocalDatabase(object):
                 )
             """)
 
+        # TABLE: file_chunks (hash, seq)
+        #   hash
+        #       Manifest chunk (view table "file_data") of a file split in
+        #       content defined chunks. The manifest is uploaded as any other
+        #       chunk, so this table can be rebuilt from the remote storage.
+        #   seq
+        #       Position of the part in the file
+        #   part, size
+        #       Chunk (view table "file_data") containing this part
+        c.execute(
+            """
+                CREATE TABLE IF NOT EXISTS file_chunks (
+                    hash        TEXT NOT NULL,
+                    seq         INTEGER NOT NULL,
+                    part        TEXT NOT NULL,
+                    size        INTEGER NOT NULL,
+                    PRIMARY KEY (hash, seq)
+                )
+            """)
+
+        # TABLE: compression_stats (compression, key)
+        #   compression
+        #       Compression algorithm
+        #   key
+        #       File type: extension ("ext:.jpg") or magic number
+        #       ("magic:ffd8ffe0")
+        #   samples, size, csize
+        #       Number of observations, and bytes before and after
+        #       compression (see chirribackup.compression.CompressionAdvisor)
+        c.execute(
+            """
+                CREATE TABLE IF NOT EXISTS compression_stats (
+                    compression VARCHAR(8) NOT NULL,
+                    key         TEXT NOT NULL,
+                    samples     INTEGER NOT NULL,
+                    size        INTEGER NOT NULL,
+                    csize       INTEGER NOT NULL,
+                    PRIMARY KEY (compression, key)
+                )
+            """)
+
+        # TABLE: compression_history (compression, ext, bucket)
+        #   compression
+        #       Compression algorithm
+        #   ext, bucket
+        #       File extension and size class (see
+        #       chirribackup.compression.size_bucket) of the compressed chunks
+        #   chunks, size, csize, seconds
+        #       Number of chunks compressed by Chunk.compress, bytes before
+        #       and after compression, and time spent compressing them
+        c.execute(
+            """
+                CREATE TABLE IF NOT EXISTS compression_history (
+                    compression VARCHAR(8) NOT NULL,
+                    ext         TEXT NOT NULL,
+                    bucket      INTEGER NOT NULL,
+                    chunks      INTEGER NOT NULL,
+                    size        INTEGER NOT NULL,
+                    csize       INTEGER NOT NULL,
+                    seconds     REAL NOT NULL,
+                    PRIMARY KEY (compression, ext, bucket)
+                )
+            """)
+
+        # TABLE: restore_journal (target, path)
+        #   target
+        #       Target directory of an unfinished restore
+        #   path
+        #       File already restored (relative to target)
+        #   snapshot, hash
+        #       Snapshot being restored, and hash of the restored file ref.
+        #       Files restored (with the size and mtime of their file_ref)
+        #       are not checked again when an interrupted restore continues.
+        c.execute(
+            """
+                CREATE TABLE IF NOT EXISTS restore_journal (
+                    target      TEXT NOT NULL,
+                    path        TEXT NOT NULL,
+                    snapshot    INTEGER NOT NULL,
+                    hash        TEXT NOT NULL,
+                    PRIMARY KEY (target, path)
+                )
+            """)
+
 
     def __init__(self, path, init = False, storage_type = None, db_version_check = True):
         super(LocalDatabase, self).__setattr__('db_path', path)
@@ -260,12 +458,13 @@ class LocalDatabase(object):
             logger.info("Creating database '%s'." % self.db_file)
 
         # connect to database
-        self.connection = sqlite3.connect(self.db_file)
+        self.connection = sqlite3.connect(self.db_file, cached_statements = CACHED_STATEMENTS)
         self.connection.row_factory = sqlite3.Row
         self.connection.text_factory = str
 
         if init:
             self.__create_tables(storage_type)
+            self.connection.commit()
 
         if self.db_version != DB_VERSION:
             if db_version_check:
@@ -279,6 +478,82 @@ class LocalDatabase(object):
         if not os.path.exists(self.chunks_dir):
             os.mkdir(self.chunks_dir, 0700)
 
+        # configure database connection
+        self.set_pragmas()
+        chirribackup.compression.configure(
+                self.compression,
+                self.compression_level,
+                self.compression_threads)
+        self.commit_hooks = []
+        self.commit_rows = self.db_commit_rows
+        self.commit_seconds = self.db_commit_seconds
+        self.last_commit_changes = self.connection.total_changes
+        self.last_commit_tstamp = time.time()
+
+
+    def set_pragmas(self):
+        for pragma, key, ptype in [
+                    ( "journal_mode", "db_journal_mode", "str" ),
+                    ( "synchronous",  "db_synchronous",  "str" ),
+                    ( "cache_size",   "db_cache_size",   "int" ),
+                    ( "mmap_size",    "db_mmap_size",    "int" ),
+                ]:
+            value = self.config_attrib_get(key)
+            if value is None:
+                continue
+            if ptype == "str":
+                value = str(value).lower()
+                if value not in PRAGMA_VALUES[pragma]:
+                    logger.warning("Ignoring bad value '%s' for %s." % (value, key))
+                    continue
+            else:
+                value = int(value)
+            self.connection.execute("PRAGMA %s = %s" % (pragma, value))
+
+
+    def commit(self):
+        """commits current transaction and runs the post-commit hooks"""
+        self.connection.commit()
+        self.last_commit_changes = self.connection.total_changes
+        self.last_commit_tstamp = time.time()
+        hooks = self.commit_hooks
+        self.commit_hooks = []
+        for hook in hooks:
+            hook()
+
+
+    def rollback(self):
+        """rollbacks current transaction, forgetting the post-commit hooks"""
+        self.connection.rollback()
+        self.commit_hooks = []
+
+
+    def maybe_commit(self):
+        """commits if 'db_commit_rows' rows have been changed or
+           'db_commit_seconds' have passed since last commit. It returns True
+           if commit was done"""
+        if (self.commit_rows is not None \
+            and self.connection.total_changes - self.last_commit_changes >= self.commit_rows) \
+        or (self.commit_seconds is not None \
+            and time.time() - self.last_commit_tstamp >= self.commit_seconds):
+            self.commit()
+            return True
+        return False
+
+
+    def on_commit(self, hook):
+        """calls 'hook' after next commit (ex. for deleting a file that is
+           not referenced anymore by the database)"""
+        self.commit_hooks.append(hook)
+
+
+    def unlink_on_commit(self, path):
+        """deletes file 'path' (if it still exists) after next commit"""
+        def unlink():
+            if os.path.exists(path):
+                os.unlink(path)
+        self.on_commit(unlink)
+
 
     def snapshot_list(self):
         slist = []
@@ -372,10 +647,94 @@ class LocalDatabase(object):
         counters["chunks_bytes_pending_upload"] = \
                     counters["chunks_uncompressed_bytes_pending_upload"] \
                     + counters["chunks_compressed_bytes_pending_upload"]
+        counters["chunks_bytes_pending_upload_estimated"] = \
+                    self.compression_estimate()
 
         return counters
 
 
+    def compression_history_add(self, compression, path, size, csize, seconds):
+        """records a chunk compressed by Chunk.compress"""
+        params = {
+            "compression" : compression,
+            "ext"         : chirribackup.compression.file_ext(path),
+            "bucket"      : chirribackup.compression.size_bucket(size),
+            "size"        : size,
+            "csize"       : csize,
+            "seconds"     : seconds,
+        }
+        self.connection.execute(
+            """
+                INSERT OR IGNORE INTO compression_history
+                    (compression, ext, bucket, chunks, size, csize, seconds)
+                    VALUES (:compression, :ext, :bucket, 0, 0, 0, 0)
+            """, params)
+        self.connection.execute(
+            """
+                UPDATE compression_history
+                SET chunks = chunks + 1,
+                    size = size + :size,
+                    csize = csize + :csize,
+                    seconds = seconds + :seconds
+                WHERE compression = :compression
+                  AND ext = :ext
+                  AND bucket = :bucket
+            """, params)
+
+
+    def compression_history(self, compression = None):
+        return self.connection.execute(
+            """
+                SELECT *
+                FROM compression_history
+                WHERE :compression IS NULL OR compression = :compression
+                ORDER BY compression, ext, bucket
+            """, {
+                "compression" : compression,
+            }).fetchall()
+
+
+    def compression_estimate(self):
+        """estimates the bytes that the next sync will upload. Chunks not
+           compressed yet are estimated using the ratio observed for their
+           extension and size class (or extension, or algorithm)"""
+        compression = self.compression
+        ratios = {}
+        size = 0
+        csize = 0
+        if compression is not None:
+            for h in self.compression_history(compression):
+                for k in [ (h["ext"], h["bucket"]), h["ext"] ]:
+                    r = ratios.setdefault(k, [ 0, 0 ])
+                    r[0] += h["size"]
+                    r[1] += h["csize"]
+                size += h["size"]
+                csize += h["csize"]
+        default = min(1.0, float(csize) / float(size)) if size > 0 else 1.0
+
+        estimated = self.connection.execute(
+                        """
+                            SELECT SUM(csize)
+                            FROM file_data
+                            WHERE status = 1 AND refcount > 0
+                        """).fetchone()[0] or 0
+        for c in self.connection.execute(
+                        """
+                            SELECT first_seen_as, size
+                            FROM file_data
+                            WHERE status = 0 AND refcount > 0
+                        """):
+            ratio = default
+            if compression is not None:
+                ext = chirribackup.compression.file_ext(c["first_seen_as"])
+                for k in [ (ext, chirribackup.compression.size_bucket(c["size"])), ext ]:
+                    if k in ratios and ratios[k][0] > 0:
+                        ratio = min(1.0, float(ratios[k][1]) / float(ratios[k][0]))
+                        break
+            estimated += c["size"] * ratio
+        return int(estimated)
+
+
     def get_storage_manager(self):
         return chirribackup.storage.BaseStorage.GetStorageManager(
                         self.storage_type,
@@ -386,13 +745,22 @@ class LocalDatabase(object):
     def is_db_file(self, rel_path):
         if rel_path == "__chunks__" \
         or rel_path == "__chirri__.db" \
-        or rel_path == "__chirri__.db-journal":
+        or rel_path == "__chirri__.db-journal" \
+        or rel_path == "__chirri__.db-wal" \
+        or rel_path == "__chirri__.db-shm":
             return True
 
         return False
 
     def config_attrib_list(self):
         status = {}
+        for k, v in STATUS_KEYS.items():
+            status[k] = {
+                "save":  v["save"],
+                "type":  v["type"],
+                "value": self.config_attrib_check_and_fix(v["type"], k, v["value"]) \
+                            if v["value"] is not None else None,
+            }
         for kv in self.connection.execute("SELECT * FROM status"):
             status[kv["key"]] = {
                 "save":  kv["save"],
@@ -413,7 +781,8 @@ class LocalDatabase(object):
             except ValueError, ex:
                 raise AttributeError("attribute %s requires None or int value (value = %s)." % (key, value))
 
-            value = str(value)
+            if value is not None:
+                value = str(value)
 
         elif entry_type == "bool":
             if re.compile("^(y(es)?|true)$", re.IGNORECASE).match(str(value)):
@@ -458,6 +827,11 @@ class LocalDatabase(object):
                     "SELECT save, type, value FROM status WHERE key = :key",
                     { "key": key }).fetchone()
             if ra is None:
+                if key in STATUS_KEYS:
+                    # key added in a newer version -- create it now
+                    self.config_attrib_new(key, STATUS_KEYS[key]["save"],
+                                           STATUS_KEYS[key]["type"], value)
+                    return
                 raise AttributeError("%s object has no %r attribute" \
                                         % (self.__class__.__name__, key))
             value = self.config_attrib_check_and_fix(ra["type"], key, value)
@@ -481,6 +855,9 @@ class LocalDatabase(object):
                     "SELECT save, type, value FROM status WHERE key = :key",
                     { "key": key }).fetchone()
             if ra is None:
+                if key in STATUS_KEYS:
+                    # key added in a newer version -- use default value
+                    return STATUS_KEYS[key]["value"]
                 raise AttributeError("%s object has no %r attribute" \
                                         % (self.__class__.__name__, key))
         else:
@@ -489,6 +866,9 @@ class LocalDatabase(object):
         if ra["value"] is None:
             return None
         if ra["type"] == "int":
+            # old versions stored unset integers as the string 'None'
+            if ra["value"] == "None":
+                return None
             return int(ra["value"])
         if ra["type"] == "bool":
             if ra["value"] == "true":
@@ -531,7 +911,14 @@ class LocalDatabase(object):
                                         % (self.__class__.__name__, attr))
             else:
                 self.__dict__[attr] = value
-        elif attr in [ "connection" ]:
+        elif attr in [
+                        "commit_hooks",
+                        "commit_rows",
+                        "commit_seconds",
+                        "connection",
+                        "last_commit_changes",
+                        "last_commit_tstamp",
+                    ]:
             self.__dict__[attr] = value
         else:
             self.config_attrib_set(attr, value)
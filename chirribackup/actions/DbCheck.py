@@ -162,8 +162,20 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
         chunk_ref_count = {}
         for r in self.ldb.connection.execute(
                     """
-                        SELECT hash, COUNT(*) AS refcount
-                        FROM file_ref
+                        SELECT hash, SUM(refcount) AS refcount
+                        FROM (
+                            SELECT CASE WHEN hash LIKE 'chunked:%'
+                                        THEN substr(hash, 9)
+                                        ELSE hash
+                                   END AS hash,
+                                   COUNT(*) AS refcount
+                            FROM file_ref
+                            GROUP BY hash
+                            UNION ALL
+                            SELECT part AS hash, COUNT(*) AS refcount
+                            FROM file_chunks
+                            GROUP BY part
+                        )
                         GROUP BY hash
                     """):
             chunk_ref_count[r["hash"]] = r["refcount"]
@@ -196,7 +208,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
             refcount = chunk_ref_count[chunk.hash] if chunk.hash in chunk_ref_count else 0
 
             if refcount == 0:
-                logger.error("check_chunks: Chunk '%s' is never referenced", chunk.hash_format())
+                logger.error("check_chunks: Chunk '%s' is never referenced" % chunk.hash_format())
 
             if refcount != chunk.refcount:
                 logger.error("check_chunks: Chunk '%s' referenced %d times, but expected %d" \
@@ -216,7 +228,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
                                 "hash"     : chunk.hash,
                                 "refcount" : refcount,
                             })
-                        self.ldb.connection.commit()
+                        self.ldb.commit()
 
             # 5. 0 <= status <= 1
             if chunk.status < 0 or chunk.status > 2:
@@ -224,7 +236,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
                 # i dont know what to do here
 
             # 6. compression algorithm
-            if chunk.compression is not None and chunk.compression not in [ "lzma" ]:
+            if not chirribackup.compression.algorithm_check(chunk.compression):
                 logger.error("check_chunks: Chunk %s is using unknown compression algorithm '%s'" \
                                 % (chunk.hash_format(), chunk.compression))
                 raise ChirriException("Not implemented")
@@ -245,6 +257,96 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
         logger.info("check_chunks: finished")
 
 
+    def check_file_chunks(self):
+        logger.info("check_file_chunks: started")
+
+        # 1. manifests exist
+        for r in self.ldb.connection.execute(
+                    """
+                        SELECT hash, COUNT(*) AS parts
+                        FROM file_chunks
+                        WHERE hash NOT IN (SELECT hash FROM file_data)
+                        GROUP BY hash
+                    """).fetchall():
+            logger.error("check_file_chunks: Manifest %s of %d parts does not exist" \
+                            % (r["hash"], r["parts"]))
+            if self.do_fix("Delete parts of unknown manifest"):
+                # NOTE: part refcounts are fixed later by check_chunks()
+                self.ldb.connection.execute(
+                        "DELETE FROM file_chunks WHERE hash = :hash",
+                        { "hash" : r["hash"] })
+                self.ldb.commit()
+
+        # 2. parts exist and sizes match
+        for r in self.ldb.connection.execute(
+                    """
+                        SELECT file_chunks.hash, file_chunks.seq, file_chunks.part,
+                               file_chunks.size, file_data.size AS part_size
+                        FROM file_chunks
+                            LEFT JOIN file_data ON file_data.hash = file_chunks.part
+                        WHERE file_data.hash IS NULL
+                           OR file_data.size != file_chunks.size
+                    """).fetchall():
+            if r["part_size"] is None:
+                logger.error("check_file_chunks: Part %d (%s) of manifest %s does not exist" \
+                                % (r["seq"],
+                                   r["part"],
+                                   r["hash"]))
+            else:
+                logger.error("check_file_chunks: Part %d (%s) of manifest %s has size %d, but expected %d" \
+                                % (r["seq"],
+                                   r["part"],
+                                   r["hash"],
+                                   r["part_size"], r["size"]))
+            if self.do_fix("Set references to broken manifest as erroneous"):
+                self.ldb.connection.execute(
+                        """
+                            UPDATE file_ref
+                            SET status = -1, hash = 'lost'
+                            WHERE hash = :chunked
+                        """, { "chunked" : "chunked:" + r["hash"] })
+                self.ldb.commit()
+
+        # 3. parts are numbered without gaps
+        for r in self.ldb.connection.execute(
+                    """
+                        SELECT hash, COUNT(*) AS parts, MIN(seq) AS min_seq, MAX(seq) AS max_seq
+                        FROM file_chunks
+                        GROUP BY hash
+                        HAVING MIN(seq) != 0 OR MAX(seq) != COUNT(*) - 1
+                    """):
+            logger.error("check_file_chunks: Manifest %s has %d parts numbered from %d to %d" \
+                            % (r["hash"],
+                               r["parts"], r["min_seq"], r["max_seq"]))
+
+        # 4. chunked file_refs point to registered manifests
+        for r in self.ldb.connection.execute(
+                    """
+                        SELECT DISTINCT substr(hash, 9) AS hash
+                        FROM file_ref
+                        WHERE hash LIKE 'chunked:%'
+                          AND substr(hash, 9) NOT IN (SELECT hash FROM file_chunks)
+                    """):
+            logger.error("check_file_chunks: Manifest %s is referenced, but its parts are not registered" \
+                            % r["hash"])
+
+        # 5. parts are referenced (at least) by their manifests
+        for r in self.ldb.connection.execute(
+                    """
+                        SELECT file_chunks.part, COUNT(*) AS refs, file_data.refcount
+                        FROM file_chunks
+                            JOIN file_data ON file_data.hash = file_chunks.part
+                        GROUP BY file_chunks.part
+                        HAVING file_data.refcount < COUNT(*)
+                    """):
+            # NOTE: counters are fixed by check_chunks()
+            logger.error("check_file_chunks: Part %s is used %d times by manifests, but its refcount is %d" \
+                            % (r["part"],
+                               r["refs"], r["refcount"]))
+
+        logger.info("check_file_chunks: finished")
+
+
     def check_local_chunks(self):
         logger.info("check_local_chunks: started")
 
@@ -304,7 +406,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
                             self.ldb.connection.execute(
                                     "DELETE FROM file_data WHERE hash = :hash",
                                     { "hash" : chunk.hash })
-                            self.ldb.connection.commit()
+                            self.ldb.commit()
 
                 except IOError, ex:
                     logger.error("check_local_chunks: Cannot read chunk %s: %s" % (fpath, ex))
@@ -341,7 +443,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
                     self.ldb.connection.execute(
                                 "DELETE FROM file_data WHERE hash = :hash",
                                 { "hash" : fd["hash"] })
-                    self.ldb.connection.commit()
+                    self.ldb.commit()
 
         logger.info("check_local_chunks: finished")
 
@@ -363,7 +465,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
         if not column_snapshots_compression_exists:
             logger.warning("check_db: Adding missing column snapshots.compression")
             self.ldb.connection.execute("ALTER TABLE snapshots ADD COLUMN compression VARCHAR(8)")
-            self.ldb.connection.commit()
+            self.ldb.commit()
 
         # add snapshots.signed column
         if not column_snapshots_signed_tstamp_exists:
@@ -375,7 +477,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
                         UPDATE snapshots
                         SET signed_tstamp = uploaded_tstamp
                     """)
-            self.ldb.connection.commit()
+            self.ldb.commit()
 
         # delete snapshots.uploaded_tstamp column
         if column_snapshots_uploaded_tstamp_exists:
@@ -384,7 +486,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
             # database; we can cope with some little anoying bytes.
             #logger.warning("check_db: Delete unused column snapshots.uploaded_tstamp")
             #self.ldb.connection.execute("ALTER TABLE snapshots DROP COLUMN uploaded_tstamp")
-            #self.ldb.connection.commit()
+            #self.ldb.commit()
             logger.warning("check_db: Detected an old database with snapshots.uploaded_tstamp column. Ignoring it.")
 
         # check for unknown config values
@@ -412,7 +514,34 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
 
             # upgrade database
             self.ldb.db_version = 2
-            self.ldb.connection.commit()
+            self.ldb.commit()
+
+        # upgrading from db_version 2 to db_version 3
+        if self.ldb.db_version == 2:
+            if not self.do_fix("Upgrade database to version 3"):
+                raise ChirriException("Cannot continue without upgrading database")
+
+            # Added columns file_ref.inode and file_ref.ctime (stat cache) and
+            # snapshots.desc_format (snapshot description format)
+            for table, column, column_type in [
+                        ("file_ref",  "inode",       "INTEGER"),
+                        ("file_ref",  "ctime",       "INTEGER"),
+                        ("snapshots", "desc_format", "VARCHAR(8)"),
+                    ]:
+                if column not in [ c["name"] for c in self.ldb.connection.execute(
+                                        "PRAGMA table_info(%s)" % table) ]:
+                    self.ldb.connection.execute("ALTER TABLE %s ADD COLUMN %s %s" \
+                                                    % (table, column, column_type))
+
+            # Added tables file_chunks (content defined chunking),
+            # compression_stats and compression_history (compression
+            # sampling and statistics), restore_journal, and index
+            # file_ref_hash
+            self.ldb.create_tables()
+
+            # upgrade database
+            self.ldb.db_version = 3
+            self.ldb.commit()
 
         logger.info("check_db: finished")
 
@@ -434,7 +563,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
                         """, {
                             "exclude_id": x["exclude_id"],
                         })
-                    self.ldb.connection.commit()
+                    self.ldb.commit()
             elif x["expr_type"] == 2:
                 try:
                     re.compile(x["exclude"])
@@ -449,7 +578,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
                             """, {
                                 "exclude_id"   : x["exclude_id"],
                             })
-                        self.ldb.connection.commit()
+                        self.ldb.commit()
 
         logger.info("check_exclude: finished")
 
@@ -491,6 +620,7 @@ class DbCheck(chirribackup.actions.BaseAction.BaseAction):
         self.check_db()
         self.check_snapshots()
         self.check_refs()
+        self.check_file_chunks()
         self.check_chunks()
         self.check_local_chunks()
         self.check_remote_chunks()
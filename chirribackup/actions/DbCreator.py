@@ -30,6 +30,7 @@ from chirribackup.exceptions import ChirriException
 from chirribackup.Config import CONFIG
 from chirribackup.Logger import logger
 import chirribackup.actions.BaseAction
+import chirribackup.compression
 import chirribackup.LocalDatabase
 import chirribackup.input
 import chirribackup.exclude
@@ -61,10 +62,11 @@ class DbCreator(chirribackup.actions.BaseAction.BaseAction):
         elif config["storage_type"] == "gs":
             config["storage_type"] = "GoogleStorage"
 
+        algorithms = chirribackup.compression.algorithms()
         config["compression"] = chirribackup.input.ask(
-                                    "storage compression (none, lzma)",
+                                    "storage compression (none, %s)" % ", ".join(algorithms),
                                     config["compression"],
-                                    "^(none|lzma)$")
+                                    "^(%s)$" % "|".join([ "none" ] + algorithms))
         if config["compression"] == "none":
             config["compression"] = None
 
@@ -118,7 +120,7 @@ class DbCreator(chirribackup.actions.BaseAction.BaseAction):
                             storage_type = config["storage_type"])
             for k,v in config.items():
                 setattr(self.ldb, k, v)
-            self.ldb.connection.commit()
+            self.ldb.commit()
             logger.info("Database created succesfully.")
         else:
             logger.error("Database already exists.")
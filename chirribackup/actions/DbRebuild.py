@@ -24,6 +24,7 @@
 # 
 ###############################################################################
 
+import os
 import re
 import sys
 import time
@@ -73,7 +74,7 @@ class DbRebuild(chirribackup.actions.DbCreator.DbCreator):
 
     def status_0_remote_file_listing(self):
         logger.debug("status_0_remote_file_listing")
-        snapshot_file_re = re.compile("^snapshots/snapshot-([1-9][0-9]*)\\.txt(\\.([a-zA-Z0-9_]+))?$")
+        snapshot_file_re = re.compile("^snapshots/snapshot-([1-9][0-9]*)\\.(txt|bin)(\\.([a-zA-Z0-9_]+))?$")
         chunk_file_re = re.compile("^chunks/([^/]+)$")
         for f in self.sm.get_listing():
             m = snapshot_file_re.search(f["name"])
@@ -81,7 +82,8 @@ class DbRebuild(chirribackup.actions.DbCreator.DbCreator):
                 snapshot_id = int(m.group(1))
                 snp = chirribackup.snapshot.Snapshot(self.ldb)
                 snp.new(snapshot_id = snapshot_id)
-                snp.set_attribute("compression", m.group(3))
+                snp.set_attribute("compression", m.group(4))
+                snp.set_attribute("desc_format", "bin" if m.group(2) == "bin" else None)
                 if snapshot_id > self.ldb.last_snapshot_id:
                     self.ldb.last_snapshot_id = snapshot_id
                 snp.set_status(-1, False)
@@ -108,7 +110,7 @@ class DbRebuild(chirribackup.actions.DbCreator.DbCreator):
 
         # commit -- now it is a good commit point
         self.ldb.status = 1
-        self.ldb.connection.commit()
+        self.ldb.commit()
 
 
     def status_1_download_snapshots(self):
@@ -116,20 +118,39 @@ class DbRebuild(chirribackup.actions.DbCreator.DbCreator):
         for snp in self.ldb.snapshot_list():
             if snp.status == -1:
                 logger.debug("  [%s] Downloading snapshot" % snp.get_filename())
-                data = self.sm.download_data("snapshots/%s" % snp.get_filename())
-
-                if snp.compression is not None:
-                    c = chirribackup.compression.Decompressor(self.ldb.compression)
-                    data = c.decompress(data)
-                    data += c.close()
-                snp.desc_load(data)
+                # description is decompressed to a temporary file while
+                # downloaded, and then it is parsed line by line
+                desc_file = os.path.join(self.ldb.chunks_dir, "snapshot-%d.tmp" % snp.snapshot_id)
+                try:
+                    c = chirribackup.compression.Decompressor(snp.compression, desc_file)
+                    try:
+                        self.sm.download_stream("snapshots/%s" % snp.get_filename(), c)
+                    finally:
+                        c.close()
+                    with open(desc_file, "rb") as f:
+                        snp.desc_load(f)
+                finally:
+                    if os.path.exists(desc_file):
+                        os.unlink(desc_file)
                 snp.set_status(5, False)
             else:
                 logger.debug("  [%s] (status %d)" % (snp.get_filename(), snp.status))
 
+        # files split in content defined chunks reference their parts through
+        # a manifest chunk -- download manifests and register their parts
+        for r in self.ldb.connection.execute(
+                    """
+                        SELECT DISTINCT substr(hash, 9) AS hash
+                        FROM file_ref
+                        WHERE hash LIKE 'chunked:%'
+                    """).fetchall():
+            c = chirribackup.chunk.Chunk(self.ldb, r["hash"])
+            logger.debug("  [%s] Loading manifest" % c.hash_format())
+            c.manifest_fetch(self.sm)
+
         # commit -- now it is a good commit point
         self.ldb.status = 2
-        self.ldb.connection.commit()
+        self.ldb.commit()
 
 
     def status_2_select_target_snapshot(self):
@@ -170,7 +191,7 @@ class DbRebuild(chirribackup.actions.DbCreator.DbCreator):
 
         # commit -- now it is a good commit point
         self.ldb.status = 3
-        self.ldb.connection.commit()
+        self.ldb.commit()
 
 
     def do_magic_recover(self):
@@ -190,7 +211,7 @@ class DbRebuild(chirribackup.actions.DbCreator.DbCreator):
 
         # everything finished -- go to normal operations state
         self.ldb.status = 100
-        self.ldb.connection.commit()
+        self.ldb.commit()
 
 
     def parse_args(self, argv):
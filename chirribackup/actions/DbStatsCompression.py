@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# chirribackup/actions/DbStatsCompression.py
+#
+#   Print compression statistics
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+# 
+###############################################################################
+
+from chirribackup.exceptions import ChirriException
+from chirribackup.Config import CONFIG
+from chirribackup.Logger import logger
+from chirribackup.StringFormat import format_num_bytes
+import chirribackup.actions.BaseAction
+import chirribackup.LocalDatabase
+import sys
+
+class DbStatsCompression(chirribackup.actions.BaseAction.BaseAction):
+
+    help = {
+        "synopsis": "Prints compression statistics",
+        "description": [
+            "Prints the compression ratio and throughput observed for each",
+            "algorithm, file extension and chunk size, and the estimated",
+            "volume of the next sync.",
+        ],
+        "args": None,
+    }
+ 
+
+    def parse_args(self, argv):
+        return {}
+
+
+    def go(self):
+        self.ldb = chirribackup.LocalDatabase.LocalDatabase(CONFIG.path)
+        counters = self.ldb.counters()
+
+        print "algorithm ext        chunk size   chunks        size       csize  ratio       MB/s"
+        print "--------- ---------- ---------- -------- ----------- ----------- ------ ----------"
+        for h in self.ldb.compression_history():
+            print "%-9s %-10s %10s %8d %11s %11s %6.2f %10s" \
+                % (h["compression"],
+                   h["ext"] if h["ext"] != "" else "-",
+                   "< %s" % format_num_bytes(2 ** h["bucket"]).replace(" ", ""),
+                   h["chunks"],
+                   format_num_bytes(h["size"]),
+                   format_num_bytes(h["csize"]),
+                   float(h["csize"]) / float(h["size"]) if h["size"] > 0 else 1.0,
+                   "%.2f" % (h["size"] / h["seconds"] / (1024.0 * 1024.0)) \
+                        if h["seconds"] > 0 else "-")
+
+        print ""
+        print "Pending sync:"
+        print "  - %d chunks (%s) not uploaded" % (
+                        counters["chunks_not_uploaded"],
+                        format_num_bytes(counters["chunks_bytes_pending_upload"]))
+        print "  - %s estimated upload size" % \
+                        format_num_bytes(counters["chunks_bytes_pending_upload_estimated"])
+
@@ -78,9 +78,7 @@ class DbStatus(chirribackup.actions.BaseAction.BaseAction):
                         )
             print "      - %s pending upload (estimated size %s)" % (
                             format_num_bytes(counters["chunks_bytes_pending_upload"]),
-                            format_num_bytes(
-                                counters["chunks_bytes_pending_upload"] \
-                                * counters["compression_ratio"]))
+                            format_num_bytes(counters["chunks_bytes_pending_upload_estimated"]))
         print "  - %d snapshots in database" % (counters["snapshots"])
 
         if counters["snapshots"] > 0:
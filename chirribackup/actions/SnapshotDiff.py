@@ -62,6 +62,36 @@ class SnapshotDiff(chirribackup.actions.BaseAction.BaseAction):
                     r["mtime"])
 
 
+    def path_key(self, r):
+        # refs are sorted by sqlite comparing UTF-8 strings
+        p = r["path"]
+        return p.encode("utf-8") if isinstance(p, unicode) else p
+
+
+    def diff(self, a, b):
+        """generator yielding the differences between snapshots 'a' and 'b'.
+           Refs of both snapshots are merged walking them sorted by path, so
+           they are not kept in memory"""
+        columns = [ "size", "perm", "uid", "gid", "mtime" ]
+        ia = a.refs(columns = columns)
+        ib = b.refs(columns = columns)
+        ra = next(ia, None)
+        rb = next(ib, None)
+        while ra is not None or rb is not None:
+            if rb is None \
+            or (ra is not None and self.path_key(ra) < self.path_key(rb)):
+                yield { "where" : 1, "a" : ra }
+                ra = next(ia, None)
+            elif ra is None or self.path_key(rb) < self.path_key(ra):
+                yield { "where" : 2, "b" : rb }
+                rb = next(ib, None)
+            else:
+                if self.k(ra) != self.k(rb):
+                    yield { "where" : 3, "a" : ra, "b" : rb }
+                ra = next(ia, None)
+                rb = next(ib, None)
+
+
     def parse_args(self, argv):
         return {
             "snapshot_a_id": int(argv.pop(0)),
@@ -81,76 +111,60 @@ class SnapshotDiff(chirribackup.actions.BaseAction.BaseAction):
         if b.status < 4:
             raise ChirriException("Snapshot A is not finished. At least status 4 is needed.")
 
-        # iterate references
-        d = { }
-        for n, s in { 1 : a, 2 : b }.iteritems():
-            for r in s.refs():
-                if not r["path"] in d:
-                    d[r["path"]] =  { "where" : 0, "a_k" : "", "b_k" : "" }
-                d[r["path"]]["a" if n == 1 else "b"] = r
-                d[r["path"]]["a_k" if n == 1 else "b_k"] = self.k(r)
-                d[r["path"]]["where"] = d[r["path"]]["where"] | n
-
-        # remove dups
-        for k, p in d.items():
-            if p["where"] == 3 and p["a_k"] == p["b_k"]:
-                del d[k]
-
-        # print diff
-        if len(d) == 0:
+        # print diff's (header is printed before the first one)
+        f = [ 3, 8, 4, 4, 4, 8, 19, 40 ]
+        header = False
+        for p in self.diff(a, b):
+            if not header:
+                print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") % (
+                            "st",
+                            "content",
+                            "perm",
+                            "uid",
+                            "gid",
+                            "size",
+                            "mtime",
+                            "path")
+                l = [ ]
+                for i in f:
+                    l.append("-" * i)
+                print " ".join(l)
+                header = True
+
+            if p["where"] != 3:
+                s = "a" if p["where"] == 1 else "b"
+                print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") \
+                        % ("del" if p["where"] == 0x1 else "new",
+                           "",
+                           "%o" % p[s]["perm"],
+                           p[s]["uid"],
+                           p[s]["gid"],
+                           p[s]["size"],
+                           time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(p[s]["mtime"])) \
+                               if p[s]["mtime"] is not None else None,
+                           p[s]["path"])
+            else:
+                print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") \
+                        % ("chg",
+                           "",
+                           "%o" % p["a"]["perm"],
+                           p["a"]["uid"],
+                           p["a"]["gid"],
+                           p["a"]["size"],
+                           time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(p["a"]["mtime"])) \
+                               if p["a"]["mtime"] is not None else None,
+                           p["a"]["path"])
+                print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") \
+                        % ("...",
+                           "yes" if p["a"]["hash"] != p["b"]["hash"] else "",
+                           "%o" % p["b"]["perm"] if p["a"]["perm"] != p["b"]["perm"] else "\"",
+                           p["b"]["uid"]         if p["a"]["uid"]  != p["b"]["uid"]  else "\"",
+                           p["b"]["gid"]         if p["a"]["gid"]  != p["b"]["gid"]  else "\"",
+                           p["b"]["size"]        if p["a"]["size"] != p["b"]["size"] else "\"",
+                           (time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(p["b"]["mtime"])) \
+                               if p["b"]["mtime"] is not None else None) \
+                                if p["a"]["mtime"] != p["b"]["mtime"] else "\"",
+                           p["a"]["path"])
+
+        if not header:
             print "No differences."
-        else:
-            # print header
-            f = [ 3, 8, 4, 4, 4, 8, 19, 40 ]
-            print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") % (
-                        "st",
-                        "content",
-                        "perm",
-                        "uid",
-                        "gid",
-                        "size",
-                        "mtime",
-                        "path")
-            l = [ ]
-            for i in f:
-                l.append("-" * i)
-            print " ".join(l)
-
-            # print diff's
-            for k, p in d.iteritems():
-                if p["where"] != 3:
-                    s = "a" if p["where"] == 1 else "b"
-                    print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") \
-                            % ("del" if p["where"] == 0x1 else "new",
-                               "",
-                               "%o" % p[s]["perm"],
-                               p[s]["uid"],
-                               p[s]["gid"],
-                               p[s]["size"],
-                               time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(p[s]["mtime"])) \
-                                   if p[s]["mtime"] is not None else None,
-                               p[s]["path"])
-                else:
-                    print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") \
-                            % ("chg",
-                               "",
-                               "%o" % p["a"]["perm"],
-                               p["a"]["uid"],
-                               p["a"]["gid"],
-                               p["a"]["size"],
-                               time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(p["a"]["mtime"])) \
-                                   if p["a"]["mtime"] is not None else None,
-                               p["a"]["path"])
-                    print ("%" + ("s %".join("-{0}".format(n) for n in f)) + "s") \
-                            % ("...",
-                               "yes" if p["a"]["hash"] != p["b"]["hash"] else "",
-                               "%o" % p["b"]["perm"] if p["a"]["perm"] != p["b"]["perm"] else "\"",
-                               p["b"]["uid"]         if p["a"]["uid"]  != p["b"]["uid"]  else "\"",
-                               p["b"]["gid"]         if p["a"]["gid"]  != p["b"]["gid"]  else "\"",
-                               p["b"]["size"]        if p["a"]["size"] != p["b"]["size"] else "\"",
-                               (time.strftime("%d/%m/%Y %H:%M:%S", time.localtime(p["b"]["mtime"])) \
-                                   if p["b"]["mtime"] is not None else None) \
-                                    if p["a"]["mtime"] != p["b"]["mtime"] else "\"",
-                               p["a"]["path"])
-
-
@@ -66,6 +66,6 @@ class SnapshotPrint(chirribackup.actions.BaseAction.BaseAction):
     def go(self, snapshot_id, output_format = "txt"):
         self.ldb = chirribackup.LocalDatabase.LocalDatabase(CONFIG.path)
         snp = chirribackup.snapshot.Snapshot(self.ldb).load(snapshot_id)
-        print snp.desc_print(output_format)
+        snp.desc_write(sys.stdout, output_format)
 
 
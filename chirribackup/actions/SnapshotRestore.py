@@ -50,6 +50,13 @@ class SnapshotRestore(chirribackup.actions.BaseAction.BaseAction):
                 "If this flag is present, data found in {target_dir} will",
                 "be overwritten."
             ],
+            [ "?copy|hardlink|reflink",
+                "How files with the same contents are restored. By default",
+                "they are reflinked (on filesystems supporting it, like",
+                "btrfs or xfs) or copied by the kernel. 'copy' disables",
+                "reflinks, 'hardlink' makes hardlinks between files with",
+                "the same attributes."
+            ],
         ]
     }
 
@@ -58,19 +65,21 @@ class SnapshotRestore(chirribackup.actions.BaseAction.BaseAction):
         r = {}
         r["snapshot_id"] = int(argv.pop(0))
         r["target_dir"] = argv.pop(0)
-        if len(argv) > 0:
+        while len(argv) > 0:
             p = argv.pop(0)
             if p == "overwrite":
                 r["overwrite"] = True
+            elif p in [ "copy", "hardlink", "reflink" ]:
+                r["link_mode"] = p
             else:
                 raise UnknownParameterException("Unknown parameter '%s'." % p)
         return r
 
 
-    def go(self, snapshot_id, target_dir, overwrite = False):
+    def go(self, snapshot_id, target_dir, overwrite = False, link_mode = "auto"):
         self.ldb = chirribackup.LocalDatabase.LocalDatabase(CONFIG.path)
         chirribackup.snapshot.Snapshot(self.ldb) \
                 .load(snapshot_id) \
-                .restore(self.ldb.get_storage_manager(), target_dir, overwrite)
+                .restore(self.ldb.get_storage_manager(), target_dir, overwrite, link_mode)
 
 
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# chirribackup/bindesc.py
+#
+#   Binary snapshot description format. It is a compact alternative to the
+#   CSV and JSON descriptions (see Snapshot.desc_write):
+#
+#     magic ("CHIRRIBD"), version (uvarint)
+#     details: snapshot, started, finished and signed tstamps (nint)
+#     hash table: count (uvarint), and one entry per distinct file_ref hash
+#       (kind byte, and the raw 64 bytes digest for contents or a string
+#       for symlinks)
+#     refs: count (uvarint), and one entry per file_ref sorted by path
+#       path (front coded: bytes shared with previous path and suffix),
+#       hash (index in the hash table), flags (perm, uid, gid and status
+#       equal to the previous ref), size (nint), mtime (delta from previous
+#       mtime), and perm, uid, gid and status (nint, if changed)
+#     sha512 digest (64 bytes) of all the previous bytes
+#
+#   uvarint are unsigned LEB128 integers; nint are nullable signed integers
+#   (0 is None, else 1 + zigzag encoded value).
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import binascii
+import hashlib
+
+import chirribackup.crypto
+from chirribackup.exceptions import BadSnapshotDescException
+
+# CONSTANTS
+MAGIC = "CHIRRIBD"
+VERSION = 1
+DIGEST_SIZE = 64
+READ_BLOCKSIZE = (1024*1024)
+
+# hash table entry kinds
+HASH_NONE    = 0
+HASH_REGFILE = 1
+HASH_CHUNKED = 2
+HASH_DIR     = 3
+HASH_LOST    = 4
+HASH_SYMLINK = 5
+HASH_OTHER   = 6
+
+# ref flags
+SAME_PERM   = 0x01
+SAME_UID    = 0x02
+SAME_GID    = 0x04
+SAME_STATUS = 0x08
+
+
+def is_bindesc(ifile):
+    """checks (without consuming it) if 'ifile' contains a binary
+       description"""
+    pos = ifile.tell()
+    magic = ifile.read(len(MAGIC))
+    ifile.seek(pos)
+    return magic == MAGIC
+
+
+def uvarint(v):
+    if v < 0x80:
+        return chr(v)
+    b = bytearray()
+    while v >= 0x80:
+        b.append((v & 0x7f) | 0x80)
+        v >>= 7
+    b.append(v)
+    return str(b)
+
+
+def nint(v):
+    if v is None:
+        return "\x00"
+    return uvarint(1 + (v * 2 if v >= 0 else -v * 2 - 1))
+
+
+def string(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return uvarint(len(s)) + s
+
+
+class BinDescWriter(object):
+    """writes a binary description in the file-like object 'ofile'"""
+
+    ofile  = None
+    hasher = None
+    buf    = None
+    prev   = None
+
+    def __init__(self, ofile):
+        self.ofile = ofile
+        self.hasher = hashlib.sha512()
+        self.buf = []
+        self.prev = {
+            "path"   : "",
+            "mtime"  : 0,
+            "perm"   : None,
+            "uid"    : None,
+            "gid"    : None,
+            "status" : None,
+        }
+        self.write(MAGIC + uvarint(VERSION))
+
+
+    def write(self, data):
+        self.buf.append(data)
+        if len(self.buf) >= 1024:
+            self.flush()
+
+
+    def flush(self):
+        data = "".join(self.buf)
+        self.buf = []
+        self.hasher.update(data)
+        self.ofile.write(data)
+
+
+    def write_details(self, snapshot, started_tstamp, finished_tstamp, signed_tstamp):
+        self.write(nint(snapshot) + nint(started_tstamp) \
+                    + nint(finished_tstamp) + nint(signed_tstamp))
+
+
+    def write_hashes(self, count, hashes):
+        """writes the hash table -- 'hashes' must yield 'count' file_ref
+           hashes (the index of each one is its position)"""
+        self.write(uvarint(count))
+        n = 0
+        for h in hashes:
+            if h is None:
+                self.write(chr(HASH_NONE))
+            elif h == "dir":
+                self.write(chr(HASH_DIR))
+            elif h == "lost":
+                self.write(chr(HASH_LOST))
+            elif h.startswith("symlink:"):
+                self.write(chr(HASH_SYMLINK) + string(h[len("symlink:"):]))
+            elif h.startswith("chunked:") \
+            and chirribackup.crypto.ChirriHasher.hash_check(h[len("chunked:"):]):
+                self.write(chr(HASH_CHUNKED) + binascii.unhexlify(h[len("chunked:"):]))
+            elif chirribackup.crypto.ChirriHasher.hash_check(h):
+                self.write(chr(HASH_REGFILE) + binascii.unhexlify(h))
+            else:
+                self.write(chr(HASH_OTHER) + string(h))
+            n += 1
+        if n != count:
+            raise BadSnapshotDescException("Expected %d hashes, but %d written." % (count, n))
+
+
+    def write_refs(self, count, refs):
+        """writes the refs -- 'refs' must yield 'count' refs sorted by path,
+           with the index of their hash (in the hash table) in 'hash_index'"""
+        self.write(uvarint(count))
+        n = 0
+        prev = self.prev
+        for r in refs:
+            # length of the common prefix (binary search)
+            path = r["path"].encode("utf-8") if isinstance(r["path"], unicode) else r["path"]
+            prefix = 0
+            hi = min(len(path), len(prev["path"]))
+            while prefix < hi:
+                mid = (prefix + hi + 1) / 2
+                if path[:mid] == prev["path"][:mid]:
+                    prefix = mid
+                else:
+                    hi = mid - 1
+            prev["path"] = path
+
+            flags = 0
+            rest = ""
+            for f, flag in [ ("perm",   SAME_PERM),
+                             ("uid",    SAME_UID),
+                             ("gid",    SAME_GID),
+                             ("status", SAME_STATUS) ]:
+                if r[f] == prev[f]:
+                    flags |= flag
+                else:
+                    rest += nint(r[f])
+                    prev[f] = r[f]
+
+            if r["mtime"] is None:
+                mtime = "\x00"
+            else:
+                mtime = nint(r["mtime"] - prev["mtime"])
+                prev["mtime"] = r["mtime"]
+
+            self.write(uvarint(prefix) + string(path[prefix:]) \
+                        + uvarint(r["hash_index"]) + chr(flags) \
+                        + nint(r["size"]) + mtime + rest)
+            n += 1
+        if n != count:
+            raise BadSnapshotDescException("Expected %d refs, but %d written." % (count, n))
+
+
+    def close(self):
+        self.flush()
+        self.ofile.write(self.hasher.digest())
+
+
+class BinDescReader(object):
+    """reads a binary description from the file-like object 'ifile'. The
+       digest is checked after reading the last ref (refs())"""
+
+    ifile   = None
+    hasher  = None
+    buf     = None
+    pos     = None
+    details = None
+    hashes  = None
+
+    def __init__(self, ifile):
+        self.ifile = ifile
+        self.hasher = hashlib.sha512()
+        self.buf = ""
+        self.pos = 0
+
+        # header
+        if self.read(len(MAGIC)) != MAGIC:
+            raise BadSnapshotDescException("Bad binary description header.")
+        version = self.uvarint()
+        if version != VERSION:
+            raise BadSnapshotDescException("Unsupported binary description version %d." % version)
+
+        # details
+        self.details = {
+            "format"          : "bin",
+            "snapshot"        : self.nint(),
+            "started_tstamp"  : self.nint(),
+            "finished_tstamp" : self.nint(),
+            "signed_tstamp"   : self.nint(),
+        }
+
+        # hash table
+        self.hashes = []
+        for i in xrange(0, self.uvarint()):
+            kind = ord(self.read(1))
+            if kind == HASH_NONE:
+                self.hashes.append(None)
+            elif kind == HASH_REGFILE:
+                self.hashes.append(binascii.hexlify(self.read(DIGEST_SIZE)))
+            elif kind == HASH_CHUNKED:
+                self.hashes.append("chunked:" + binascii.hexlify(self.read(DIGEST_SIZE)))
+            elif kind == HASH_DIR:
+                self.hashes.append("dir")
+            elif kind == HASH_LOST:
+                self.hashes.append("lost")
+            elif kind == HASH_SYMLINK:
+                self.hashes.append("symlink:" + self.string())
+            elif kind == HASH_OTHER:
+                self.hashes.append(self.string())
+            else:
+                raise BadSnapshotDescException("Unknown hash kind %d." % kind)
+
+
+    def fill(self, n):
+        """makes sure that 'n' bytes are buffered (if they exist)"""
+        if len(self.buf) - self.pos >= n:
+            return
+        self.hasher.update(self.buf[:self.pos])
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        while len(self.buf) < n:
+            data = self.ifile.read(max(READ_BLOCKSIZE, n))
+            if len(data) == 0:
+                break
+            self.buf += data
+
+
+    def read(self, n):
+        if len(self.buf) - self.pos < n:
+            self.fill(n)
+        if len(self.buf) - self.pos < n:
+            raise BadSnapshotDescException("Binary description finished abruptly.")
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+
+    def uvarint(self):
+        if len(self.buf) - self.pos < 10:
+            self.fill(10)
+        buf = self.buf
+        pos = self.pos
+        if pos < len(buf) and buf[pos] < "\x80":
+            self.pos = pos + 1
+            return ord(buf[pos])
+        v = 0
+        shift = 0
+        try:
+            while True:
+                b = ord(buf[pos])
+                pos += 1
+                v |= (b & 0x7f) << shift
+                if b < 0x80:
+                    break
+                shift += 7
+        except IndexError:
+            raise BadSnapshotDescException("Binary description finished abruptly.")
+        self.pos = pos
+        return v
+
+
+    def nint(self):
+        v = self.uvarint()
+        if v == 0:
+            return None
+        v -= 1
+        return (v >> 1) if (v & 1) == 0 else -((v + 1) >> 1)
+
+
+    def string(self):
+        return self.read(self.uvarint())
+
+
+    def refs(self):
+        """generator yielding the refs as dicts (paths are byte strings, as
+           stored by the writer)"""
+        path = ""
+        mtime = 0
+        prev = {
+            "perm"   : None,
+            "uid"    : None,
+            "gid"    : None,
+            "status" : None,
+        }
+        for i in xrange(0, self.uvarint()):
+            prefix = self.uvarint()
+            path = path[:prefix] + self.string()
+            h = self.hashes[self.uvarint()]
+            flags = ord(self.read(1))
+            size = self.nint()
+            d = self.nint()
+            if d is not None:
+                mtime += d
+            for f, flag in [ ("perm",   SAME_PERM),
+                             ("uid",    SAME_UID),
+                             ("gid",    SAME_GID),
+                             ("status", SAME_STATUS) ]:
+                if not (flags & flag):
+                    prev[f] = self.nint()
+            yield {
+                "path"   : path,
+                "hash"   : h,
+                "size"   : size,
+                "perm"   : prev["perm"],
+                "uid"    : prev["uid"],
+                "gid"    : prev["gid"],
+                "mtime"  : mtime if d is not None else None,
+                "status" : prev["status"],
+            }
+
+        # check digest
+        self.hasher.update(self.buf[:self.pos])
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        if self.read(DIGEST_SIZE) != self.hasher.digest():
+            raise BadSnapshotDescException("Binary description digest does not match.")
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# chirribackup/cdc.py
+#
+#   Content defined chunking. Big files are split in variable size chunks
+#   using a rolling hash (FastCDC-like gear hash), so a little change in a
+#   huge file only produces a few new chunks.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import hashlib
+import re
+import struct
+
+from chirribackup.exceptions import ChirriException, BadValueException
+
+# CONSTANTS
+READ_BLOCKSIZE = (1024*1024)
+MANIFEST_VERSION = 1
+
+# Gear table. It MUST never change: chunk boundaries (and so deduplication
+# between snapshots) depend on it. It is generated from md5 instead of using
+# the 'random' module because the later is not stable between versions.
+GEAR = [ struct.unpack(">I", hashlib.md5("chirri-gear-%d" % i).digest()[0:4])[0]
+            for i in range(0, 256) ]
+
+
+class Chunker(object):
+    """Splits a stream in content defined chunks"""
+
+    min_size    = None
+    avg_size    = None
+    max_size    = None
+    mask_s      = None
+    mask_l      = None
+
+    def __init__(self, avg_size, min_size = None, max_size = None):
+        avg_size = int(avg_size)
+        if avg_size < 256:
+            raise BadValueException("CDC average chunk size %d is too small." % avg_size)
+        self.avg_size = avg_size
+        self.min_size = int(min_size) if min_size is not None else avg_size / 4
+        self.max_size = int(max_size) if max_size is not None else avg_size * 8
+        if not 0 < self.min_size <= self.avg_size <= self.max_size:
+            raise BadValueException("Bad CDC sizes (min=%d, avg=%d, max=%d)." \
+                                        % (self.min_size, self.avg_size, self.max_size))
+
+        # normalized chunking: before reaching the average size we use a
+        # harder mask (two bits more), and after it an easier one. Masks use
+        # the high bits of the fingerprint, which depend on more input bytes.
+        bits = min(max(avg_size.bit_length() - 1, 4), 28)
+        self.mask_s = ((1 << (bits + 2)) - 1) << (32 - (bits + 2))
+        self.mask_l = ((1 << (bits - 2)) - 1) << (32 - (bits - 2))
+
+
+    def find_cut(self, data, fp, i, end):
+        """scan 'data' from 'i' to 'end' -- returns (cut, fp) where cut is -1
+           if no boundary was found"""
+        gear = GEAR
+        normal = min(self.avg_size, end)
+        mask = self.mask_s
+        while i < normal:
+            fp = ((fp << 1) + gear[data[i]]) & 0xffffffff
+            i += 1
+            if not fp & mask:
+                return i, fp
+        mask = self.mask_l
+        while i < end:
+            fp = ((fp << 1) + gear[data[i]]) & 0xffffffff
+            i += 1
+            if not fp & mask:
+                return i, fp
+        return -1, fp
+
+
+    def split(self, ifile):
+        """generator that yields the chunks (strings) found in 'ifile'"""
+        buf = bytearray()
+        fp = 0
+        i = self.min_size
+        eof = False
+        while True:
+            # fill buffer
+            while not eof and len(buf) < self.max_size:
+                data = ifile.read(READ_BLOCKSIZE)
+                if len(data) == 0:
+                    eof = True
+                else:
+                    buf.extend(data)
+            if len(buf) == 0:
+                return
+
+            # search next cut (the first 'min_size' bytes are never hashed)
+            cut = -1
+            if i < len(buf):
+                cut, fp = self.find_cut(buf, fp, i, min(len(buf), self.max_size))
+            if cut < 0:
+                if len(buf) < self.max_size and not eof:
+                    i = len(buf)
+                    continue
+                cut = min(len(buf), self.max_size)
+
+            yield str(buf[0:cut])
+            del buf[0:cut]
+            fp = 0
+            i = self.min_size
+
+
+class Manifest(object):
+    """List of chunks that compose a file"""
+
+    hash  = None
+    size  = None
+    parts = None
+
+    # CONSTANTS
+    part_re = re.compile("^([a-f0-9]{128}) ([0-9]+)$")
+
+    def __init__(self):
+        self.hash = None
+        self.size = 0
+        self.parts = []
+
+
+    def append(self, hash, size):
+        self.parts.append((hash, size))
+
+
+    def dump(self):
+        if self.hash is None:
+            raise ChirriException("Cannot dump a manifest without hash.")
+        d = "chirri-cdc-manifest: %d\n" % MANIFEST_VERSION
+        d += "hash: %s\n" % self.hash
+        d += "size: %d\n" % self.size
+        d += "parts:\n"
+        d += "".join([ "%s %d\n" % (h, s) for h, s in self.parts ])
+        return d
+
+
+    @classmethod
+    def parse(cls, data):
+        m = Manifest()
+        lines = data.splitlines()
+        if len(lines) < 4 \
+        or lines[0] != "chirri-cdc-manifest: %d" % MANIFEST_VERSION \
+        or not lines[1].startswith("hash: ") \
+        or not lines[2].startswith("size: ") \
+        or lines[3] != "parts:":
+            raise ChirriException("Bad CDC manifest header.")
+        m.hash = lines[1][len("hash: "):]
+        m.size = int(lines[2][len("size: "):])
+        for l in lines[4:]:
+            p = Manifest.part_re.match(l)
+            if p is None:
+                raise ChirriException("Bad CDC manifest line '%s'." % l)
+            m.append(p.group(1), int(p.group(2)))
+        if sum([ s for h, s in m.parts ]) != m.size:
+            raise ChirriException("CDC manifest parts do not sum %d bytes." % m.size)
+        return m
+
@@ -26,10 +26,13 @@
 from __future__ import absolute_import
 
 import exceptions
+import itertools
 import os
 import re
 import sys
+import time
 
+import chirribackup.cdc
 import chirribackup.compression
 import chirribackup.crypto
 from chirribackup.Logger import logger
@@ -38,11 +41,18 @@ from chirribackup.exceptions import \
     BadValueException,              \
     ChunkBadFilenameException,      \
     ChunkBadHashException,          \
+    ChunkChangedException,          \
     ChunkNotFoundException
 
 # CONSTANTS
 READ_BLOCKSIZE = (1024*1024)
 
+# sequence used for naming staged chunks (unique between threads)
+tmp_seq = itertools.count()
+
+# sequence used for tagging the rows of each RefcountBatch
+refcount_batch_seq = itertools.count()
+
 # CHUNK CLASS
 class Chunk(object):
 
@@ -54,6 +64,11 @@ class Chunk(object):
     status        = None
     refcount      = None
     compression   = None
+    manifest      = None
+    staged_file   = None
+    staged_compression = None
+    staged_codec       = None
+    staged_advice      = None
 
     def __init__(self, ldb, hash = None):
         self.ldb = ldb
@@ -79,59 +94,88 @@ class Chunk(object):
         return self
 
 
-    def new(self, source_file):
-        # local_file (source_file in ldb.db_path)
+    def new(self, source_file, single_pass = False, compression = None, advisor = None):
+        """creates a chunk with the contents of 'source_file'. By default the
+           file is hashed first and copied only if it is a new chunk; when
+           'single_pass' is True it is hashed and copied at the same time,
+           and the copy is dropped if the chunk already exists. If
+           'compression' is given, the copy is compressed on the fly and the
+           chunk is created ready for upload (status 1). The 'advisor'
+           (a CompressionAdvisor) may decide that the file is not worth
+           compressing"""
+        self.stage(source_file, single_pass, compression, advisor)
+        return self.commit()
+
+
+    def stage(self, source_file, single_pass = False, compression = None, advisor = None):
+        """first half of new(): hashes 'source_file' (and copies it to a
+           temporary file if 'single_pass' is True). It does not touch the
+           database, so it can be called from worker threads. The staged
+           chunk MUST be registered (or discarded) calling commit()"""
         local_file = os.path.join(self.ldb.db_path, source_file)
-        tmp_file = os.path.join(self.ldb.chunks_dir, "tmp.%s" % os.getpid())
-
-        # hash target file
+        tmp_file = os.path.join(self.ldb.chunks_dir,
+                                "tmp.%d.%d" % (os.getpid(), next(tmp_seq)))
+        compressor = None
+        codec = compression
+        keys = None
         sh = chirribackup.crypto.ChirriHasher()
         try:
+            if compression is not None and advisor is not None:
+                advice = advisor.select(local_file, source_file, compression,
+                                        os.path.getsize(local_file))
+                if advice is None:
+                    codec = None
+                else:
+                    codec, keys = advice
+            if single_pass:
+                # create the file snapshot 'tmp_file'
+                compressor = chirribackup.compression.Compressor(codec, tmp_file)
             with open(local_file, 'rb') as ifile:
                 buf = ifile.read(READ_BLOCKSIZE)
                 while len(buf) > 0:
+                    if compressor is not None:
+                        compressor.compress(buf)
                     sh.update(buf)
                     buf = ifile.read(READ_BLOCKSIZE)
+                if compressor is not None:
+                    compressor.close()
 
-        except exceptions.IOError, ex:
+        except (exceptions.IOError, exceptions.OSError), ex:
+            if compressor is not None and os.path.exists(tmp_file):
+                os.unlink(tmp_file)
             raise ChirriException("Cannot hash file '%s': %s" % (source_file, ex))
 
+        if compressor is not None and codec is None \
+        and sh.nbytes != compressor.bytes_out:
+            os.unlink(tmp_file)
+            raise ChirriException(
+                    "Null compressor bytes %d do not match with hash bytes %d" \
+                        % (compressor.bytes_out, sh.nbytes))
+
         # set basic attribs
         self.hash          = sh.hash
         self.size          = sh.nbytes
-        self.csize         = None
+        self.csize         = compressor.bytes_out if compressor is not None else None
         self.first_seen_as = source_file
         self.status        = 0
         self.refcount      = 0
-        self.compression   = None
-
-        # configure target_file path
-        target_file = os.path.join(self.ldb.chunks_dir, self.get_filename())
+        self.compression   = codec if compressor is not None else None
+        self.staged_file   = tmp_file if compressor is not None else None
+        self.staged_compression = compression
+        self.staged_codec  = codec
+        self.staged_advice = (advisor, keys) if keys is not None else None
 
-        # check if this chunk exists already in local database
-        oc = self.ldb.connection.execute(
-                    "SELECT * FROM file_data WHERE hash = :hashkey",
-                    { "hashkey" : sh.hash }).fetchone()
-        if oc is not None:
-            # check the improbability
-            if sh.nbytes != oc["size"]:
-                raise ChirriException("OMG! File '%s' matches with chunk %s, but it differs in size."
-                                        % (target_file, self.hash_format()))
+        return self
 
-            # hash already processed, load and return
-            logger.debug("Chunk %s already exists for file %s" \
-                                % (self.hash_format(), source_file))
-            return self.load(sh.hash)
 
-        # if the target_file already exists (was generated, but not reg in db),
-        # delete it
-        if os.path.exists(target_file):
-            logger.warning("A local chunk '%s' was already created -- deleting it." \
-                            % self.hash_format())
-            os.unlink(target_file)
-
-        # create the file snapshot 'target_file' (without compression)
-        compressor = chirribackup.compression.Compressor(None, tmp_file)
+    def __copy(self, compression):
+        """copies (and compresses) the file of a staged chunk to a temporary
+           file, checking that it did not change since it was hashed"""
+        source_file = self.first_seen_as
+        local_file = os.path.join(self.ldb.db_path, source_file)
+        tmp_file = os.path.join(self.ldb.chunks_dir,
+                                "tmp.%d.%d" % (os.getpid(), next(tmp_seq)))
+        compressor = chirribackup.compression.Compressor(compression, tmp_file)
         sh = chirribackup.crypto.ChirriHasher()
         try:
             with open(local_file, 'rb') as ifile:
@@ -148,15 +192,249 @@ class Chunk(object):
 
         # check hash and update csize
         if sh.hash != self.hash or sh.nbytes != self.size:
+            os.unlink(tmp_file)
             raise ChunkChangedException("Chunk %s changed during snapshot" % source_file)
-        if sh.nbytes != compressor.bytes_out:
+        if compression is None and sh.nbytes != compressor.bytes_out:
+            os.unlink(tmp_file)
             raise ChirriException(
                     "Null compressor bytes %d do not match with hash bytes %d" \
                         % (compressor.bytes_out, sh.nbytes))
         self.csize = compressor.bytes_out
+        self.compression = compression
+
+        return tmp_file
+
+
+    def commit(self):
+        """second half of new(): registers a staged chunk in the database"""
+        source_file = self.first_seen_as
+        tmp_file = self.staged_file
+        self.staged_file = None
+
+        # check if this chunk exists already in local database
+        oc = self.ldb.connection.execute(
+                    "SELECT size FROM file_data WHERE hash = :hashkey",
+                    { "hashkey" : self.hash }).fetchone()
+        if oc is not None:
+            # drop the speculative copy
+            if tmp_file is not None:
+                os.unlink(tmp_file)
+
+            # check the improbability
+            if self.size != oc["size"]:
+                raise ChirriException("OMG! File '%s' matches with chunk %s, but it differs in size."
+                                        % (source_file, self.hash_format()))
+
+            # hash already processed, load and return
+            logger.debug("Chunk %s already exists for file %s" \
+                                % (self.hash_format(), source_file))
+            return self.load(self.hash)
+
+        if tmp_file is None:
+            # create the file snapshot 'tmp_file'
+            tmp_file = self.__copy(self.staged_codec)
+
+        if self.staged_compression is not None:
+            # compressed on the fly => chunk is ready for upload (unless
+            # compression did not work, then it is stored uncompressed)
+            if self.compression is not None and self.staged_advice is not None:
+                advisor, keys = self.staged_advice
+                advisor.record(self.compression, keys, self.size, self.csize)
+            if self.compression is not None and self.csize >= self.size:
+                logger.debug("Storing '%s' uncompressed (uncompressed=%d <= %s=%d)" \
+                            % (self.hash_format(),
+                               self.size,
+                               self.compression, self.csize))
+                os.unlink(tmp_file)
+                tmp_file = self.__copy(None)
+            self.status = 1
+
+        # if the target_file already exists (was generated, but not reg in db),
+        # delete it
+        target_file = os.path.join(self.ldb.chunks_dir, self.get_filename())
+        if os.path.exists(target_file):
+            logger.warning("A local chunk '%s' was already created -- deleting it." \
+                            % self.hash_format())
+            os.unlink(target_file)
 
         # commit target_file and register chunk in database
         os.rename(tmp_file, target_file)
+        self.__insert()
+
+        return self
+
+
+    def discard(self):
+        """forgets a staged chunk that will not be committed"""
+        if self.staged_file is not None:
+            if os.path.exists(self.staged_file):
+                os.unlink(self.staged_file)
+            self.staged_file = None
+
+
+    def new_data(self, data, first_seen_as, compression = None):
+        """creates a chunk with the contents of the string 'data' (see
+           new() for 'compression')"""
+        sh = chirribackup.crypto.ChirriHasher()
+        sh.update(data)
+
+        # set basic attribs
+        self.hash          = sh.hash
+        self.size          = sh.nbytes
+        self.csize         = sh.nbytes
+        self.first_seen_as = first_seen_as
+        self.status        = 0 if compression is None else 1
+        self.refcount      = 0
+        self.compression   = None
+
+        # check if this chunk exists already in local database
+        oc = self.ldb.connection.execute(
+                    "SELECT size FROM file_data WHERE hash = :hashkey",
+                    { "hashkey" : sh.hash }).fetchone()
+        if oc is not None:
+            if sh.nbytes != oc["size"]:
+                raise ChirriException("OMG! Data of '%s' matches with chunk %s, but it differs in size."
+                                        % (first_seen_as, self.hash_format()))
+            return self.load(sh.hash)
+
+        # compress it (if it is worth)
+        if compression is not None:
+            c = chirribackup.compression.Compressor(compression)
+            zdata = c.compress(data)
+            zdata += c.close()
+            if len(zdata) < len(data):
+                data = zdata
+                self.csize = len(zdata)
+                self.compression = compression
+
+        # write chunk
+        target_file = os.path.join(self.ldb.chunks_dir, self.get_filename())
+        tmp_file = os.path.join(self.ldb.chunks_dir,
+                                "tmp.%d.%d" % (os.getpid(), next(tmp_seq)))
+        if os.path.exists(target_file):
+            logger.warning("A local chunk '%s' was already created -- deleting it." \
+                            % self.hash_format())
+            os.unlink(target_file)
+        try:
+            with open(tmp_file, 'wb') as ofile:
+                ofile.write(data)
+        except exceptions.IOError, ex:
+            os.unlink(tmp_file)
+            raise ChirriException("Cannot write chunk %s: %s" % (self.hash_format(), ex))
+        os.rename(tmp_file, target_file)
+        self.__insert()
+
+        return self
+
+
+    def new_chunked(self, source_file, avg_size, compression = None, advisor = None):
+        """splits 'source_file' in content defined chunks. This chunk becomes
+           the manifest listing the file parts (see new() for 'compression'
+           and 'advisor')"""
+        local_file = os.path.join(self.ldb.db_path, source_file)
+        chunker = chirribackup.cdc.Chunker(avg_size)
+        manifest = chirribackup.cdc.Manifest()
+        sh = chirribackup.crypto.ChirriHasher()
+        keys = None
+        csize = 0
+        try:
+            if compression is not None and advisor is not None:
+                advice = advisor.select(local_file, source_file, compression,
+                                        os.path.getsize(local_file))
+                if advice is None:
+                    # parts will be stored uncompressed (status 0)
+                    compression = None
+                else:
+                    compression, keys = advice
+            with open(local_file, 'rb') as ifile:
+                for data in chunker.split(ifile):
+                    sh.update(data)
+                    part = Chunk(self.ldb).new_data(data, source_file, compression)
+                    manifest.append(part.hash, part.size)
+                    csize += part.csize
+
+        except (exceptions.IOError, exceptions.OSError), ex:
+            raise ChirriException("Cannot chunk file '%s': %s" % (source_file, ex))
+
+        if keys is not None:
+            advisor.record(compression, keys, sh.nbytes, csize)
+
+        manifest.hash = sh.hash
+        manifest.size = sh.nbytes
+        logger.debug("File %s split in %d parts" % (source_file, len(manifest.parts)))
+
+        # store manifest and register its parts (only first time)
+        self.new_data(manifest.dump(), source_file, compression)
+        self.manifest_register(manifest)
+        self.manifest = manifest
+
+        return self
+
+
+    def manifest_register(self, manifest):
+        """register the parts of this manifest chunk -- each part gets a
+           reference from this manifest"""
+        if self.ldb.connection.execute(
+                    "SELECT COUNT(*) FROM file_chunks WHERE hash = :hash",
+                    { "hash" : self.hash }).fetchone()[0] > 0:
+            return False
+
+        refcounts = RefcountBatch(self.ldb)
+        rows = []
+        for h, size in manifest.parts:
+            rows.append({
+                    "hash" : self.hash,
+                    "seq"  : len(rows),
+                    "part" : h,
+                    "size" : size,
+                })
+            refcounts.inc(h)
+        self.ldb.connection.executemany(
+                """
+                    INSERT INTO file_chunks (hash, seq, part, size)
+                        VALUES (:hash, :seq, :part, :size)
+                """, rows)
+        missing = refcounts.flush()
+        if len(missing) > 0:
+            raise ChirriException("Chunk %s does not exists." \
+                    % chirribackup.crypto.ChirriHasher.hash_format(missing.keys()[0]))
+        return True
+
+
+    def manifest_parts(self):
+        """returns a dict with the (loaded) Chunk objects of the parts
+           registered for this manifest chunk"""
+        parts = {}
+        for row in self.ldb.connection.execute(
+                    "SELECT part FROM file_chunks WHERE hash = :hash",
+                    { "hash" : self.hash }):
+            if row["part"] not in parts:
+                parts[row["part"]] = Chunk(self.ldb, row["part"])
+        return parts
+
+
+    def manifest_load(self, sm, tmp_file):
+        """download this manifest chunk (using the temporary file
+           'tmp_file') and return it parsed (Manifest). It does not access
+           the database"""
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+        self.download(sm, tmp_file)
+        try:
+            with open(tmp_file, 'rb') as ifile:
+                return chirribackup.cdc.Manifest.parse(ifile.read())
+        finally:
+            os.unlink(tmp_file)
+
+
+    def manifest_fetch(self, sm):
+        """download this manifest chunk and register its parts"""
+        return self.manifest_register(
+                    self.manifest_load(sm,
+                        os.path.join(self.ldb.chunks_dir, "manifest.%s" % os.getpid())))
+
+
+    def __insert(self):
         self.ldb.connection.execute(
                 """
                     INSERT INTO file_data
@@ -171,10 +449,54 @@ class Chunk(object):
                     "compression" : self.compression,
                 })
 
-        return self
+
+    def destroy(self):
+        """deletes this chunk from the database. A manifest releases the
+           parts it references: it returns the list of parts (Chunk) that
+           are not referenced anymore"""
+        released = []
+        refcounts = RefcountBatch(self.ldb)
+        refcounts.add_query(
+            """
+                SELECT part, -COUNT(*)
+                FROM file_chunks
+                WHERE hash = :hash
+                GROUP BY part
+            """, { "hash" : self.hash })
+        for h in refcounts.flush().keys():
+            logger.warning("Chunk %s (part of %s) does not exists." \
+                    % (chirribackup.crypto.ChirriHasher.hash_format(h), self.hash_format()))
+        for p in self.ldb.connection.execute(
+                    """
+                        SELECT DISTINCT part FROM file_chunks
+                            JOIN file_data ON file_data.hash = file_chunks.part
+                        WHERE file_chunks.hash = :hash
+                          AND file_data.refcount = 0
+                    """, { "hash" : self.hash }).fetchall():
+            released.append(Chunk(self.ldb, p["part"]))
+        self.ldb.connection.execute(
+                "DELETE FROM file_chunks WHERE hash = :hash",
+                { "hash" : self.hash })
+        self.ldb.connection.execute(
+                "DELETE FROM file_data WHERE hash = :hash",
+                { "hash" : self.hash })
+        return released
 
 
-    def compress(self, compression):
+    def compress(self, compression, advisor = None):
+        staged = self.compress_stage(compression, advisor)
+        if staged is None:
+            return False
+        return self.compress_commit(staged)
+
+
+    def compress_stage(self, compression, advisor = None):
+        """compresses the local chunk into a temporary file without touching
+           the database (it can be called from worker threads). Returns a
+           tuple (compression, csize, tmp_file, seconds) to be passed to
+           compress_commit() -- 'tmp_file' is None if the compressed chunk
+           was not smaller. Returns None if the chunk was not compressed at
+           all (also when 'advisor' decides that it is not worth it)"""
         # sanity checks
         if self.status != 0:
             raise ChirriException(
@@ -189,15 +511,29 @@ class Chunk(object):
                    ("Compressed with " + self.compression) \
                        if self.compression is not None else "Uncompressed",
                    "NONE" if compression is None else compression))
-            return False
+            return None
 
         # get paths
         old_chunk_file = os.path.join(self.ldb.chunks_dir, self.get_filename())
-        tmp_file = os.path.join(self.ldb.chunks_dir, "tmp.%s" % os.getpid())
+        tmp_file = os.path.join(self.ldb.chunks_dir, "tmp.%d.%d" % (os.getpid(), next(tmp_seq)))
+
+        # check if it is worth and choose the algorithm (only for
+        # uncompressed chunks)
+        keys = None
+        if advisor is not None and self.compression is None:
+            try:
+                advice = advisor.select(old_chunk_file, self.first_seen_as, compression, self.size)
+            except exceptions.IOError, ex:
+                raise ChirriException("Cannot recompress chunk %s: %s" \
+                                        % (self.hash_format(), ex))
+            if advice is None:
+                return None
+            compression, keys = advice
 
         # try compressing it using 'compression' algorithm
         # NOTE: we must decompress the existing chunk using the current
         #       compression algorithm (probably None)
+        t = time.time()
         decompressor = chirribackup.compression.Decompressor(self.compression)
         compressor = chirribackup.compression.Compressor(compression, tmp_file)
         sh = chirribackup.crypto.ChirriHasher()
@@ -235,7 +571,10 @@ class Chunk(object):
                     "Data in file '%s' does not match with chunk %s" \
                         % (sh.hash, self.hash))
 
-        # check if compression has worked
+        # learn and check if compression has worked
+        t = time.time() - t
+        if keys is not None:
+            advisor.record(compression, keys, self.size, compressor.bytes_out)
         if compressor.bytes_out >= self.csize:
             if self.csize == 0:
                 logger.warning("Found zero bytes chunk '%s'." % self.hash_format())
@@ -246,14 +585,29 @@ class Chunk(object):
                                compression, compressor.bytes_out,
                                float(compressor.bytes_out) / float(self.csize)))
             os.unlink(tmp_file)
+            return (compression, compressor.bytes_out, None, t)
+
+        logger.debug("Chunk %s compressed (%d < %d)" \
+                % (self.hash_format(), compressor.bytes_out, self.csize))
+        return (compression, compressor.bytes_out, tmp_file, t)
+
+
+    def compress_commit(self, staged):
+        """replaces the local chunk with the compressed one returned by
+           compress_stage() and updates the chunk info. The observed ratio
+           and throughput are recorded in the compression history. Returns
+           False if the chunk is left uncompressed"""
+        compression, csize, tmp_file, seconds = staged
+        self.ldb.compression_history_add(
+                compression, self.first_seen_as, self.size, csize, seconds)
+        if tmp_file is None:
             return False
+        old_chunk_file = os.path.join(self.ldb.chunks_dir, self.get_filename())
 
         # ok .. proceed to update chunk with compressed version
         # update chunk info
-        logger.debug("Chunk %s compressed (%d < %d)" \
-                % (self.hash_format(), compressor.bytes_out, self.csize))
         self.compression = compression
-        self.csize = compressor.bytes_out
+        self.csize = csize
         self.ldb.connection.execute(
             """
                 UPDATE file_data
@@ -274,13 +628,12 @@ class Chunk(object):
                             % self.hash_format())
             os.unlink(new_chunk_file)
         os.rename(tmp_file, new_chunk_file)
-        self.ldb.connection.commit()
-        os.unlink(old_chunk_file)
+        self.ldb.unlink_on_commit(old_chunk_file)
+        self.ldb.maybe_commit()
 
         return True
 
 
-
     def download(self, sm, target_file, overwrite = False):
         remote_chunk = "chunks/%s" % self.get_filename()
         tmp_file = target_file + ".download"
@@ -292,44 +645,79 @@ class Chunk(object):
                 raise ChirriException("Chunk file '%s' already exists." % target_file)
 
             # yep! chunk is already on disk.. decide what to do...
-            eh = chirribackup.crypto.hash_file(target_file)
-            if eh.hash != h:
+            eh = chirribackup.crypto.ChirriHasher.hash_file(target_file)
+            if eh.hash != self.hash:
                 # hashes doesn't match... it is surely an old partial chunk of
                 # a previous restore operation (cancelled), delete it from disk
-                logger.warning("Old tmp download '%s' found but corrupt. Reloading again.")
+                logger.warning("Old tmp download '%s' found but corrupt. Reloading again." \
+                                % target_file)
                 os.unlink(target_file)
             else:
                 # hashes match, so it is the file that we need -- continue as
                 # usual without downloading anything
-                logger.info("Found previous temp download '%s' with matching hash. Recycling it.")
+                logger.info("Found previous temp download '%s' with matching hash. Recycling it." \
+                                % target_file)
                 return
 
-        # ok... download raw chunk
-        sm.download_file(remote_chunk, tmp_file)
+        # download, decompress and verify the chunk in a single pass
+        writer = ChunkWriter(self, tmp_file)
+        try:
+            sm.download_stream(remote_chunk, writer)
+            writer.close()
+        except exceptions.Exception, ex:
+            writer.discard()
+            os.unlink(tmp_file)
+            if isinstance(ex, exceptions.IOError):
+                raise ChirriException("Cannot download chunk %s to '%s': %s" \
+                                        % (self.hash_format(), target_file, ex))
+            raise
+        os.rename(tmp_file, target_file)
 
-        # decompress it
-        if self.compression is None:
-            os.rename(tmp_file, target_file)
-        else:
-            try:
-                decompressor = chirribackup.compression.Decompressor(self.compression, target_file)
-                sh = chirribackup.crypto.ChirriHasher()
-                with open(tmp_file, 'rb') as ifile:
-                    buf = ifile.read(READ_BLOCKSIZE)
-                    while len(buf) > 0:
-                        sh.update(decompressor.decompress(buf))
-                        buf = ifile.read(READ_BLOCKSIZE)
-                    sh.update(decompressor.close())
 
-                if sh.hash != self.hash:
-                    raise ChirriException("Bad data recovered (%s, %s)" \
-                                            % (target_file, self.first_seen_as))
+    def download_chunked(self, sm, target_file, parts = None, manifest = None):
+        """download this manifest chunk and rebuild the file it describes.
+           If 'parts' (see manifest_parts) is given, the database is not
+           accessed, so this method can be called from a worker thread.
+           The manifest is downloaded unless it is given (see
+           manifest_load())"""
+        part_file = target_file + ".part"
+        if os.path.exists(part_file):
+            os.unlink(part_file)
 
-            except exceptions.IOError, ex:
-                os.unlink(target_file)
-                raise ChirriException("Cannot hash & copy file '%s': %s" % (source_file, ex))
-            finally:
-                os.unlink(tmp_file)
+        # fetch manifest
+        if manifest is None:
+            manifest = self.manifest_load(sm, target_file + ".manifest")
+
+        # download and concatenate parts
+        sh = chirribackup.crypto.ChirriHasher()
+        try:
+            with open(target_file, 'wb') as ofile:
+                for h, size in manifest.parts:
+                    if parts is None:
+                        Chunk(self.ldb, h).download(sm, part_file)
+                    elif h in parts:
+                        parts[h].download(sm, part_file)
+                    else:
+                        raise ChirriException("Part %s of chunk %s is not registered." \
+                                                % (h, self.hash_format()))
+                    with open(part_file, 'rb') as ifile:
+                        buf = ifile.read(READ_BLOCKSIZE)
+                        while len(buf) > 0:
+                            sh.update(buf)
+                            ofile.write(buf)
+                            buf = ifile.read(READ_BLOCKSIZE)
+                    os.unlink(part_file)
+
+        except exceptions.Exception, ex:
+            for f in [ target_file, part_file ]:
+                if os.path.exists(f):
+                    os.unlink(f)
+            raise
+
+        if sh.hash != manifest.hash or sh.nbytes != manifest.size:
+            os.unlink(target_file)
+            raise ChirriException("Bad data recovered (%s, %s)" \
+                                    % (target_file, self.first_seen_as))
 
 
     def __refcount_sum(self, value):
@@ -474,3 +862,162 @@ class Chunk(object):
         return Chunk(ldb, hash)
 
 
+
+
+# CHUNK WRITER CLASS
+class ChunkWriter(object):
+    """File-like object written by the storage managers (download_stream)
+       with the raw contents of a chunk. Data is decompressed, hashed and
+       written to the target file as it arrives, and the download is aborted
+       (raising an exception from write()) as soon as the data received does
+       not match the chunk."""
+
+    chunk        = None
+    decompressor = None
+    hasher       = None
+    nbytes       = None
+
+    def __init__(self, chunk, target_file):
+        self.chunk = chunk
+        self.decompressor = chirribackup.compression.Decompressor(chunk.compression, target_file)
+        self.hasher = chirribackup.crypto.ChirriHasher()
+        self.nbytes = 0
+
+
+    def write(self, data):
+        self.nbytes += len(data)
+        if self.chunk.csize is not None and self.nbytes > self.chunk.csize:
+            raise ChirriException("Chunk %s is bigger than expected (%d bytes)." \
+                                    % (self.chunk.hash_format(), self.chunk.csize))
+        self.hasher.update(self.decompressor.decompress(data))
+        if self.hasher.nbytes > self.chunk.size:
+            raise ChirriException("Bad data recovered (%s, %s)" \
+                                    % (self.chunk.hash_format(), self.chunk.first_seen_as))
+
+
+    def close(self):
+        self.hasher.update(self.decompressor.close())
+        if self.hasher.nbytes != self.chunk.size \
+        or self.hasher.hash != self.chunk.hash:
+            raise ChirriException("Bad data recovered (%s, %s)" \
+                                    % (self.chunk.hash_format(), self.chunk.first_seen_as))
+
+
+    def discard(self):
+        if self.decompressor.out_file is not None:
+            self.decompressor.out_file.close()
+            self.decompressor.out_file = None
+
+
+# REFCOUNT BATCH CLASS
+class RefcountBatch(object):
+    """Accumulates chunk refcount changes and applies them with a single
+       grouped UPDATE (instead of an UPDATE and a SELECT per reference).
+       Changes are stored in memory and in the temporary table
+       'refcount_delta' (created on first use), tagged with the id of
+       their batch, so several batches can be pending at once. Pending
+       changes MUST be flushed before committing."""
+
+    ldb      = None
+    batch_id = None
+    deltas   = None
+    queued   = None
+
+    def __init__(self, ldb):
+        self.ldb = ldb
+        self.batch_id = next(refcount_batch_seq)
+        self.deltas = {}
+        self.queued = False
+
+
+    def create_table(self):
+        self.ldb.connection.execute(
+            """
+                CREATE TEMP TABLE IF NOT EXISTS refcount_delta (
+                    batch   INTEGER NOT NULL,
+                    hash    TEXT NOT NULL,
+                    delta   INTEGER NOT NULL
+                )""")
+        self.ldb.connection.execute(
+            """
+                CREATE INDEX IF NOT EXISTS temp.refcount_delta_batch_hash
+                    ON refcount_delta (batch, hash)
+            """)
+
+
+    def add(self, hash, value):
+        self.deltas[hash] = self.deltas.get(hash, 0) + value
+
+
+    def inc(self, hash):
+        self.add(hash, 1)
+
+
+    def dec(self, hash):
+        self.add(hash, -1)
+
+
+    def add_query(self, select, params):
+        """adds the changes returned by the query 'select', which must return
+           two columns (hash, delta)"""
+        if not self.queued:
+            self.create_table()
+            self.queued = True
+        params = dict(params)
+        params["refcount_batch"] = self.batch_id
+        self.ldb.connection.execute(
+                "INSERT INTO refcount_delta (batch, hash, delta)"
+                " SELECT :refcount_batch, * FROM (%s)" % select,
+                params)
+
+
+    def flush(self):
+        """applies pending changes. It returns a dict with the changes of
+           the chunks that do not exist (hash => delta)"""
+        deltas = [ (self.batch_id, h, d) for h, d in self.deltas.items() if d != 0 ]
+        self.deltas = {}
+        if len(deltas) == 0 and not self.queued:
+            return {}
+        if not self.queued:
+            self.create_table()
+        self.queued = False
+        self.ldb.connection.executemany(
+                "INSERT INTO refcount_delta (batch, hash, delta) VALUES (?, ?, ?)",
+                deltas)
+
+        params = { "batch" : self.batch_id }
+        try:
+            missing = {}
+            for r in self.ldb.connection.execute(
+                        """
+                            SELECT hash, SUM(delta) AS delta
+                            FROM refcount_delta
+                            WHERE batch = :batch
+                              AND hash NOT IN (SELECT hash FROM file_data)
+                            GROUP BY hash
+                        """, params):
+                missing[r["hash"]] = r["delta"]
+
+            self.ldb.connection.execute(
+                """
+                    UPDATE file_data
+                    SET refcount = refcount
+                                   + (SELECT SUM(delta) FROM refcount_delta
+                                      WHERE refcount_delta.batch = :batch
+                                        AND refcount_delta.hash = file_data.hash)
+                    WHERE hash IN (SELECT hash FROM refcount_delta WHERE batch = :batch)
+                """, params)
+            c = self.ldb.connection.execute(
+                """
+                    SELECT hash FROM file_data
+                    WHERE hash IN (SELECT hash FROM refcount_delta WHERE batch = :batch)
+                      AND refcount < 0
+                """, params).fetchone()
+        finally:
+            self.ldb.connection.execute(
+                    "DELETE FROM refcount_delta WHERE batch = :batch", params)
+        if c is not None:
+            raise ChirriException("Negative ref in chunk %s." \
+                    % chirribackup.crypto.ChirriHasher.hash_format(c["hash"]))
+
+        return missing
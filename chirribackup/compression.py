@@ -3,7 +3,10 @@
 ###############################################################################
 # chirribackup/compression.py
 #
-#   Helper compression funcs
+#   Helper compression funcs. Compression algorithms (codecs) are kept in a
+#   registry; the name of the codec is what is stored in the 'compression'
+#   column of chunks and snapshots (and in chunk file names), so chunks
+#   compressed with different codecs can coexist.
 #
 # -----------------------------------------------------------------------------
 # Chirri Backup - Cheap and ugly backup tool
@@ -26,17 +29,181 @@
 
 from chirribackup.exceptions import BadCompressionException
 from chirribackup.Logger import logger
+import bz2
 import json
+import os
+import threading
+import time
+import zlib
 
-lzma_available = False
+# optional codecs
 try:
     import lzma
-    lzma_available = True
 except ImportError, e:
-    logger.warning("lzma import not available.")
+    try:
+        from backports import lzma
+    except ImportError, e:
+        lzma = None
+try:
+    import zstandard
+except ImportError, e:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError, e:
+    lz4 = None
+
+
+class Codec(object):
+    """base class of compression algorithms. Subclasses return stream
+       objects with methods compress()/flush() and decompress() (and
+       optionally flush())"""
+
+    name    = None
+    module  = None
+    level   = None
+    threads = None
+
+    def available(self):
+        return self.module is not None
+
+    def compressobj(self, level):
+        raise BadCompressionException("This method must be overrided")
+
+    def decompressobj(self):
+        raise BadCompressionException("This method must be overrided")
+
+
+class ZlibCodec(Codec):
+
+    name   = "zlib"
+    module = zlib
+
+    def compressobj(self, level):
+        return zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION)
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+
+class Bz2Codec(Codec):
+
+    name   = "bz2"
+    module = bz2
+
+    def compressobj(self, level):
+        return bz2.BZ2Compressor(level if level is not None else 9)
+
+    def decompressobj(self):
+        return bz2.BZ2Decompressor()
+
+
+class LzmaCodec(Codec):
+
+    name   = "lzma"
+    module = lzma
+
+    def compressobj(self, level):
+        if level is None:
+            return lzma.LZMACompressor()
+        try:
+            return lzma.LZMACompressor(preset = level)
+        except TypeError, ex:
+            # pyliblzma
+            return lzma.LZMACompressor(options = { "level" : level })
+
+    def decompressobj(self):
+        return lzma.LZMADecompressor()
+
+
+class ZstdCodec(Codec):
+    """zstandard (multi-threaded when 'threads' is greater than 1)"""
+
+    name   = "zstd"
+    module = zstandard
+
+    def compressobj(self, level):
+        return zstandard.ZstdCompressor(
+                    level = level if level is not None else 3,
+                    threads = self.threads if self.threads is not None else 0).compressobj()
+
+    def decompressobj(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4Codec(Codec):
+
+    name   = "lz4"
+    module = lz4
+
+    class Compressor(object):
+        """lz4 frames need an explicit begin()"""
+
+        def __init__(self, level):
+            self.compressor = lz4.frame.LZ4FrameCompressor(
+                                    compression_level = level if level is not None else 0)
+            self.header = self.compressor.begin()
+
+        def compress(self, data):
+            data = self.header + self.compressor.compress(data)
+            self.header = ""
+            return data
+
+        def flush(self):
+            data = self.header + self.compressor.flush()
+            self.header = ""
+            return data
+
+    def compressobj(self, level):
+        return Lz4Codec.Compressor(level)
+
+    def decompressobj(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+# compression sampling (see CompressionAdvisor)
+SAMPLE_BLOCKSIZE  = 65536       # size of head, middle and tail samples
+SAMPLE_MIN_SIZE   = 1048576     # smaller chunks are not sampled
+SAMPLE_MAX_RATIO  = 0.95        # worse ratios are not worth compressing
+STATS_MIN_SAMPLES = 8           # observations needed to trust a file type
+STATS_MIN_SIZE    = 65536       # smaller files are not representative
+STATS_MAX_SAMPLES = 64          # older observations are halved past this
+STATS_RESAMPLE    = 16          # 1 of each N skipped files is sampled again
+SELECT_MAX_LOSS   = 0.05        # worse ratios accepted for a faster codec
+MAGIC_SIZE        = 4
+
+# codecs registry
+CODECS = { }
+for codec in [ ZlibCodec, Bz2Codec, LzmaCodec, ZstdCodec, Lz4Codec ]:
+    CODECS[codec.name] = codec()
+
 
 def algorithm_check(algorithm):
-    return (algorithm is None or algorithm in [ "lzma" ])
+    return (algorithm is None or algorithm in CODECS)
+
+
+def algorithms(available = True):
+    """returns the names of the known (or available) codecs"""
+    return sorted([ n for n, c in CODECS.items() if not available or c.available() ])
+
+
+def get_codec(algorithm):
+    if algorithm not in CODECS:
+        raise BadCompressionException("Uknown compression algorithm '%s'." % algorithm)
+    codec = CODECS[algorithm]
+    if not codec.available():
+        raise BadCompressionException("Compression algorithm '%s' not available." % algorithm)
+    return codec
+
+
+def configure(algorithm, level = None, threads = None):
+    """sets the default compression level and number of threads of a codec
+       (None means the codec default)"""
+    if algorithm is None or algorithm not in CODECS:
+        return
+    CODECS[algorithm].level = level
+    CODECS[algorithm].threads = threads
+
 
 class Compressor:
 
@@ -46,26 +213,23 @@ class Compressor:
     bytes_in    = None
     bytes_out   = None
 
-    def __init__(self, algorithm, target_file = None):
+    def __init__(self, algorithm, target_file = None, level = None):
         self.algorithm = algorithm
         self.bytes_in  = 0
         self.bytes_out = 0
         if self.algorithm is None:
             self.compressor = None
-        elif self.algorithm == "lzma":
-            if not lzma_available:
-                raise BadCompressionException("LZMA (xz) compressor not available.")
-            self.compressor = lzma.LZMACompressor()
         else:
-            raise BadCompressionException("Uknown compression algorithm '%s'." % self.algorithm)
+            codec = get_codec(self.algorithm)
+            self.compressor = codec.compressobj(level if level is not None else codec.level)
 
         self.out_file = open(target_file, "wb") \
                             if target_file is not None else None
 
 
     def compress(self, data):
-        self.bytes_in = len(data)
-        if self.algorithm == "lzma":
+        self.bytes_in += len(data)
+        if self.compressor is not None:
             data = self.compressor.compress(data)
         if self.out_file is not None:
             self.out_file.write(data)
@@ -73,8 +237,13 @@ class Compressor:
         return data
 
 
+    def write(self, data):
+        """file-like interface (data is only written to the target file)"""
+        self.compress(data)
+
+
     def close(self):
-        if self.algorithm == "lzma":
+        if self.compressor is not None:
             data = self.compressor.flush()
         else:
             data = ""
@@ -102,31 +271,31 @@ class Decompressor:
         self.bytes_out = 0
         if self.algorithm is None:
             self.decompressor = None
-        elif self.algorithm == "lzma":
-            if not lzma_available:
-                raise BadCompressionException("LZMA (xz) decompressor not available.")
-            self.decompressor = lzma.LZMADecompressor()
         else:
-            raise BadCompressionException("Uknown compression algorithm '%s'." % self.algorithm)
+            self.decompressor = get_codec(self.algorithm).decompressobj()
 
         self.out_file = open(target_file, "wb") \
                             if target_file is not None else None
 
 
     def decompress(self, data):
-        if self.algorithm == "lzma":
+        if self.decompressor is not None:
             data = self.decompressor.decompress(data)
         if self.out_file is not None:
             self.out_file.write(data)
         return data
 
 
+    def write(self, data):
+        """file-like interface (data is only written to the target file)"""
+        self.decompress(data)
+
+
     def close(self):
         data = ""
-        if self.algorithm == "lzma":
-            #if not self.decompressor.eof():
-            #    raise BadCompressionException("Unfinished lzma stream.")
-            data = self.decompressor.flush()
+        if self.decompressor is not None \
+        and hasattr(self.decompressor, "flush"):
+            data = self.decompressor.flush() or ""
         if self.out_file is not None:
             self.out_file.write(data)
             self.out_file.close()
@@ -135,3 +304,192 @@ class Decompressor:
         return data
 
 
+def file_ext(name):
+    """file type used in compression statistics"""
+    return os.path.splitext(name)[1].lower()
+
+
+def size_bucket(size):
+    """size class used in compression statistics: chunks in bucket 'n' have
+       between 2^(n-1) and 2^n - 1 bytes"""
+    return int(size).bit_length()
+
+
+def sample_ratio(path, algorithm, size):
+    """compresses three blocks of 'path' (head, middle and tail) and returns
+       a tuple (bytes, compressed bytes, seconds spent compressing)"""
+    total = 0
+    ctotal = 0
+    seconds = 0.0
+    with open(path, "rb") as f:
+        for pos in sorted(set([ 0,
+                                max(0, (size - SAMPLE_BLOCKSIZE) / 2),
+                                max(0, size - SAMPLE_BLOCKSIZE) ])):
+            f.seek(pos)
+            buf = f.read(SAMPLE_BLOCKSIZE)
+            t = time.time()
+            c = Compressor(algorithm)
+            ctotal += len(c.compress(buf)) + len(c.close())
+            seconds += time.time() - t
+            total += len(buf)
+    return (total, ctotal, seconds)
+
+
+class CompressionAdvisor(object):
+    """decides if a chunk is worth compressing using the ratios observed for
+       files of the same type (same extension or magic number), or
+       compressing a sample of it. It also chooses the codec used for each
+       chunk among the 'compression_candidates' (see select()). Methods
+       select(), check() and record() can be called from worker threads;
+       flush() saves the learned ratios in the table compression_stats and
+       must be called by the database writer"""
+
+    ldb        = None
+    stats      = None
+    dirty      = None
+    skipped    = None
+    lock       = None
+    candidates = None
+
+    def __init__(self, ldb):
+        self.ldb = ldb
+        self.stats = {}
+        self.dirty = set()
+        self.skipped = {}
+        self.lock = threading.Lock()
+        self.candidates = []
+        if ldb.compression_candidates is not None:
+            for algorithm in ldb.compression_candidates.split(","):
+                algorithm = algorithm.strip()
+                if algorithm != "":
+                    get_codec(algorithm)
+                    self.candidates.append(algorithm)
+        for r in self.ldb.connection.execute("SELECT * FROM compression_stats"):
+            self.stats[(r["compression"], r["key"])] = [ r["samples"], r["size"], r["csize"] ]
+
+
+    def keys(self, name, head):
+        keys = []
+        ext = file_ext(name)
+        if ext != "":
+            keys.append("ext:%s" % ext)
+        if len(head) >= MAGIC_SIZE:
+            keys.append("magic:%s" % head[:MAGIC_SIZE].encode("hex"))
+        return keys
+
+
+    def predict(self, algorithm, keys):
+        """returns the ratio expected for a file of type 'keys', or None if
+           not enough observations were made"""
+        size = 0
+        csize = 0
+        with self.lock:
+            for key in keys:
+                s = self.stats.get((algorithm, key))
+                if s is not None and s[0] >= STATS_MIN_SAMPLES:
+                    size += s[1]
+                    csize += s[2]
+        return float(csize) / float(size) if size > 0 else None
+
+
+    def check(self, path, name, algorithm, size):
+        """returns the type keys of the file 'path' (first seen as 'name') if
+           it is worth compressing it with 'algorithm', or None otherwise"""
+        with open(path, "rb") as f:
+            head = f.read(MAGIC_SIZE)
+        keys = self.keys(name, head)
+
+        # types predicted as incompressible are sampled again from time to
+        # time, so a wrong decision (ex. learned from a few odd files) can
+        # be undone
+        ratio = self.predict(algorithm, keys)
+        resample = False
+        if ratio is not None and ratio >= SAMPLE_MAX_RATIO and size >= STATS_MIN_SIZE:
+            with self.lock:
+                n = self.skipped.get((algorithm, tuple(keys)), 0) + 1
+                self.skipped[(algorithm, tuple(keys))] = n
+            resample = n % STATS_RESAMPLE == 0
+        if (ratio is None and size >= SAMPLE_MIN_SIZE) or resample:
+            total, ctotal, seconds = sample_ratio(path, algorithm, size)
+            ratio = float(ctotal) / float(total) if total > 0 else None
+            if ratio is not None and ratio >= SAMPLE_MAX_RATIO:
+                # it will not be compressed, so learn from the sample
+                self.record(algorithm, keys, total, ctotal)
+
+        if ratio is not None and ratio >= SAMPLE_MAX_RATIO:
+            logger.debug("'%s' is not worth compressing with %s (ratio %.2f)" \
+                            % (name, algorithm, ratio))
+            return None
+        return keys
+
+
+    def select(self, path, name, algorithm, size):
+        """returns a tuple (algorithm, keys) with the algorithm chosen for
+           compressing the file 'path' (first seen as 'name') and its type
+           keys, or None if it is not worth compressing it with 'algorithm'
+           (see check()). Files big enough are sampled with 'algorithm' and
+           each one of the candidates, and the fastest algorithm whose ratio
+           is at most SELECT_MAX_LOSS worse than the best ratio is chosen"""
+        keys = self.check(path, name, algorithm, size)
+        if keys is None:
+            return None
+        algorithms = [ algorithm ] + [ a for a in self.candidates if a != algorithm ]
+        if len(algorithms) == 1 or size < SAMPLE_MIN_SIZE:
+            return (algorithm, keys)
+
+        # algorithm => (ratio, seconds)
+        samples = {}
+        for a in algorithms:
+            total, ctotal, seconds = sample_ratio(path, a, size)
+            if total > 0:
+                samples[a] = (float(ctotal) / float(total), seconds)
+        if len(samples) == 0:
+            return (algorithm, keys)
+        best = min([ s[0] for s in samples.values() ])
+        chosen = min([ a for a in algorithms
+                         if a in samples and samples[a][0] <= best + SELECT_MAX_LOSS ],
+                     key = lambda a: samples[a][1])
+        logger.debug("'%s' will be compressed with %s (%s)" \
+                        % (name, chosen,
+                           ", ".join([ "%s ratio %.2f in %.3fs" % (a, s[0], s[1])
+                                            for a, s in sorted(samples.items()) ])))
+        return (chosen, keys)
+
+
+    def record(self, algorithm, keys, size, csize):
+        """learns the ratio observed compressing a file of type 'keys'"""
+        if size < STATS_MIN_SIZE:
+            return
+        with self.lock:
+            for key in keys:
+                s = self.stats.setdefault((algorithm, key), [ 0, 0, 0 ])
+                if s[0] >= STATS_MAX_SAMPLES:
+                    # decay: recent observations weight more
+                    s[0] /= 2
+                    s[1] /= 2
+                    s[2] /= 2
+                s[0] += 1
+                s[1] += size
+                s[2] += csize
+                self.dirty.add((algorithm, key))
+
+
+    def flush(self):
+        with self.lock:
+            rows = []
+            for algorithm, key in self.dirty:
+                s = self.stats[(algorithm, key)]
+                rows.append({
+                    "compression" : algorithm,
+                    "key"         : key,
+                    "samples"     : s[0],
+                    "size"        : s[1],
+                    "csize"       : s[2],
+                })
+            self.dirty.clear()
+        self.ldb.connection.executemany(
+            """
+                INSERT OR REPLACE INTO compression_stats
+                    (compression, key, samples, size, csize)
+                    VALUES (:compression, :key, :samples, :size, :csize)
+            """, rows)
@@ -32,14 +32,14 @@ import re
 
 READ_BLOCKSIZE = (1024*1024)
 
-class ChirriHasher:
+class ChirriHasher(object):
     """alias for hashlib.sha512"""
     """This is the default hasher used by Chirri Backup"""
 
     # ATTRIBUTES
     hasher = None
-    hash   = None
     nbytes = None
+    __hash = None
 
     # CONSTANTS
     hash_re = re.compile("^[a-f0-9]{128}$")
@@ -47,13 +47,22 @@ class ChirriHasher:
     def __init__(self):
         self.hasher = hashlib.sha512()
         self.nbytes = 0
-        self.hash = self.hasher.hexdigest()
+        self.__hash = None
 
 
     def update(self, data):
         self.hasher.update(data)
         self.nbytes = self.nbytes + len(data)
-        self.hash = self.hasher.hexdigest()
+        self.__hash = None
+
+
+    @property
+    def hash(self):
+        # hexdigest() clones the hasher state, so it is calculated only on
+        # demand and cached until next update()
+        if self.__hash is None:
+            self.__hash = self.hasher.hexdigest()
+        return self.__hash
 
 
     # CLASS/OBJECT METHODS
@@ -96,6 +105,68 @@ def protect_string(string):
                     protect_header(False))
 
 
+def protect_file(ifile, ofile, hash = None):
+    """like protect_string(), but reading the content from the file 'ifile'
+       (from its current position) and writing into the file-like object
+       'ofile'. If 'hash' is not given, 'ifile' is read twice"""
+    if hash is None:
+        pos = ifile.tell()
+        hasher = ChirriHasher()
+        buf = ifile.read(READ_BLOCKSIZE)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = ifile.read(READ_BLOCKSIZE)
+        hash = hasher.hash
+        ifile.seek(pos)
+    ofile.write("%s\nHash: %s\n" % (protect_header(True), hash))
+    buf = ifile.read(READ_BLOCKSIZE)
+    while len(buf) > 0:
+        ofile.write(buf)
+        buf = ifile.read(READ_BLOCKSIZE)
+    ofile.write("\n%s\n" % protect_header(False))
+
+
+def unprotect_lines(ifile):
+    """generator yielding the lines (without end of line) of the content
+       protected (see protect_string) in the file-like object 'ifile'. The
+       hash is calculated as lines are read, and an exception is raised
+       after the last line if it does not match"""
+    lines = iter(ifile)
+    hasher = ChirriHasher()
+
+    # ignore void lines and header
+    l = None
+    for l in lines:
+        if not re.match("^\s*$", l):
+            break
+    if l is None or l.rstrip("\n") != protect_header(True):
+        raise ChirriException("Bad header.")
+
+    # fetch hash
+    h = re.compile("^Hash: ([a-z0-9]+)$").search(next(lines, "").rstrip("\n"))
+    if h is not None:
+        h = h.group(1)
+    else:
+        raise ChirriException("Hash header not found.")
+
+    # hash and yield content
+    first = True
+    for l in lines:
+        if l.endswith("\n"):
+            l = l[:-1]
+        if l == protect_header(False):
+            if h != hasher.hash:
+                raise ChirriException("Hash does not match.")
+            return
+        if not first:
+            hasher.update("\n")
+        hasher.update(l)
+        first = False
+        yield l
+
+    raise ChirriException("String finished abruptly.")
+
+
 def unprotect_string(string):
     linebuffer = string.split("\n")
     hasher = ChirriHasher()
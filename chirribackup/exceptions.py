@@ -104,6 +104,10 @@ class BadSnapshotDescException(ChirriException):
     """Bad snapshot description exception"""
 
 
+class BadSnapshotStatusException(ChirriException):
+    """Snapshot is not in the expected status"""
+
+
 class ExcludeNotFound(ChirriException):
     pass
 
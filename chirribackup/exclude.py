@@ -26,6 +26,9 @@
 # 
 ###############################################################################
 
+import fnmatch
+import re
+
 from chirribackup.exceptions import ExcludeNotFound, ChirriException
 
 
@@ -146,3 +149,272 @@ class Exclude(object):
         for x in ldb.connection.execute("SELECT exclude_id FROM excludes"):
             l.append(Exclude(ldb, x["exclude_id"]))
         return l
+
+
+class ExcludeMatcher(object):
+    """Compiled list of the enabled excludes.
+
+    All rules are combined so a path is not checked against every rule:
+      - literals are looked up in a set,
+      - wildcards without wildcard characters (ex. 'node_modules') are
+        looked up in a set with every path suffix,
+      - wildcards like '*.pyc' are looked up in a set with the path ending
+        (one lookup for each different length),
+      - anchored wildcards ('/build/*.o') are indexed by their first path
+        component,
+      - the rest of wildcards and regexes are joined in a few alternation
+        regexes (python 2 only supports 100 groups per regex). Wildcards
+        are only tried at the start of each path component and regexes
+        anchored with '^' only at the start of the path."""
+
+    # CONSTANTS
+    MAX_GROUPS = 90
+    wildcard_re = re.compile("[*?[]")
+    # regexes that cannot be joined with others (global flags, named
+    # groups, backreferences and conditionals depend on the regex alone)
+    unsafe_re = re.compile(r"\(\?[iLmsux]+\)|\\[1-9]|\(\?P[<=]|\(\?\(")
+
+    rules          = None
+    literals       = None
+    suffixes       = None
+    suffixes_ci    = None
+    endings        = None
+    endings_ci     = None
+    patterns       = None
+    anchored       = None
+    anchored_ci    = None
+    boundary_rxs   = None
+    start_rxs      = None
+    search_rxs     = None
+    stats          = None
+
+    def __init__(self, ldb = None):
+        self.rules       = 0
+        self.literals    = set()
+        self.suffixes    = set()
+        self.suffixes_ci = set()
+        self.endings     = {}
+        self.endings_ci  = {}
+        self.patterns    = {}
+        self.stats       = {
+            "checked"  : 0,
+            "literal"  : 0,
+            "suffix"   : 0,
+            "anchored" : 0,
+            "regex"    : 0,
+        }
+        if ldb is not None:
+            for x in ldb.connection.execute("SELECT * FROM excludes WHERE disabled = 0"):
+                self.add(x["exclude"], x["expr_type"], x["ignore_case"])
+
+    @classmethod
+    def is_start_anchored(cls, src):
+        """True if regex 'src' can only match at the start of the string
+           (begins with '^' and it has no '|' at top level)"""
+        if not src.startswith("^"):
+            return False
+        depth = 0
+        i = 1
+        while i < len(src):
+            c = src[i]
+            if c == "\\":
+                i += 1
+            elif c == "[":
+                # skip char class (']' just after '[' or '[^' is literal)
+                i += 1
+                if i < len(src) and src[i] == "^":
+                    i += 1
+                if i < len(src) and src[i] == "]":
+                    i += 1
+                while i < len(src) and src[i] != "]":
+                    if src[i] == "\\":
+                        i += 1
+                    i += 1
+            elif c == "(":
+                depth += 1
+            elif c == ")":
+                depth -= 1
+            elif c == "|" and depth == 0:
+                return False
+            i += 1
+        return True
+
+    def add(self, exclude, expr_type, ignore_case):
+        expr_type = Exclude.parse_expr_type(expr_type)
+        self.rules += 1
+        self.search_rxs = None
+
+        # literal => exact match
+        if expr_type == 0:
+            self.literals.add(exclude)
+            return
+
+        flags = re.IGNORECASE if ignore_case else 0
+        if expr_type == 1:
+            anchored = exclude.startswith("/")
+            if anchored:
+                exclude = exclude[1:]
+
+            # wildcard without wildcard chars => match path suffixes
+            if not anchored and not ExcludeMatcher.wildcard_re.search(exclude):
+                if ignore_case:
+                    self.suffixes_ci.add(exclude.lower())
+                else:
+                    self.suffixes.add(exclude)
+                return
+
+            # '*' + literal => match path endings ('*' also matches '/')
+            if not anchored \
+            and len(exclude) > 1 \
+            and exclude.startswith("*") \
+            and not ExcludeMatcher.wildcard_re.search(exclude[1:]):
+                ending = exclude[1:]
+                if ignore_case:
+                    ending = ending.lower()
+                    self.endings_ci.setdefault(len(ending), set()).add(ending)
+                else:
+                    self.endings.setdefault(len(ending), set()).add(ending)
+                return
+
+            # python 2 appends '\Z(?ms)' -- global flags cannot be joined
+            src = fnmatch.translate(exclude)
+            if src.endswith("(?ms)"):
+                src = src[:-len("(?ms)")]
+            flags |= re.MULTILINE | re.DOTALL
+            if anchored:
+                first = exclude.split("/", 1)[0]
+                if not ExcludeMatcher.wildcard_re.search(first):
+                    key = ("anchored", flags, first.lower() if ignore_case else first)
+                else:
+                    key = ("start", flags)
+            elif exclude.startswith("*"):
+                # a leading '*' can eat any path prefix
+                key = ("start", flags)
+            else:
+                key = ("boundary", flags)
+        else:
+            src = exclude
+            if ExcludeMatcher.unsafe_re.search(src):
+                key = ("single", flags)
+            elif ExcludeMatcher.is_start_anchored(src):
+                key = ("start", flags)
+            else:
+                key = ("regex", flags)
+
+        # check regex and get its number of groups
+        rx = re.compile(src, flags)
+        self.patterns.setdefault(key, []).append((src, rx.groups))
+
+    def compile(self):
+        """joins the rules in the minimum number of regexes"""
+        self.anchored = {}
+        self.anchored_ci = {}
+        self.boundary_rxs = []
+        self.start_rxs = []
+        self.search_rxs = []
+        for key, l in self.patterns.items():
+            flags = key[1]
+            if key[0] == "single":
+                batches = [ [ src ] for src, groups in l ]
+            else:
+                batches = [ [] ]
+                ngroups = 0
+                for src, groups in l:
+                    if ngroups + groups > ExcludeMatcher.MAX_GROUPS and len(batches[-1]) > 0:
+                        batches.append([])
+                        ngroups = 0
+                    batches[-1].append(src)
+                    ngroups += groups
+            rxs = [ re.compile("|".join([ "(?:%s)" % src for src in b ]), flags)
+                        for b in batches ]
+            if key[0] == "anchored":
+                index = self.anchored_ci if flags & re.IGNORECASE else self.anchored
+                index.setdefault(key[2], []).extend(rxs)
+            elif key[0] == "boundary":
+                self.boundary_rxs.extend(rxs)
+            elif key[0] == "start":
+                self.start_rxs.extend(rxs)
+            else:
+                self.search_rxs.extend(rxs)
+
+    def match(self, path):
+        """returns True if 'path' is excluded"""
+        if self.search_rxs is None:
+            self.compile()
+        stats = self.stats
+        stats["checked"] += 1
+
+        if path in self.literals:
+            stats["literal"] += 1
+            return True
+
+        # start of each path component
+        boundaries = [ 0 ]
+        i = path.find("/")
+        while i >= 0:
+            boundaries.append(i + 1)
+            i = path.find("/", i + 1)
+
+        if len(self.suffixes) > 0:
+            for i in boundaries:
+                if path[i:] in self.suffixes:
+                    stats["suffix"] += 1
+                    return True
+        if len(self.suffixes_ci) > 0:
+            lpath = path.lower()
+            for i in boundaries:
+                if lpath[i:] in self.suffixes_ci:
+                    stats["suffix"] += 1
+                    return True
+
+        for l, endings in self.endings.items():
+            if path[-l:] in endings:
+                stats["suffix"] += 1
+                return True
+        if len(self.endings_ci) > 0:
+            lpath = path.lower()
+            for l, endings in self.endings_ci.items():
+                if lpath[-l:] in endings:
+                    stats["suffix"] += 1
+                    return True
+
+        if len(self.anchored) > 0 or len(self.anchored_ci) > 0:
+            first = path[0:boundaries[1] - 1] if len(boundaries) > 1 else path
+            for rx in self.anchored.get(first, []) \
+                    + self.anchored_ci.get(first.lower(), []):
+                if rx.match(path) is not None:
+                    stats["anchored"] += 1
+                    return True
+
+        for rx in self.start_rxs:
+            if rx.match(path) is not None:
+                stats["regex"] += 1
+                return True
+        for rx in self.boundary_rxs:
+            for i in boundaries:
+                if rx.match(path, i) is not None:
+                    stats["regex"] += 1
+                    return True
+        for rx in self.search_rxs:
+            if rx.search(path) is not None:
+                stats["regex"] += 1
+                return True
+
+        return False
+
+    def match_tree(self, path):
+        """returns True if 'path' or any of its parent directories is
+           excluded"""
+        while path != "":
+            if self.match(path):
+                return True
+            path = path.rpartition("/")[0]
+        return False
+
+    def stats_format(self):
+        excluded = sum([ v for k, v in self.stats.items() if k != "checked" ])
+        return "%d rules, %d paths checked, %d excluded " \
+               "(literal %d, suffix %d, anchored %d, regex %d)" \
+                    % (self.rules, self.stats["checked"], excluded,
+                       self.stats["literal"], self.stats["suffix"],
+                       self.stats["anchored"], self.stats["regex"])
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# chirribackup/fileops.py
+#
+#   File copy helpers used when restoring. A file can be copied, hardlinked
+#   or reflinked (cloned sharing the data blocks, on filesystems supporting
+#   it like btrfs or xfs). When a link cannot be made the file is copied.
+#   Copies are made by the kernel (copy_file_range or sendfile) when
+#   possible, without moving the data through userspace.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+
+from chirribackup.exceptions import BadValueException
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# FICLONE ioctl (linux/fs.h)
+FICLONE = 0x40049409
+
+# max bytes copied by each copy_file_range/sendfile call
+KERNEL_COPY_BLOCKSIZE = (1024*1024*1024)
+
+# link modes ('auto' makes a reflink if possible, else a copy)
+LINK_MODES = [ "copy", "auto", "hardlink", "reflink" ]
+
+# errors meaning 'this kind of link is not possible here'
+LINK_ERRORS = [
+    errno.EXDEV, errno.EMLINK, errno.EPERM, errno.EACCES,
+    errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS,
+]
+
+
+# kernel copy syscalls (not exposed by the os module of python2)
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+except OSError:
+    libc = None
+
+def libc_func(name, restype, argtypes):
+    f = getattr(libc, name, None) if libc is not None else None
+    if f is not None:
+        f.restype = restype
+        f.argtypes = argtypes
+    return f
+
+c_copy_file_range = libc_func("copy_file_range", ctypes.c_ssize_t,
+                        [ ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                          ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint ])
+c_sendfile = libc_func("sendfile", ctypes.c_ssize_t,
+                        [ ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t ])
+
+
+def kernel_copy(ifile, ofile, size):
+    """copies 'size' bytes from 'ifile' to 'ofile' (current positions) using
+       copy_file_range, or sendfile. It returns False if the kernel cannot
+       do it (and nothing was copied)"""
+    calls = []
+    if c_copy_file_range is not None:
+        calls.append(lambda n: c_copy_file_range(ifile.fileno(), None, ofile.fileno(), None, n, 0))
+    if c_sendfile is not None:
+        calls.append(lambda n: c_sendfile(ofile.fileno(), ifile.fileno(), None, n))
+    for call in calls:
+        copied = 0
+        while copied < size:
+            r = call(min(size - copied, KERNEL_COPY_BLOCKSIZE))
+            if r < 0:
+                e = ctypes.get_errno()
+                if e == errno.EINTR:
+                    continue
+                if copied == 0 and e in LINK_ERRORS:
+                    break
+                raise OSError(e, os.strerror(e))
+            if r == 0:
+                break
+            copied += r
+        if copied > 0 or size == 0:
+            if copied != size:
+                raise OSError(errno.EIO, "Short copy (%d of %d bytes)" % (copied, size))
+            return True
+    return False
+
+
+def link_mode_check(mode):
+    if mode not in LINK_MODES:
+        raise BadValueException("Unknown link mode '%s'." % mode)
+
+
+def copy(src, dst):
+    with open(src, 'rb') as ifile:
+        with open(dst, 'wb') as ofile:
+            if kernel_copy(ifile, ofile, os.fstat(ifile.fileno()).st_size):
+                return
+            shutil.copyfileobj(ifile, ofile)
+
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "Reflinks are not supported on this platform")
+    with open(src, 'rb') as ifile:
+        with open(dst, 'wb') as ofile:
+            try:
+                fcntl.ioctl(ofile.fileno(), FICLONE, ifile.fileno())
+            except IOError, ex:
+                raise OSError(ex.errno, ex.strerror)
+
+
+def clone(src, dst, mode = "copy"):
+    """creates 'dst' with the contents of 'src' using the selected link mode
+       ('copy', 'auto', 'hardlink' or 'reflink'). When the link cannot be
+       made the file is copied. Returns the mode actually used"""
+    link_mode_check(mode)
+    if mode != "copy":
+        try:
+            if mode == "hardlink":
+                hardlink(src, dst)
+            else:
+                reflink(src, dst)
+                mode = "reflink"
+            return mode
+        except OSError, ex:
+            if ex.errno not in LINK_ERRORS:
+                raise
+            if os.path.lexists(dst):
+                os.unlink(dst)
+    copy(src, dst)
+    return "copy"
+
@@ -24,19 +24,74 @@
 # 
 ###############################################################################
 
-import fnmatch
+import StringIO
+import itertools
 import json
 import os
 import re
-import shutil
 import stat
+import tempfile
 import time
 import sys
 
+import chirribackup.bindesc
 import chirribackup.chunk
+import chirribackup.compression
 import chirribackup.crypto
+import chirribackup.exclude
+import chirribackup.fileops
+import chirribackup.walker
+import chirribackup.workers
 from chirribackup.Logger import logger
-from chirribackup.exceptions import ChirriException, ChunkNotFoundException
+from chirribackup.exceptions import \
+    ChirriException,                \
+    BadSnapshotDescException,       \
+    BadSnapshotStatusException,     \
+    ChunkNotFoundException
+
+# CONSTANTS
+DISCOVER_FILES_BATCH = 1000
+
+# SQL expressions for file_ref rows that reference a chunk and its hash
+# (see Snapshot.file_ref_chunk())
+FILE_REF_HAS_CHUNK_SQL = "(hash IS NOT NULL AND hash NOT IN ('dir', 'lost') AND hash NOT LIKE 'symlink:%')"
+FILE_REF_CHUNK_SQL = "(CASE WHEN hash LIKE 'chunked:%' THEN substr(hash, 9) ELSE hash END)"
+HASHY_HASHER_BATCH = 1000
+
+# file_ref rows inserted by each query of Snapshot.desc_load()
+DESC_LOAD_BATCH = 1000
+
+# journal entries fetched by each query of Snapshot.restore_journal()
+RESTORE_JOURNAL_BATCH = 500
+
+# file_ref rows fetched by each query of Snapshot.refs()
+REFS_PAGE_SIZE = 10000
+
+# columns returned by Snapshot.refs()
+REFS_COLUMNS = {
+    "path"        : "file_ref.path",
+    "hash"        : "file_ref.hash",
+    "size"        : "file_ref.size",
+    "perm"        : "file_ref.perm",
+    "uid"         : "file_ref.uid",
+    "gid"         : "file_ref.gid",
+    "mtime"       : "file_ref.mtime",
+    "status"      : "file_ref.status",
+    "compression" : "file_data.compression",
+    "csize"       : "file_data.csize",
+}
+
+# SQL expressions selecting each file_ref type (see Snapshot.file_ref_type())
+REFS_TYPES_SQL = {
+    "dir"     : "file_ref.hash = 'dir'",
+    "lost"    : "file_ref.hash = 'lost'",
+    "symlink" : "file_ref.hash LIKE 'symlink:%'",
+    "chunked" : "file_ref.hash LIKE 'chunked:%'",
+    "regfile" : "(file_ref.hash IS NULL" \
+                " OR (file_ref.hash NOT IN ('dir', 'lost')" \
+                " AND file_ref.hash NOT LIKE 'symlink:%'" \
+                " AND file_ref.hash NOT LIKE 'chunked:%'))",
+}
 
 
 class Snapshot(object):
@@ -49,10 +104,13 @@ class Snapshot(object):
     finished_tstamp = None
     signed_tstamp   = None
     compression     = None
+    desc_format     = None
+    refcounts       = None
 
     def __init__(self, ldb):
         self.ldb = ldb
         self.snapshot_id = None
+        self.refcounts = chirribackup.chunk.RefcountBatch(ldb)
 
 
     def new(self, base_snapshot_id = None, snapshot_id = None):
@@ -82,6 +140,7 @@ class Snapshot(object):
         self.finished_tstamp = None
         self.signed_tstamp   = None
         self.compression     = None
+        self.desc_format     = None
 
         # create snapshot
         self.ldb.connection.execute("INSERT INTO snapshots (snapshot, status) VALUES ( :id, 0 )",
@@ -94,14 +153,69 @@ class Snapshot(object):
                         { "id": base_snapshot_id }).fetchone() is None:
                 raise ChirriException("Snapshot '%d' does not exists." % base_snapshot_id)
 
-            for fr in self.ldb.connection.execute("SELECT * FROM file_ref WHERE snapshot = :id",
-                                    { "id": base_snapshot_id }):
-                logger.debug("[CHK] %s" % fr["path"])
-                self.file_ref_save(fr["path"], fr["hash"], fr["size"], fr["perm"],
-                                   fr["uid"], fr["gid"], fr["mtime"], None)
+            # copy file_refs (set-based, the status NULL means copied)
+            t = time.time()
+            rows = self.ldb.connection.execute(
+                """
+                    INSERT INTO file_ref
+                        (snapshot, path, hash, size, perm, uid, gid, mtime, status, inode, ctime)
+                    SELECT :snapshot, path, hash, size, perm, uid, gid, mtime, NULL, inode, ctime
+                    FROM file_ref
+                    WHERE snapshot = :base
+                """, {
+                    "snapshot" : self.snapshot_id,
+                    "base"     : base_snapshot_id,
+                }).rowcount
+
+            # update refcount (grouped by chunk) -- references to unknown
+            # chunks are marked as lost
+            self.refcounts_add_file_refs("1", {}, 1)
+            self.refcounts_flush()
+
+            t = time.time() - t
+            logger.info("Copied %d file refs in %.2f seconds (%d rows/s)" \
+                            % (rows, t, rows / t if t > 0 else rows))
+
         return self
 
 
+    def refcounts_add_file_refs(self, where, params, value):
+        """adds 'value' to the refcount of the chunks referenced by the
+           file_refs of this snapshot that match 'where' (grouped by chunk,
+           applied on next refcounts_flush())"""
+        params = dict(params)
+        params["snapshot"] = self.snapshot_id
+        params["value"] = value
+        self.refcounts.add_query(
+            """
+                SELECT %s AS chunk, :value * COUNT(*)
+                FROM file_ref
+                WHERE snapshot = :snapshot AND %s AND (%s)
+                GROUP BY chunk
+            """ % (FILE_REF_CHUNK_SQL, FILE_REF_HAS_CHUNK_SQL, where),
+            params)
+
+
+    def refcounts_flush(self):
+        """applies pending refcount changes -- file_refs of this snapshot
+           referencing unknown chunks are marked as lost"""
+        for h, delta in self.refcounts.flush().items():
+            if delta <= 0:
+                continue
+            hashes = { "snapshot" : self.snapshot_id, "hash" : h, "chunked" : "chunked:" + h }
+            for fr in self.ldb.connection.execute(
+                        """
+                            SELECT path FROM file_ref
+                            WHERE snapshot = :snapshot AND hash IN (:hash, :chunked)
+                        """, hashes).fetchall():
+                logger.error("chunk '%s' not found for file '%s' -- MARKED AS LOST" % (h, fr["path"]))
+            self.ldb.connection.execute(
+                """
+                    UPDATE file_ref SET hash = 'lost', status = -1
+                    WHERE snapshot = :snapshot AND hash IN (:hash, :chunked)
+                """, hashes)
+
+
     def load(self, snapshot_id = None):
         # if snapshot_id not declared, load last snapshot with status 4 or 5
         if snapshot_id is None:
@@ -131,36 +245,70 @@ class Snapshot(object):
         self.finished_tstamp = row["finished_tstamp"]
         self.signed_tstamp   = row["signed_tstamp"]
         self.compression     = row["compression"]
+        self.desc_format     = row["desc_format"]
 
         return self
 
 
-    def refs(self):
-        srlist = []
-        for row in self.ldb.connection.execute(
-                        """
-                            SELECT file_ref.*,
-                                   file_data.csize,
-                                   file_data.compression
-                            FROM file_ref LEFT JOIN file_data
-                                ON file_ref.hash = file_data.hash
-                            WHERE file_ref.snapshot = :snapshot
-                        """, {
-                            "snapshot" : self.snapshot_id,
-                        }):
-            srlist.append({
-                    "path"        : row["path"],
-                    "hash"        : row["hash"],
-                    "size"        : row["size"],
-                    "compression" : row["compression"],
-                    "csize"       : row["csize"],
-                    "perm"        : row["perm"],
-                    "uid"         : row["uid"],
-                    "gid"         : row["gid"],
-                    "mtime"       : row["mtime"],
-                    "status"      : row["status"],
-                })
-        return srlist
+    def refs(self, columns = None, types = None, order = "path", reverse = False):
+        """generator yielding the file refs of this snapshot as sqlite3.Row
+           objects (indexed by column name). 'columns' selects which columns
+           of REFS_COLUMNS are fetched (all by default, and 'path' and
+           'hash' are always present), 'types' the file_ref types returned
+           (see file_ref_type) and 'order' sorts refs by 'path' or by 'hash'
+           (refs without hash are skipped then).
+           Refs are fetched in pages, continuing from the last ref returned
+           (keyset pagination), so memory usage does not depend on the
+           snapshot size and the database can be written (and committed)
+           while iterating."""
+        if columns is None:
+            columns = REFS_COLUMNS.keys()
+        columns = [ "path", "hash" ] + [ c for c in columns if c not in [ "path", "hash" ] ]
+        for c in columns:
+            if c not in REFS_COLUMNS:
+                raise ChirriException("Unknown file_ref column '%s'." % c)
+        if order not in [ "path", "hash" ]:
+            raise ChirriException("Unknown file_ref order '%s'." % order)
+
+        # build query
+        select = "SELECT %s FROM file_ref" \
+                    % ", ".join([ "%s AS %s" % (REFS_COLUMNS[c], c) for c in columns ])
+        if "compression" in columns or "csize" in columns:
+            select += " LEFT JOIN file_data ON file_ref.hash = file_data.hash"
+        where = [ "file_ref.snapshot = :snapshot" ]
+        if types is not None:
+            for t in types:
+                if t not in REFS_TYPES_SQL:
+                    raise ChirriException("Unknown file_ref type '%s'." % t)
+            where.append("(%s)" % " OR ".join([ REFS_TYPES_SQL[t] for t in types ]))
+        op, direction = ("<", "DESC") if reverse else (">", "ASC")
+        if order == "path":
+            next_page = "file_ref.path %s :path" % op
+            order_by = "file_ref.path %s" % direction
+        else:
+            where.append("file_ref.hash IS NOT NULL")
+            next_page = "file_ref.hash %s= :hash AND (file_ref.hash %s :hash OR file_ref.path %s :path)" \
+                            % (op, op, op)
+            order_by = "file_ref.hash %s, file_ref.path %s" % (direction, direction)
+
+        params = {
+            "snapshot" : self.snapshot_id,
+            "limit"    : REFS_PAGE_SIZE,
+        }
+        last = None
+        while True:
+            w = where if last is None else where + [ next_page ]
+            rows = self.ldb.connection.execute(
+                        "%s WHERE %s ORDER BY %s LIMIT :limit" \
+                            % (select, " AND ".join([ "(%s)" % x for x in w ]), order_by),
+                        params).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < REFS_PAGE_SIZE:
+                return
+            last = rows[-1]
+            params["path"] = last["path"]
+            params["hash"] = last["hash"]
 
 
     def file_ref_type(self, hash_ref):
@@ -172,6 +320,8 @@ class Snapshot(object):
             return "dir"
         if hash_ref.startswith("symlink:"):
             return "symlink"
+        if hash_ref.startswith("chunked:"):
+            return "chunked"
         if chirribackup.crypto.ChirriHasher.hash_check(hash_ref):
             return "regfile"
         raise ChirriException("Unknown file_ref type '%s'." % hash_ref)
@@ -184,6 +334,17 @@ class Snapshot(object):
         return hash_ref[len("symlink:"):]
 
 
+    def file_ref_chunk(self, hash_ref):
+        """returns the chunk referenced by a file_ref (the file content or
+           its manifest if it is a chunked file)"""
+        htype = self.file_ref_type(hash_ref)
+        if htype == "regfile":
+            return hash_ref
+        if htype == "chunked":
+            return hash_ref[len("chunked:"):]
+        return None
+
+
     def file_ref_format(self, hash_ref):
         htype = self.file_ref_type(hash_ref)
 
@@ -196,10 +357,13 @@ class Snapshot(object):
             return "dir"
         elif htype == "symlink":
             return hash_ref
+        elif htype == "chunked":
+            return "chunked:" + chirribackup.crypto.ChirriHasher.hash_format(self.file_ref_chunk(hash_ref))
         raise ChirriException("Unknown file_ref type '%s'." % hash_ref)
 
 
-    def file_ref_save(self, path, hash_or_type, size, perm, uid, gid, mtime, status):
+    def file_ref_save(self, path, hash_or_type, size, perm, uid, gid, mtime, status,
+                      inode = None, ctime = None):
         c = self.ldb.connection.cursor()
 
         # status assert
@@ -207,7 +371,7 @@ class Snapshot(object):
             if (status < -1 or status > 1):
                 raise ChirriException("Invalid status %d for path '%s'." % (status, path))
 
-            if self.file_ref_type(hash_or_type) != "regfile" \
+            if self.file_ref_type(hash_or_type) not in [ "regfile", "chunked" ] \
             and status == 0:
                 raise ChirriException("Invalid status %d for path '%s' of type %s." \
                                         % (status, path, self.file_ref_type(hash_or_type)))
@@ -231,9 +395,9 @@ class Snapshot(object):
             c.execute(
                 """
                 INSERT INTO file_ref
-                    (snapshot, path, hash, size, perm, uid, gid, mtime)
+                    (snapshot, path, hash, size, perm, uid, gid, mtime, inode, ctime)
                 VALUES
-                    (:snapshot, :path, :hash_or_type, :size, :perm, :uid, :gid, :mtime)
+                    (:snapshot, :path, :hash_or_type, :size, :perm, :uid, :gid, :mtime, :inode, :ctime)
                 """, {
                     "snapshot"     : self.snapshot_id,
                     "path"         : path,
@@ -243,12 +407,18 @@ class Snapshot(object):
                     "uid"          : uid,
                     "gid"          : gid,
                     "mtime"        : mtime,
+                    "inode"        : inode,
+                    "ctime"        : ctime,
                 })
         else:
             touched = False
 
             # check that file type is the same (if not, then reset hash to new value)
-            if self.file_ref_type(hash_or_type) != self.file_ref_type(f["hash"]):
+            # NOTE: a chunked file is a regular file not hashed yet
+            old_type = self.file_ref_type(f["hash"])
+            if old_type == "chunked" and hash_or_type is None:
+                old_type = "regfile"
+            if self.file_ref_type(hash_or_type) != old_type:
                 touched = True
 
             # if symlink changed...
@@ -256,7 +426,7 @@ class Snapshot(object):
                 touched = True
 
             # if regfile and hash declared, then force update hash
-            if self.file_ref_type(hash_or_type) == "regfile" \
+            if self.file_ref_type(hash_or_type) in [ "regfile", "chunked" ] \
             and hash_or_type is not None \
             and hash_or_type != f["hash"]:
                 touched = True
@@ -287,8 +457,32 @@ class Snapshot(object):
                     logger.debug("[UPD] %s (new(%s): %s; old: %s; touched = %s)" \
                                 % (path, k, v[1], f[k], touched))
 
+            # inode and ctime catch files rewritten in place (with the same
+            # size and mtime). They are ignored if unknown (NULL).
+            for k,v in ({
+                            "inode" : inode,
+                            "ctime" : ctime,
+                        }).items():
+                if v is not None and f[k] != v:
+                    touched = touched or f[k] is not None
+                    c.execute(
+                        """
+                            UPDATE file_ref SET %s = :val
+                            WHERE snapshot = :snapshot AND path = :path
+                        """ % k, {
+                            "snapshot" : self.snapshot_id,
+                            "path"     : path,
+                            "val"      : v
+                        })
+                    logger.debug("[UPD] %s (new(%s): %s; old: %s; touched = %s)" \
+                                % (path, k, v, f[k], touched))
+
             # if needs update, then update hash
             if touched:
+                # release old content (new content is referenced below)
+                if self.file_ref_chunk(f["hash"]) is not None \
+                and f["hash"] != hash_or_type:
+                    self.refcounts.dec(self.file_ref_chunk(f["hash"]))
                 c.execute(
                     """
                         UPDATE file_ref SET hash = :hash
@@ -310,24 +504,37 @@ class Snapshot(object):
                 "path"     : path,
             })
 
-        # update refcount
-        if hash_or_type is not None and self.file_ref_type(hash_or_type) == "regfile":
-            try:
-                chunk = chirribackup.chunk.Chunk(self.ldb, hash_or_type)
-                chunk.refcount_inc()
-            except ChunkNotFoundException, ex:
-                logger.error("chunk '%s' not found for file '%s' -- MARKED AS LOST" % (hash_or_type, path))
-                c.execute(
-                    """
-                        UPDATE file_ref SET hash = 'lost', status = -1
-                        WHERE snapshot = :snapshot AND path = :path
-                    """, {
-                        "snapshot" : self.snapshot_id,
-                        "path"     : path,
-                    })
+        # update refcount (unknown chunks are marked as lost when the
+        # changes are flushed, see refcounts_flush())
+        if self.file_ref_chunk(hash_or_type) is not None:
+            self.refcounts.inc(self.file_ref_chunk(hash_or_type))
 
 
     def run_discover_files(self, target_path = "."):
+        # load the stat cache: an index of the file_refs copied from the base
+        # snapshot that have already content. Files whose stat matches with
+        # the cache are unchanged and are confirmed in bulk.
+        #   path => (hash_or_type, size, perm, uid, gid, mtime, inode, ctime)
+        # NOTE: hash_or_type is "" for hashed regfiles (not needed and big)
+        cache = {}
+        for fr in self.ldb.connection.execute(
+                    """
+                        SELECT path, hash, size, perm, uid, gid, mtime, inode, ctime
+                        FROM file_ref
+                        WHERE snapshot = :snapshot
+                          AND status IS NULL
+                          AND hash IS NOT NULL
+                    """,
+                    { "snapshot" : self.snapshot_id }):
+            fr_type = self.file_ref_type(fr["hash"])
+            if fr_type == "lost":
+                continue
+            cache[fr["path"]] = (
+                    "" if fr_type in [ "regfile", "chunked" ] else fr["hash"],
+                    fr["size"], fr["perm"], fr["uid"], fr["gid"], fr["mtime"],
+                    fr["inode"], fr["ctime"])
+        logger.debug("Stat cache loaded with %d entries" % len(cache))
+
         # cache base path for local operationa -- this is always the 'db_path', never changes
         base = os.path.realpath(self.ldb.db_path)
 
@@ -339,8 +546,8 @@ class Snapshot(object):
         # NOTE:
         #   We do not use realpath() here because we want to know where the
         #   target file resides, not where it is pointing.
-        #   Please note that we only iterate on real directories, and we never
-        #   will follow a symlink in the next recursive calls.
+        #   Please note that the walker only iterates on real directories, it
+        #   never follows symlinks.
         path = os.path.abspath(os.path.join(base, target_path))
 
         # check that target path is inside 'base'
@@ -353,163 +560,264 @@ class Snapshot(object):
         # that directory '/home/user/backup_dir' is the base component.
         target_path = path[len(os.path.join(base, "")):]
 
-        # oookay, now we have:
-        #   - base        = realpath of the base dir (/home/user/backup_dir)
-        #   - path        = abspath of target file (/home/user/backup_dir/dir/file)
-        #   - target_path = target file relative to 'base' (dir/file)
-
         ########################################
-        # REGISTER PATH/FILE_REF
+        # WALK AND REGISTER PATH/FILE_REF
         ########################################
 
-        # check if file is excluded
-        if self.ldb.is_db_file(target_path):
+        os.stat_float_times(False)
+        unchanged = []
+        xm = chirribackup.exclude.ExcludeMatcher(self.ldb)
+        def prune(rel_path, is_dir):
+            if self.ldb.is_db_file(rel_path):
+                return True
+            if xm.match(rel_path):
+                logger.debug("[EXC] %s" % rel_path)
+                return True
+            return False
+
+        for rel_path, abs_path, statinfo in chirribackup.walker.walk(base, target_path, prune):
+            self.__discover_file(rel_path, abs_path, statinfo, cache, unchanged)
+        self.__discover_files_flush(unchanged)
+        self.refcounts_flush()
+        if xm.rules > 0:
+            logger.info("Excludes: %s" % xm.stats_format())
+
+
+    def __discover_files_flush(self, unchanged):
+        """confirms the unchanged file_refs found by __discover_file(): they
+           are loaded in a temporary table and updated with a single query"""
+        if len(unchanged) == 0:
             return
+        c = self.ldb.connection
+        c.execute(
+            """
+                CREATE TEMP TABLE IF NOT EXISTS discover_unchanged (
+                    path    TEXT PRIMARY KEY,
+                    inode   INTEGER,
+                    ctime   INTEGER
+                )""")
+        c.executemany(
+            """
+                INSERT INTO temp.discover_unchanged (path, inode, ctime)
+                    VALUES (:path, :inode, :ctime)
+            """, unchanged)
+        c.execute(
+            """
+                UPDATE file_ref
+                SET status = CASE WHEN %s THEN 0 ELSE 1 END,
+                    inode = (SELECT inode FROM temp.discover_unchanged u
+                             WHERE u.path = file_ref.path),
+                    ctime = (SELECT ctime FROM temp.discover_unchanged u
+                             WHERE u.path = file_ref.path)
+                WHERE snapshot = :snapshot
+                  AND path IN (SELECT path FROM temp.discover_unchanged)
+            """ % FILE_REF_HAS_CHUNK_SQL,
+            { "snapshot" : self.snapshot_id })
+        c.execute("DELETE FROM temp.discover_unchanged")
+        del unchanged[:]
 
-        # get file stats
-        os.stat_float_times(False)
-        statinfo = os.lstat(os.path.join(base, path))
 
+    def __discover_file(self, target_path, path, statinfo, cache, unchanged):
         # decide type
         hash_or_type = "bad"
         if stat.S_ISDIR(statinfo.st_mode):
             hash_or_type = "dir"
         elif stat.S_ISLNK(statinfo.st_mode):
-            hash_or_type = "symlink:%s" % os.readlink(os.path.join(base, path))
+            hash_or_type = "symlink:%s" % os.readlink(path)
         elif stat.S_ISREG(statinfo.st_mode):
             hash_or_type = None
 
         if hash_or_type == "bad":
             raise ChirriException("Unknown mode %o for %s" % (stat.S_IFMT(statinfo.st_mode), path))
 
-        if base != path:
+        # NOTE: the scandir backport may return float times
+        fr = (
+                hash_or_type if hash_or_type is not None else "",
+                statinfo.st_size       if stat.S_ISREG(statinfo.st_mode) else 0,
+                stat.S_IMODE(statinfo.st_mode) if not stat.S_ISLNK(statinfo.st_mode) else 0,
+                statinfo.st_uid        if not stat.S_ISLNK(statinfo.st_mode) else 0,
+                statinfo.st_gid        if not stat.S_ISLNK(statinfo.st_mode) else 0,
+                int(statinfo.st_mtime) if not stat.S_ISLNK(statinfo.st_mode) else 0,
+                statinfo.st_ino,
+                int(statinfo.st_ctime))
+        cfr = cache.get(target_path)
+        if cfr is not None \
+        and cfr[0:6] == fr[0:6] \
+        and (cfr[6] is None or cfr[6] == fr[6]) \
+        and (cfr[7] is None or cfr[7] == fr[7]):
+            # unchanged => confirm it (in bulk)
+            unchanged.append({
+                    "path"     : target_path,
+                    "inode"    : fr[6],
+                    "ctime"    : fr[7],
+                })
+            if len(unchanged) >= DISCOVER_FILES_BATCH:
+                self.__discover_files_flush(unchanged)
+                self.refcounts_flush()
+                self.ldb.maybe_commit()
+        else:
             self.file_ref_save(
                     target_path,
                     hash_or_type,
-                    statinfo.st_size if stat.S_ISREG(statinfo.st_mode) else 0,
-                    stat.S_IMODE(statinfo.st_mode) if not stat.S_ISLNK(statinfo.st_mode) else 0,
-                    statinfo.st_uid                if not stat.S_ISLNK(statinfo.st_mode) else 0,
-                    statinfo.st_gid                if not stat.S_ISLNK(statinfo.st_mode) else 0,
-                    statinfo.st_mtime              if not stat.S_ISLNK(statinfo.st_mode) else 0,
-                    0 if stat.S_ISREG(statinfo.st_mode) else 1)
-
-        ########################################
-        # IF PATH IS DIR, TRAVERSE IT
-        ########################################
-
-        # process file depending on its type
-        if hash_or_type == "dir":
-            for f in os.listdir(path):
-                self.run_discover_files(os.path.join(target_path, f))
+                    fr[1], fr[2], fr[3], fr[4], fr[5],
+                    0 if stat.S_ISREG(statinfo.st_mode) else 1,
+                    fr[6], fr[7])
 
 
     def run_find_lost_and_excluded(self):
-        base = os.path.realpath(self.ldb.db_path)
-
-        # load exclude list
-        xl = []
-        for x in self.ldb.connection.execute("SELECT * FROM excludes"):
-            if x["disabled"] == 0:
-                exclude = x["exclude"]
-                if x["expr_type"] > 0:
-                    if x["expr_type"] == 1:
-                        exclude = fnmatch.translate(exclude)
-                        if exclude.startswith("\\/"):
-                            exclude = "^" + exclude[2:]
-                        else:
-                            exclude = "(\\A|\\/)" + exclude
-                    if x["ignore_case"] != 0:
-                        exclude = re.compile(exclude, re.IGNORECASE)
-                    else:
-                        exclude = re.compile(exclude)
-                xl.append(exclude)
-
-        # delete excluded or lost files
+        # excluded paths are pruned during discovery, so any file_ref that
+        # still has status NULL (copied from base snapshot) was not found:
+        # it has been deleted or excluded
+        xm = chirribackup.exclude.ExcludeMatcher(self.ldb)
         for fr in self.ldb.connection.execute(
                     """
-                        SELECT *
+                        SELECT path
                         FROM file_ref
                         WHERE snapshot = :snapshot
+                          AND status IS NULL
                     """,
                     { "snapshot" : self.snapshot_id }):
-
-            delete = False
-
-            # delete excluded files
-            for x in xl:
-                if isinstance(x, basestring):
-                    delete = (fr["path"] == x)
-                else:
-                    delete = x.search(fr["path"]) is not None
-                if delete:
-                    logger.info("[EXC] %s" % fr["path"])
-                    break
-
-            # delete lost files
-            if not delete and not os.path.exists(os.path.join(base, fr["path"])):
+            if xm.match_tree(fr["path"]):
+                logger.info("[EXC] %s" % fr["path"])
+            else:
                 logger.warning("[DEL] %s" % fr["path"])
-                delete = True
 
-            # execute deletion (if requested)
-            if delete:
-                self.ldb.connection.execute(
-                    """
-                        DELETE FROM file_ref
-                        WHERE snapshot = :snapshot AND path = :path
-                    """, {
-                        "snapshot" : self.snapshot_id,
-                        "path"     : fr["path"]
-                    })
-                if fr["hash"] is not None \
-                and self.file_ref_type(fr["hash"]) == "regfile":
-                    chunk = chirribackup.chunk.Chunk(self.ldb, fr["hash"])
-                    chunk.refcount_dec()
+        # release chunks and delete them (in bulk)
+        self.refcounts_add_file_refs("status IS NULL", {}, -1)
+        self.refcounts_flush()
+        self.ldb.connection.execute(
+            """
+                DELETE FROM file_ref
+                WHERE snapshot = :snapshot AND status IS NULL
+            """, {
+                "snapshot" : self.snapshot_id,
+            })
 
 
     def run_hashy_hasher(self):
         """do the hashy hashy"""
-        base = os.path.realpath(self.ldb.db_path)
-
-        for fr in self.ldb.connection.execute(
-                    """
-                        SELECT *
-                        FROM file_ref
-                        WHERE snapshot = :snapshot
-                    """,
-                    { "snapshot" : self.snapshot_id }):
-            fr_type = self.file_ref_type(fr["hash"])
+        cdc_min_file_size = self.ldb.cdc_min_file_size
+        cdc_avg_chunk_size = self.ldb.cdc_avg_chunk_size
+        single_pass_min_size = self.ldb.single_pass_min_size
+        hash_jobs = self.ldb.hash_jobs
+        compression = self.ldb.compression if self.ldb.snapshot_compression else None
+        advisor = chirribackup.compression.CompressionAdvisor(self.ldb) \
+                    if compression is not None and self.ldb.compression_sampling \
+                    else None
+
+        def is_chunked(fr):
+            return cdc_min_file_size is not None \
+                   and fr["size"] > 0 \
+                   and fr["size"] >= cdc_min_file_size
+
+        def stage(fr):
+            # NOTE: this function is executed in worker threads, so it
+            #       cannot access the database. Big files are split in
+            #       content defined chunks later, in the main thread.
+            if is_chunked(fr):
+                return None
+            logger.info("snapshot of '%s'" % fr["path"])
+            return chirribackup.chunk.Chunk(self.ldb).stage(
+                        fr["path"],
+                        single_pass = single_pass_min_size is not None
+                                      and fr["size"] >= single_pass_min_size,
+                        compression = compression,
+                        advisor = advisor)
+
+        def pending():
+            # files not hashed yet. They are fetched in pages (keyset
+            # pagination, as in refs()) because the database is updated and
+            # committed while hashing
+            params = {
+                "snapshot" : self.snapshot_id,
+                "limit"    : REFS_PAGE_SIZE,
+            }
+            next_page = ""
+            while True:
+                rows = self.ldb.connection.execute(
+                            """
+                                SELECT path, size
+                                FROM file_ref
+                                WHERE snapshot = :snapshot
+                                  AND hash IS NULL
+                                  %s
+                                ORDER BY path
+                                LIMIT :limit
+                            """ % next_page,
+                            params).fetchall()
+                for row in rows:
+                    yield row
+                if len(rows) < REFS_PAGE_SIZE:
+                    return
+                next_page = "AND path > :path"
+                params["path"] = rows[-1]["path"]
+
+        frs = pending()
+        if hash_jobs is not None and hash_jobs == 1:
+            staged = ((fr, stage(fr), None) for fr in frs)
+        else:
+            staged = chirribackup.workers.WorkerPool(hash_jobs).imap(stage, frs)
 
-            if fr_type == "regfile" and fr["hash"] is None:
-                # do snapshot and calc hash
-                c = chirribackup.chunk.Chunk(self.ldb)
-                try:
-                    # make a snapshot of file
-                    # NOTE: by default because performance we do not ask for
-                    #       any compression for the associated chunk...
-                    #       compression will be performed during syncing
+        # NOTE: the main thread is the only database writer. It registers
+        #       staged chunks and updates file_ref in batches.
+        updates = []
+        for fr, c, ex in staged:
+            try:
+                if ex is not None:
+                    raise ex
+                # make a snapshot of file
+                # NOTE: by default because performance we do not ask for
+                #       any compression for the associated chunk...
+                #       compression will be performed during syncing
+                #       (unless 'snapshot_compression' is enabled)
+                if c is None:
+                    # big file => split it in content defined chunks
                     logger.info("snapshot of '%s'" % fr["path"])
-                    c.new(fr["path"])
-
-                    # snapshot succesful: register reference and update
-                    # chunk ref counter
-                    c.refcount_inc()
-                except chirribackup, ex:
-                    # snapshot failed: tag file_ref as failed
-                    logger.warning("%s: Cannot snapshot file: %s" % (fr["path"], ex))
-                    c = None
-                self.ldb.connection.execute(
-                    """
-                        UPDATE file_ref
-                        SET status = 1, hash = :hash, size = :size
-                        WHERE snapshot = :snapshot
-                          AND path = :path
-                    """, {
-                        "status"   : 1      if c is not None else -1,
-                        "hash"     : c.hash if c is not None else None,
-                        "size"     : c.size if c is not None else None,
-                        "snapshot" : self.snapshot_id,
-                        "path"     : fr["path"],
-                    })
+                    c = chirribackup.chunk.Chunk(self.ldb)
+                    c.new_chunked(fr["path"], cdc_avg_chunk_size, compression, advisor)
+                    hash = "chunked:%s" % c.hash
+                    size = c.manifest.size
+                else:
+                    c.commit()
+                    hash = c.hash
+                    size = c.size
+
+                # snapshot succesful: register reference and update
+                # chunk ref counter
+                self.refcounts.inc(c.hash)
+            except ChirriException, ex:
+                # snapshot failed: tag file_ref as failed
+                logger.warning("%s: Cannot snapshot file: %s" % (fr["path"], ex))
+                if c is not None:
+                    c.discard()
+                c = None
+            updates.append({
+                    "status"   : 1    if c is not None else -1,
+                    "hash"     : hash if c is not None else None,
+                    "size"     : size if c is not None else None,
+                    "snapshot" : self.snapshot_id,
+                    "path"     : fr["path"],
+                })
+            if len(updates) >= HASHY_HASHER_BATCH:
+                self.hashy_hasher_flush(updates)
+                if advisor is not None:
+                    advisor.flush()
+                self.ldb.maybe_commit()
+        self.hashy_hasher_flush(updates)
+        if advisor is not None:
+            advisor.flush()
+
+
+    def hashy_hasher_flush(self, updates):
+        self.ldb.connection.executemany(
+            """
+                UPDATE file_ref
+                SET status = :status, hash = :hash, size = :size
+                WHERE snapshot = :snapshot
+                  AND path = :path
+            """, updates)
+        del updates[:]
+        self.refcounts_flush()
 
 
     def set_status(self, status, commit = True):
@@ -529,13 +837,14 @@ class Snapshot(object):
 
         # commit -- a status change is a good commit point
         if commit:
-            self.ldb.connection.commit()
+            self.ldb.commit()
 
 
     def set_attribute(self, attribute, value):
         if attribute not in [
                                 "compression",
                                 "deleted",
+                                "desc_format",
                                 "finished_tstamp",
                                 "started_tstamp",
                                 "signed_tstamp",
@@ -606,9 +915,9 @@ class Snapshot(object):
             logger.error("Snapshot %d in unknown state %d." % (self.snapshot_id, self.status))
 
 
-    def __desc_parse_json(self, desc):
+    def __desc_parse_json(self, lines):
         try:
-            d = json.loads(desc)
+            d = json.loads("\n".join(lines))
             if "format" not in d["details"]:
                 d["format"] = "json"
             if "default" not in d:
@@ -619,20 +928,18 @@ class Snapshot(object):
         return d
 
 
-    def __desc_parse_csv(self, desc):
+    def __desc_parse_csv(self, lines):
         d = {
             "details": {},
             "default": {},
-            "refs": [],
         }
 
-        desc = desc.splitlines()
         keyval_re = re.compile("^([^:\\s]+)\\s*:\\s*(.+?)\\s*$")
         defkey_re = re.compile("^default\\.(.+)$")
 
         # read header
-        while len(desc) > 0:
-            l = desc.pop(0).strip()
+        for l in lines:
+            l = l.strip()
             m = keyval_re.match(l)
             if m is not None:
                 k = m.group(1)
@@ -649,49 +956,80 @@ class Snapshot(object):
                 logger.error("Cannot parse line '%s'." % l)
                 return None
 
-        if d["details"]["format"] != "csv":
-            logger.error("Unsupported format '%s'." % d["details"]["format"])
+        if d.get("details", {}).get("format") != "csv":
+            logger.error("Unsupported format '%s'." % d["details"].get("format"))
             return None
 
-        if len(desc) == 0:
-            logger.warning("No refs found.")
-            return d
+        # rows are parsed as they are read
+        d["refs"] = self.__desc_parse_csv_rows(lines)
+        return d
+
+
+    def __desc_parse_csv_rows(self, lines):
+        headers = None
+        for l in lines:
+            if l == "":
+                continue
 
-        # read headers
-        headers = desc.pop(0).split(";")
+            # read headers
+            if headers is None:
+                headers = l.split(";")
+                continue
 
-        # parse lines
-        while len(desc) > 0:
-            l = desc.pop(0).split(";")
+            # parse line
+            l = l.split(";")
             r = {}
             for i in range(0, len(headers)):
                 if l[i] != "":
                     #r[headers[i]] = l[i].decode("string_escape").decode('utf-8')
                     r[headers[i]] = l[i].decode("string_escape")
-            d["refs"].append(r)
-        return d
+            yield r
+
+        if headers is None:
+            logger.warning("No refs found.")
+
 
-            
     def desc_parse(self, desc):
+        """parses a snapshot description (a string or a file-like object).
+           The refs are returned as a generator, so they are parsed (and
+           the protection hash is checked) as they are consumed"""
+        if isinstance(desc, basestring):
+            desc = StringIO.StringIO(desc)
+
+        # binary descriptions carry their own digest
+        if chirribackup.bindesc.is_bindesc(desc):
+            logger.debug("decoding binary snapshot description")
+            r = chirribackup.bindesc.BinDescReader(desc)
+            return self.__desc_parse_check({
+                        "details" : r.details,
+                        "default" : {},
+                        "refs"    : r.refs(),
+                    })
+
         # unprotect
         logger.debug("unprotecting snapshot description")
-        desc = chirribackup.crypto.unprotect_string(desc)
+        lines = chirribackup.crypto.unprotect_lines(desc)
 
-        # try with json decoder
+        # JSON descriptions are an object, CSV descriptions start with the
+        # 'format' header
         logger.debug("trying to decode snapshot description...")
-        d = self.__desc_parse_json(desc)
-
-        # try with CSV decoder
-        if d is None:
-            d = self.__desc_parse_csv(desc)
-            logger.debug(" >> decoded as csv")
-        else:
+        first = next(lines, "")
+        lines = itertools.chain([ first ], lines)
+        if first.lstrip().startswith("{"):
+            d = self.__desc_parse_json(lines)
             logger.debug(" >> decoded as json")
+        else:
+            d = self.__desc_parse_csv(lines)
+            logger.debug(" >> decoded as csv")
 
         # if we cannot decode this throw an exception
         if d is None:
             raise BadSnapshotDescException("Cannot parse snapshot description")
-        
+
+        return self.__desc_parse_check(d)
+
+
+    def __desc_parse_check(self, d):
         # retrocompatibility fix: during development of version 1,
         # 'uploaded_tstamp' field was renamed to 'signed_tstamp'
         if "uploaded_tstamp" in d["details"]:
@@ -702,12 +1040,15 @@ class Snapshot(object):
         if self.status >= 0:
             raise BadSnapshotStatusException("Snapshot %s is in state %d." \
                                                 % (self.snapshot_id, self.status))
+
         # uncompress file refs
-        for r in d["refs"]:
-            for f,dv in d["default"].iteritems():
-                if f not in r:
-                    #logger.debug2("  >> adding %s(%s) in %s" % (f, dv, r))
-                    r[f] = dv
+        def refs(refs, default):
+            for r in refs:
+                for f,dv in default.iteritems():
+                    if f not in r:
+                        r[f] = dv
+                yield r
+        d["refs"] = refs(d["refs"], d["default"])
         return d
 
 
@@ -722,101 +1063,212 @@ class Snapshot(object):
                     "signed_tstamp",
                  ]:
             self.set_attribute(a, d["details"][a])
+
+        # forget refs of a previous (interrupted) load
+        self.refcounts_add_file_refs("1", {}, -1)
+        self.refcounts_flush()
+        self.ldb.connection.execute(
+            "DELETE FROM file_ref WHERE snapshot = :snapshot",
+            { "snapshot" : self.snapshot_id })
+
+        # insert refs in batches
+        def insert(batch):
+            self.ldb.connection.executemany(
+                """
+                    INSERT INTO file_ref
+                        (snapshot, path, hash, size, perm, uid, gid, mtime, status)
+                    VALUES
+                        (:snapshot, :path, :hash, :size, :perm, :uid, :gid, :mtime, :status)
+                """, batch)
+
+        batch = []
         for fr in d["refs"]:
-            self.file_ref_save(
-                    fr["path"],
-                    fr["hash"],
-                    int(fr["size"]),
-                    int(fr["perm"]),
-                    int(fr["uid"]),
-                    int(fr["gid"]),
-                    int(fr["mtime"]),
-                    int(fr["status"]) if "status" in fr else 1)
+            status = int(fr["status"]) if fr.get("status") is not None else 1
+            if status < -1 or status > 1:
+                raise ChirriException("Invalid status %d for path '%s'." % (status, fr["path"]))
+            batch.append({
+                    "snapshot" : self.snapshot_id,
+                    "path"     : fr["path"],
+                    "hash"     : fr["hash"],
+                    "size"     : int(fr["size"]) if fr["size"] is not None else None,
+                    "perm"     : int(fr["perm"]) if fr["perm"] is not None else None,
+                    "uid"      : int(fr["uid"]) if fr["uid"] is not None else None,
+                    "gid"      : int(fr["gid"]) if fr["gid"] is not None else None,
+                    "mtime"    : int(fr["mtime"]) if fr["mtime"] is not None else None,
+                    "status"   : status,
+                })
+            if len(batch) >= DESC_LOAD_BATCH:
+                insert(batch)
+                batch = []
+        if len(batch) > 0:
+            insert(batch)
+
+        # reference chunks
+        self.refcounts_add_file_refs("1", {}, 1)
+        self.refcounts_flush()
         self.set_status(5, False)
 
 
-    def desc_print(self, output_format = "txt"):
+    def __desc_write_bin(self, ofile):
+        """writes the description in binary format (see bindesc.py). Hashes
+           are indexed in a temporary table, ordered by hash"""
+        c = self.ldb.connection
+        c.execute("DROP TABLE IF EXISTS temp.desc_hashes")
+        c.execute(
+            """
+                CREATE TEMPORARY TABLE desc_hashes (
+                    idx     INTEGER PRIMARY KEY,
+                    hash    TEXT NOT NULL UNIQUE
+                )
+            """)
+        try:
+            # index 0 is None, the others are the distinct hashes
+            c.execute(
+                """
+                    INSERT INTO temp.desc_hashes (idx, hash)
+                        SELECT NULL, hash
+                        FROM (
+                            SELECT DISTINCT hash
+                            FROM file_ref
+                            WHERE snapshot = :snapshot AND hash IS NOT NULL
+                            ORDER BY hash
+                        )
+                """, {
+                    "snapshot" : self.snapshot_id,
+                })
+            nhashes = c.execute("SELECT COUNT(*) FROM temp.desc_hashes").fetchone()[0]
+            nrefs = c.execute(
+                        "SELECT COUNT(*) FROM file_ref WHERE snapshot = :snapshot",
+                        { "snapshot" : self.snapshot_id }).fetchone()[0]
+
+            w = chirribackup.bindesc.BinDescWriter(ofile)
+            w.write_details(self.snapshot_id,
+                            self.started_tstamp,
+                            self.finished_tstamp,
+                            self.signed_tstamp)
+            w.write_hashes(nhashes + 1, itertools.chain([ None ],
+                            (row["hash"] for row in c.execute(
+                                "SELECT hash FROM temp.desc_hashes ORDER BY idx"))))
+            w.write_refs(nrefs, c.execute(
+                        """
+                            SELECT file_ref.path, file_ref.size, file_ref.perm,
+                                   file_ref.uid, file_ref.gid, file_ref.mtime,
+                                   file_ref.status,
+                                   IFNULL(desc_hashes.idx, 0) AS hash_index
+                            FROM file_ref
+                                LEFT JOIN temp.desc_hashes
+                                    ON file_ref.hash = desc_hashes.hash
+                            WHERE file_ref.snapshot = :snapshot
+                            ORDER BY file_ref.path
+                        """, {
+                            "snapshot" : self.snapshot_id,
+                        }))
+            w.close()
+
+        finally:
+            c.execute("DROP TABLE IF EXISTS temp.desc_hashes")
+
+
+    def desc_write(self, ofile, output_format = "txt"):
+        """writes the description of this snapshot in the file-like object
+           'ofile' (it is streamed, and never kept in memory). Formats are
+           'txt' (CSV), 'json' and 'bin' (see bindesc.py)"""
         if self.status < 4:
             raise ChirriException("This snapshot cannot be described -- it is incomplete")
 
-        # fetch all refs
-        refs = self.refs()
+        if output_format == "bin":
+            self.__desc_write_bin(ofile)
+            return
 
         # search most common values (space optimization)
-        mc = {
-            "hash":   {},
-            "size":   {},
-            "perm":   {},
-            "uid":    {},
-            "gid":    {},
-            "mtime":  {},
-            "status": {},
-        }
-        for r in refs:
-            for f,vc in mc.iteritems():
-                if r[f] not in vc:
-                    vc[r[f]] = 1
-                else:
-                    vc[r[f]] += 1
-        for f in mc.keys():
-            mv = None
-            for v,c in mc[f].iteritems():
-                if mv is None or mc[f][mv] < mc[f][v]:
-                    mv = v
-            if mv is None:
-                del mc[f]
+        mc = {}
+        for f in [ "hash", "size", "perm", "uid", "gid", "mtime", "status" ]:
+            row = self.ldb.connection.execute(
+                        """
+                            SELECT %s AS value, COUNT(*) AS n
+                            FROM file_ref
+                            WHERE snapshot = :snapshot
+                            GROUP BY %s
+                            ORDER BY n DESC
+                            LIMIT 1
+                        """ % (f, f), {
+                            "snapshot" : self.snapshot_id,
+                        }).fetchone()
+            if row is None or row["value"] is None:
+                continue
+            if row["n"] > 5:
+                mc[f] = row["value"]
             else:
-                if mc[f][mv] > 5:
-                    mc[f] = mv
-                else:
-                    logger.warning("Cannot compress '%s' -- only used %d times." % (f, mc[f][mv]))
-                    del mc[f]
+                logger.warning("Cannot compress '%s' -- only used %d times." % (f, row["n"]))
 
         # remove most common values from references
-        for r in refs:
-            for f in mc.iterkeys():
-                if r[f] == mc[f]:
-                    del r[f]
-
-        d = None
-        if output_format == "json":
-            d = json.dumps(
-                    {
-                        "details" : {
+        def refs():
+            for r in self.refs():
+                yield dict([ (f, r[f]) for f in r.keys() if f not in mc or r[f] != mc[f] ])
+
+        # the description is spooled (and hashed) in a temporary file, and
+        # then it is written protected (see crypto.protect_string) to ofile
+        spool = tempfile.TemporaryFile(dir = self.ldb.chunks_dir)
+        hasher = chirribackup.crypto.ChirriHasher()
+        def emit(data):
+            if isinstance(data, unicode):
+                data = data.encode("utf-8")
+            hasher.update(data)
+            spool.write(data)
+
+        try:
+            if output_format == "json":
+                emit('{"details": %s, "default": %s, "refs": [' % (
+                        json.dumps({
                             "snapshot"        : self.snapshot_id,
                             "started_tstamp"  : self.started_tstamp,
                             "finished_tstamp" : self.finished_tstamp,
                             "signed_tstamp"   : self.signed_tstamp,
-                        },
-                        "default" : mc,
-                        "refs" : refs,
-                    })
+                        }),
+                        json.dumps(mc)))
+                sep = ""
+                for ref in refs():
+                    emit(sep + json.dumps(ref))
+                    sep = ", "
+                emit("]}")
+
+            elif output_format == "txt":
+                emit("format:          csv\n")
+                emit("snapshot:        %s\n" % self.snapshot_id)
+                emit("started_tstamp:  %s\n" % self.started_tstamp)
+                emit("finished_tstamp: %s\n" % self.finished_tstamp)
+                emit("signed_tstamp:   %s\n" % self.signed_tstamp)
+                for f,v in mc.iteritems():
+                    emit("default.%s: %s\n" % (f, v))
+                emit("rows:\n")
+                emit("hash;size;perm;uid;gid;mtime;status;path\n")
+                for ref in refs():
+                    emit("%s;%s;%s;%s;%s;%s;%s;%s\n" \
+                            % (str(ref["hash"]).encode("string_escape").replace(";", "\\x3b") if "hash" in ref else "",
+                               str(ref["size"]).encode("string_escape").replace(";", "\\x3b") if "size" in ref else "",
+                               str(ref["perm"]).encode("string_escape").replace(";", "\\x3b") if "perm" in ref else "",
+                               str(ref["uid"]).encode("string_escape").replace(";", "\\x3b") if "uid" in ref else "",
+                               str(ref["gid"]).encode("string_escape").replace(";", "\\x3b") if "gid" in ref else "",
+                               str(ref["mtime"]).encode("string_escape").replace(";", "\\x3b") if "mtime" in ref else "",
+                               str(ref["status"]).encode("string_escape").replace(";", "\\x3b") if "status" in ref else "",
+                               str(ref["path"]).encode("string_escape").replace(";", "\\x3b") if "path" in ref else ""))
+
+            else:
+                raise ChirriException("Unknown output format '%s'." % output_format)
 
-        elif output_format == "txt":
-            d = "format:          csv\n"
-            d += "snapshot:        %s\n" % self.snapshot_id
-            d += "started_tstamp:  %s\n" % self.started_tstamp
-            d += "finished_tstamp: %s\n" % self.finished_tstamp
-            d += "signed_tstamp:   %s\n" % self.signed_tstamp
-            for f,v in mc.iteritems():
-                d += "default.%s: %s\n" % (f, v)
-            d += "rows:\n"
-            d += "hash;size;perm;uid;gid;mtime;status;path\n"
-            for ref in refs:
-                d += "%s;%s;%s;%s;%s;%s;%s;%s\n" \
-                        % (str(ref["hash"]).encode("string_escape").replace(";", "\\x3b") if "hash" in ref else "",
-                           str(ref["size"]).encode("string_escape").replace(";", "\\x3b") if "size" in ref else "",
-                           str(ref["perm"]).encode("string_escape").replace(";", "\\x3b") if "perm" in ref else "",
-                           str(ref["uid"]).encode("string_escape").replace(";", "\\x3b") if "uid" in ref else "",
-                           str(ref["gid"]).encode("string_escape").replace(";", "\\x3b") if "gid" in ref else "",
-                           str(ref["mtime"]).encode("string_escape").replace(";", "\\x3b") if "mtime" in ref else "",
-                           str(ref["status"]).encode("string_escape").replace(";", "\\x3b") if "status" in ref else "",
-                           str(ref["path"]).encode("string_escape").replace(";", "\\x3b") if "path" in ref else "")
+            spool.seek(0)
+            chirribackup.crypto.protect_file(spool, ofile, hasher.hash)
 
-        else:
-            raise ChirriException("Unknown output format '%s'." % output_format)
+        finally:
+            spool.close()
 
-        return chirribackup.crypto.protect_string(d)
+
+    def desc_print(self, output_format = "txt"):
+        """returns the description of this snapshot as a string (see
+           desc_write)"""
+        d = StringIO.StringIO()
+        self.desc_write(d, output_format)
+        return d.getvalue()
 
 
     def destroy(self):
@@ -824,20 +1276,20 @@ class Snapshot(object):
             raise ChirriException("Cannot destroy a not-deleted snapshot.")
 
         # fix reference counters to snapshot's related file_ref
-        for fr in self.ldb.connection.execute(
-                        "SELECT * FROM file_ref WHERE snapshot = :id",
-                        { "id" : self.snapshot_id, }):
-            # (if hash is None or symlink/dir doesn't matter)
-            fr_type = self.file_ref_type(fr["hash"])
-            if fr_type == "regfile" and fr["hash"] is not None:
-                chunk = chirribackup.chunk.Chunk(self.ldb, fr["hash"])
-                chunk.refcount_dec()
+        # (if hash is None or symlink/dir doesn't matter)
+        self.refcounts_add_file_refs("1", {}, -1)
+        self.refcounts_flush()
 
         # delete snapshot's related file_ref
         self.ldb.connection.execute(
             "DELETE FROM file_ref WHERE snapshot = :id",
             { "id" : self.snapshot_id })
 
+        # forget unfinished restores of this snapshot
+        self.ldb.connection.execute(
+            "DELETE FROM restore_journal WHERE snapshot = :id",
+            { "id" : self.snapshot_id })
+
         # delete this snapshot
         self.ldb.connection.execute(
             "DELETE FROM snapshots WHERE snapshot = :id",
@@ -851,145 +1303,300 @@ class Snapshot(object):
         self.signed_tstamp   = None
 
         # commit -- such a status change is a good commit point
-        self.ldb.connection.commit()
+        self.ldb.commit()
 
 
     def get_filename(self):
-        f = "snapshot-%d.txt" % self.snapshot_id
+        f = "snapshot-%d.%s" % (self.snapshot_id, "bin" if self.desc_format == "bin" else "txt")
         if self.compression is not None:
             f += "." + self.compression
         return f
 
 
-    def restore(self, sm, target_path, overwrite = False):
-        # some checks
-        if self.status < 5:
-            raise ChirriException("This snapshot cannot be restored -- it is not uploaded yet")
-
-        target_path = os.path.realpath(target_path)
-        logger.info("Restoring snapshot %d in target path '%s'." % (self.snapshot_id, target_path))
-
-        if os.path.exists(target_path):
-            if not overwrite:
-                raise ChirriException("Target path '%s' already exists." % target_path)
-
-            if not os.path.isdir(target_path):
-                raise ChirriException("Target path '%s' is not a directory" % target_path)
+    def restore_attributes(self, target_file, r):
+        os.utime(target_file, (r["mtime"], r["mtime"]))
+        os.chmod(target_file, r["perm"])
+        try:
+            os.chown(target_file, r["uid"], r["gid"])
+        except OSError, oe:
+            if oe.errno == 1:
+                logger.error("chown(%d, %d): %s" % (r["uid"], r["gid"], str(oe)))
             else:
-                logger.warning("Target path '%s' already exists -- continuing restoration on it" % target_path)
-        else:
-            logger.info("Target path '%s' does not exist -- creating" % target_path)
-            os.makedirs(target_path, 0770)
+                raise oe
 
-        # create directories
-        for r in self.refs():
-            if self.file_ref_type(r["hash"]) == "dir":
-                if not os.path.exists(os.path.join(target_path, r["path"])):
-                    os.mkdir(os.path.join(target_path, r["path"]))
-                else:
-                    os.chmod(os.path.join(target_path, r["path"]), 0700)
 
-        # restore symlinks
-        for r in self.refs():
-            # process only symlinks
-            if self.file_ref_type(r["hash"]) != "symlink":
-                continue
+    def restore_journal_size(self, target_path):
+        """returns the number of files already restored by an unfinished
+           restore of this snapshot in 'target_path'"""
+        return self.ldb.connection.execute(
+                        """
+                            SELECT COUNT(*)
+                            FROM restore_journal
+                            WHERE target = :target
+                              AND snapshot = :snapshot
+                        """, {
+                            "target"   : target_path,
+                            "snapshot" : self.snapshot_id,
+                        }).fetchone()[0]
 
-            # restore symlink
-            target_file = os.path.join(target_path, r["path"])
-            symlink = self.file_ref_symlink(r["hash"])
-            if os.path.exists(target_file):
-                if not overwrite:
-                    raise ChirriException("Target file '%s' already exists." % target_file)
-                os.unlink(target_file)
-            logger.debug("  restoring [%s] (-> %s)" % (target_file, symlink))
-            os.symlink(symlink, target_file)
-
-        # organize downloads
-        dl = {}
-        for r in self.refs():
-            # only regular files are processed in this loop
-            if self.file_ref_type(r["hash"]) == "lost":
-                logger.error("File '%s' is lost" % r["path"])
 
-            if self.file_ref_type(r["hash"]) != "regfile":
-                continue
+    def restore_journal(self, target_path, paths):
+        """returns a dict path -> hash with the files of 'paths' already
+           restored by an unfinished restore of this snapshot in
+           'target_path'"""
+        journal = {}
+        for i in range(0, len(paths), RESTORE_JOURNAL_BATCH):
+            params = {
+                "target"   : target_path,
+                "snapshot" : self.snapshot_id,
+            }
+            for j, path in enumerate(paths[i:i + RESTORE_JOURNAL_BATCH]):
+                params["p%d" % j] = path
+            for row in self.ldb.connection.execute(
+                            """
+                                SELECT path, hash
+                                FROM restore_journal
+                                WHERE target = :target
+                                  AND snapshot = :snapshot
+                                  AND path IN (%s)
+                            """ % ", ".join([ ":p%d" % j for j in range(0, len(params) - 2) ]),
+                            params):
+                journal[row["path"]] = row["hash"]
+        return journal
+
+
+    def restore_journal_add(self, target_path, ref_list):
+        self.ldb.connection.executemany(
+                        """
+                            INSERT OR REPLACE INTO restore_journal
+                                (target, path, snapshot, hash)
+                                VALUES (:target, :path, :snapshot, :hash)
+                        """, [ {
+                            "target"   : target_path,
+                            "path"     : r["path"],
+                            "snapshot" : self.snapshot_id,
+                            "hash"     : r["hash"],
+                        } for r in ref_list ])
+        self.ldb.maybe_commit()
 
-            # check if target file exists. If it exists check that its hash
-            # match with the chunk's hash
+
+    def restore_journal_clear(self, target_path):
+        self.ldb.connection.execute(
+                        "DELETE FROM restore_journal WHERE target = :target",
+                        { "target" : target_path })
+        self.ldb.commit()
+
+
+    def restore_chunk(self, sm, target_path, job, overwrite, link_mode):
+        """downloads a chunk and restores the file refs using it. This method
+           runs in a worker thread, so it cannot access the database (the
+           chunk, its parts and the journaled refs are loaded by the
+           caller). It returns a tuple (restored refs, refs found already
+           restored)"""
+        h, c, parts, ref_list, journal = job
+
+        # check if target files exist. Files journaled by a previous restore
+        # are accepted if their size and mtime match; otherwise check that
+        # their hash match with the chunk's hash (or, for chunked files,
+        # with the hash of the contents described by the manifest)
+        pending = []
+        found = []
+        manifest = None
+        for r in ref_list:
             target_file = os.path.join(target_path, r["path"])
             if os.path.exists(target_file):
-                hot = chirribackup.crypto.ChirriHasher.hash_file(target_file)
-                if hot.hash == r["hash"]:
-                    # target file matches... don't add to the download queue
+                st = os.lstat(target_file)
+                if journal.get(r["path"]) == r["hash"]:
+                    if st.st_size == r["size"] and int(st.st_mtime) == int(r["mtime"]):
+                        found.append(r)
+                        continue
+                if parts is None:
+                    content_hash = c.hash
+                else:
+                    if manifest is None:
+                        manifest = c.manifest_load(sm,
+                                        os.path.join(target_path, ".%s.manifest" % c.hash))
+                    content_hash = manifest.hash
+                if (r["size"] is None or st.st_size == r["size"]) \
+                and chirribackup.crypto.ChirriHasher.hash_file(target_file).hash == content_hash:
+                    # target file matches... don't download it again (but
+                    # its attributes could be not restored yet)
                     logger.info("File '%s' already downloaded." % r["path"])
+                    self.restore_attributes(target_file, r)
+                    found.append(r)
                     continue
                 # okay ... hashes doesn't match... decide if unlink or abort
                 if not overwrite:
                     raise ChirriException("Target file '%s' already exists." % target_file)
                 os.unlink(target_file)
-
-            # add a new 'hash' group if does not exist, and then add this file
-            # reference to the download queue
-            if r["hash"] not in dl:
-                dl[r["hash"]] = []
-            dl[r["hash"]].append(r)
-
-        # restore files and symlinks
-        for h, ref_list in dl.items():
-            # download needed chunk
-            target_chunk = os.path.join(target_path, ".%s.tmp" % h)
-            c = chirribackup.chunk.Chunk(self.ldb, h)
+            pending.append(r)
+        if len(pending) == 0:
+            return (pending, found)
+
+        # download needed chunk
+        target_chunk = os.path.join(target_path, ".%s.tmp" % c.hash)
+        if parts is not None:
+            c.download_chunked(sm, target_chunk, parts, manifest)
+        else:
             c.download(sm, target_chunk)
 
-            # once downloaded the needed chunk, we use it for restoring the
-            # requested file references
-            while len(ref_list) > 0:
-                # fetch next element
-                r = ref_list.pop(0)
-
-                # debug assertion
-                if r["hash"] != h:
-                    os.unlink(target_chunk)
-                    raise ChirriException("hash not match")
-
+        # once downloaded the needed chunk, we use it for restoring the
+        # requested file references: the chunk is moved to the first file,
+        # and this file is cloned for the rest. Hardlinks are only made
+        # between files sharing the same attributes (a hardlink shares them),
+        # other files are copied
+        try:
+            restored = []
+            sources = {}
+            for r in pending:
                 # overwrite check -- if we found an unexpected file here we
-                # must abort. It was created between the download queue build
-                # loop (dl) and now, so it is maybe an update or something like
-                # that.
+                # must abort. It was created between the existence check and
+                # now, so it is maybe an update or something like that.
                 target_file = os.path.join(target_path, r["path"])
-                if os.path.exists(target_file):
-                    os.unlink(target_chunk)
+                if os.path.lexists(target_file):
                     raise ChirriException("Unexpected file '%s' has been found." % target_file)
 
                 # restore file ref
                 logger.debug("  restoring [%s]" % target_file)
-                if len(ref_list) == 0:
+                attrs = (r["perm"], r["uid"], r["gid"], r["mtime"])
+                if len(restored) == 0:
                     os.rename(target_chunk, target_file)
+                elif link_mode != "hardlink":
+                    chirribackup.fileops.clone(restored[0], target_file, link_mode)
+                elif attrs in sources:
+                    chirribackup.fileops.clone(sources[attrs], target_file, link_mode)
                 else:
-                    shutil.copyfile(target_chunk, target_file)
-                os.utime(target_file, (r["mtime"], r["mtime"]))
-                os.chmod(target_file, r["perm"])
-                try:
-                    os.chown(target_file, r["uid"], r["gid"])
-                except OSError, oe:
-                    if oe.errno == 1:
-                        logger.error("chown(%d, %d): %s" % (r["uid"], r["gid"], str(oe)))
-                    else:
-                        raise oe
-
-            # finally we remove the target_chunk file if it stills exists (and
-            # we warn about this bug)
+                    chirribackup.fileops.clone(restored[0], target_file, "auto")
+                sources.setdefault(attrs, target_file)
+                restored.append(target_file)
+
+        finally:
             if os.path.exists(target_chunk):
-                logger.error("Removing forgotten chunk %s??" % target_chunk)
                 os.unlink(target_chunk)
 
-        # restore directory properties
-        for r in self.refs():
-            target_file = os.path.join(target_path, r["path"])
-            if self.file_ref_type(r["hash"]) == "dir":
-                os.chmod(target_file, r["perm"])
-                os.chown(target_file, r["uid"], r["gid"])
-                os.utime(target_file, (r["mtime"], r["mtime"]))
+        # attributes are restored once all the copies have been made (so
+        # read-only files can be used as source)
+        for r in pending:
+            self.restore_attributes(os.path.join(target_path, r["path"]), r)
+
+        return (pending, found)
+
+
+    def restore(self, sm, target_path, overwrite = False, link_mode = "auto", jobs = None):
+        # some checks
+        if self.status < 5:
+            raise ChirriException("This snapshot cannot be restored -- it is not uploaded yet")
+        chirribackup.fileops.link_mode_check(link_mode)
+
+        target_path = os.path.realpath(target_path)
+        logger.info("Restoring snapshot %d in target path '%s'." % (self.snapshot_id, target_path))
+
+        # files restored by an interrupted restore
+        resuming = self.restore_journal_size(target_path)
+
+        if os.path.exists(target_path):
+            if resuming > 0:
+                logger.info("Resuming restoration (%d files already restored)" % resuming)
+            elif not overwrite:
+                raise ChirriException("Target path '%s' already exists." % target_path)
+
+            if not os.path.isdir(target_path):
+                raise ChirriException("Target path '%s' is not a directory" % target_path)
+            else:
+                logger.warning("Target path '%s' already exists -- continuing restoration on it" % target_path)
+        else:
+            logger.info("Target path '%s' does not exist -- creating" % target_path)
+            os.makedirs(target_path, 0770)
+
+        # create directories and restore symlinks (sorted by path, so parent
+        # dirs come first)
+        for r in self.refs(columns = [], types = [ "dir", "symlink", "lost" ]):
+            t = self.file_ref_type(r["hash"])
+            if t == "lost":
+                logger.error("File '%s' is lost" % r["path"])
+
+            elif t == "dir":
+                if not os.path.exists(os.path.join(target_path, r["path"])):
+                    os.mkdir(os.path.join(target_path, r["path"]))
+                else:
+                    os.chmod(os.path.join(target_path, r["path"]), 0700)
 
+            elif t == "symlink":
+                # restore symlink
+                target_file = os.path.join(target_path, r["path"])
+                symlink = self.file_ref_symlink(r["hash"])
+                if os.path.islink(target_file) and os.readlink(target_file) == symlink:
+                    continue
+                if os.path.lexists(target_file):
+                    if not overwrite:
+                        raise ChirriException("Target file '%s' already exists." % target_file)
+                    os.unlink(target_file)
+                logger.debug("  restoring [%s] (-> %s)" % (target_file, symlink))
+                os.symlink(symlink, target_file)
+
+        for r in self.ldb.connection.execute(
+                        """
+                            SELECT path
+                            FROM file_ref
+                            WHERE snapshot = :snapshot
+                              AND hash IS NULL
+                        """, {
+                            "snapshot" : self.snapshot_id,
+                        }):
+            logger.error("File '%s' has no content" % r["path"])
+
+        # regular files are restored grouped by content. Chunks (and journal
+        # entries) are loaded here, because workers cannot access the
+        # database
+        def jobs_iter():
+            for h, refs in itertools.groupby(
+                                self.refs(columns = [ "size", "perm", "uid", "gid", "mtime" ],
+                                          types = [ "regfile", "chunked" ],
+                                          order = "hash"),
+                                lambda r: r["hash"]):
+                ref_list = list(refs)
+                c = chirribackup.chunk.Chunk(self.ldb, self.file_ref_chunk(h))
+                parts = c.manifest_parts() if self.file_ref_type(h) == "chunked" else None
+                journal = self.restore_journal(target_path, [ r["path"] for r in ref_list ]) \
+                                if resuming > 0 else {}
+                yield (h, c, parts, ref_list, journal)
+
+        # restore files -- each worker downloads a chunk and writes the files
+        # using it, and finished files are journaled
+        if jobs is None or jobs == 0:
+            jobs = self.ldb.restore_jobs
+        if jobs is None or jobs == 0:
+            jobs = sm.sync_jobs
+        logger.debug("Restoring files using %d workers" % jobs)
+        pool = chirribackup.workers.WorkerPool(jobs)
+        restored = 0
+        chunks = 0
+        try:
+            for job, res, ex in pool.imap(
+                                lambda job: self.restore_chunk(sm, target_path, job,
+                                                               overwrite, link_mode),
+                                jobs_iter()):
+                if ex is not None:
+                    raise ex
+                pending, found = res
+                journal = job[4]
+                restored += len(pending)
+                chunks += 1
+                self.restore_journal_add(target_path,
+                        pending + [ r for r in found if journal.get(r["path"]) != r["hash"] ])
+        finally:
+            self.ldb.commit()
+        logger.info("Restored %d files from %d chunks." % (restored, chunks))
+
+        # restore directory properties (children first, so parent mtimes are
+        # not changed later)
+        for r in self.refs(columns = [ "perm", "uid", "gid", "mtime" ],
+                           types = [ "dir" ],
+                           reverse = True):
+            target_file = os.path.join(target_path, r["path"])
+            os.chmod(target_file, r["perm"])
+            os.chown(target_file, r["uid"], r["gid"])
+            os.utime(target_file, (r["mtime"], r["mtime"]))
 
+        # restore finished
+        self.restore_journal_clear(target_path)
@@ -43,6 +43,10 @@ class BaseStorage(object):
     # class attributes
     name = None
     storage_status_keys = {}
+    # default number of concurrent transfers (methods of this class are
+    # called from several threads when greater than 1, so they cannot use
+    # the local database: read the storage config in __init__())
+    sync_jobs = 1
 
     # object attributes
     ldb = None
@@ -82,6 +86,12 @@ class BaseStorage(object):
         """download a file to disk"""
         raise ChirriException("This method must be overrided")
 
+    def download_stream(self, remote_file, f):
+        """download a file writing its contents to the file-like object 'f'
+           as they arrive (the download is aborted if f.write() raises an
+           exception)"""
+        raise ChirriException("This method must be overrided")
+
     def download_data(self, remote_file, callback = None):
         """get file contents"""
         raise ChirriException("This method must be overrided")
@@ -64,12 +64,21 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
     credentials = None
     client = None
     bucket = None
+    gs_bucket = None
+    gs_folder = None
+    gs_chunked = None
 
     def __init__(self, ldb, config = False):
         super(GoogleStorage, self).__init__(ldb, config)
 
         if not config:
             # okay .. not in config (ask_config() method)
+            # read config here: other methods may be called from threads
+            # that cannot use the local database
+            self.gs_bucket = self.ldb.sm_gs_bucket
+            self.gs_folder = self.ldb.sm_gs_folder
+            self.gs_chunked = self.ldb.sm_gs_chunked
+
             # load credentials and authenticate
             self.scopes = ['https://www.googleapis.com/auth/devstorage.read_write']
                          #['https://www.googleapis.com/auth/cloud-platform'])
@@ -81,21 +90,21 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
             logger.debug("project <%s>" % (self.credentials._project_id))
             logger.debug("Creating gs client")
             self.client = google.cloud.storage.Client(credentials=self.credentials, project=self.credentials._project_id)
-            logger.debug("Setting bucket %s" % self.ldb.sm_gs_bucket)
-            self.bucket = self.client.get_bucket(self.ldb.sm_gs_bucket)
+            logger.debug("Setting bucket %s" % self.gs_bucket)
+            self.bucket = self.client.get_bucket(self.gs_bucket)
             logger.debug("GS storage manager ready")
 
 
     def __build_gs_path(self, remote_file):
         if remote_file is None:
-            return self.ldb.sm_gs_folder
+            return self.gs_folder
         if isinstance(remote_file, list):
             remote_file = os.path.join(*remote_file)
         if len(remote_file) > 0 and remote_file[0] == "/":
             raise ChirriException("bad path '%s'." % remote_file)
-        if len(self.ldb.sm_gs_folder) == 0:
+        if len(self.gs_folder) == 0:
             return remote_file
-        return os.path.join(self.ldb.sm_gs_folder, remote_file)
+        return os.path.join(self.gs_folder, remote_file)
 
 
     def ask_config(self, config):
@@ -123,7 +132,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
 
     def __upload_iobase(self, remote_file, md5sum, f, size, retry = 0):
         try:
-            if not self.ldb.sm_gs_chunked:
+            if not self.gs_chunked:
                 blob = self.bucket.blob(self.__build_gs_path(remote_file))
                 blob.md5_hash = md5sum
                 blob.upload_from_file(f, num_retries=retry)
@@ -134,7 +143,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
                 #                mimetype="application/octet-stream",
                 #                resumable=True)
                 #request = self.service.objects().insert(
-                #            bucket = self.ldb.sm_gs_bucket,
+                #            bucket = self.gs_bucket,
                 #            body = {
                 #                "name"    : self.__build_gs_path(remote_file),
                 #                "md5Hash" : md5sum,
@@ -211,7 +220,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
         if path != "":
             path = path + "/"
         logger.debug("Listing bucket '%s' with prefix '%s'." \
-                        % (self.ldb.sm_gs_bucket, self.__build_gs_path(path)))
+                        % (self.gs_bucket, self.__build_gs_path(path)))
         blobs = self.bucket.list_blobs(prefix=self.__build_gs_path(path))
         l = []
         for blob in blobs:
@@ -240,7 +249,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
         """Downloads a blob from the bucket."""
         blob = self.bucket.blob(self.__build_gs_path(remote_file))
 
-        if not self.ldb.sm_gs_chunked:
+        if not self.gs_chunked:
             blob.download_to_file(f)
 
         else:
@@ -256,6 +265,10 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
             self.__download(remote_file, f)
 
 
+    def download_stream(self, remote_file, f):
+        self.__download(remote_file, f)
+
+
     def download_data(self, remote_file):
         f = StringIO.StringIO()
         self.__download(remote_file, f)
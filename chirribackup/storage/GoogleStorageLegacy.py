@@ -65,11 +65,17 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
     scopes = None
     credentials = None
     service = None
+    gs_bucket = None
+    gs_folder = None
 
     def __init__(self, ldb, config = False):
         super(GoogleStorage, self).__init__(ldb, config)
         if not config:
             # okay .. not in config (ask_config() method)
+            # read config here: other methods may be called from threads
+            # that cannot use the local database
+            self.gs_bucket = self.ldb.sm_gs_bucket
+            self.gs_folder = self.ldb.sm_gs_folder
             # load credentials and authenticate
             self.scopes = ['https://www.googleapis.com/auth/devstorage.read_write']
             self.credentials = ServiceAccountCredentials.from_json_keyfile_name(
@@ -83,7 +89,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
             remote_file = os.path.join(*remote_file)
         if len(remote_file) > 0 and remote_file[0] == "/":
             raise ChirriException("bad path '%s'." % remote_file)
-        return os.path.join(self.ldb.sm_gs_folder, remote_file)
+        return os.path.join(self.gs_folder, remote_file)
 
 
     def ask_config(self, config):
@@ -113,7 +119,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
                             mimetype="application/octet-stream",
                             resumable=True)
             request = self.service.objects().insert(
-                        bucket = self.ldb.sm_gs_bucket,
+                        bucket = self.gs_bucket,
                         body = {
                             "name"    : self.__build_gs_path(remote_file),
                             "md5Hash" : md5sum,
@@ -185,7 +191,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
 
     def get_listing(self, path = ""):
         req = self.service.objects().list(
-                    bucket = self.ldb.sm_gs_bucket,
+                    bucket = self.gs_bucket,
                     fields = "nextPageToken,items(name,size)")
         l = []
         while req:
@@ -193,7 +199,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
             for i in resp.get('items', []):
                 l.append(
                     {
-                        "name" : i["name"][len(self.ldb.sm_gs_folder)+1:],
+                        "name" : i["name"][len(self.gs_folder)+1:],
                         "size" : i["size"],
                     })
             req = self.service.objects().list_next(req, resp)
@@ -202,7 +208,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
 
     def __download(self, remote_file, f):
         req = self.service.objects().get_media(
-                            bucket = self.ldb.sm_gs_bucket,
+                            bucket = self.gs_bucket,
                             object = self.__build_gs_path(remote_file))
         downloader = http.MediaIoBaseDownload(f, req)
 
@@ -217,6 +223,10 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
             self.__download(remote_file, f)
 
 
+    def download_stream(self, remote_file, f):
+        self.__download(remote_file, f)
+
+
     def download_data(self, remote_file):
         f = StringIO.StringIO()
         self.__download(remote_file, f)
@@ -226,7 +236,7 @@ class GoogleStorage(chirribackup.storage.BaseStorage.BaseStorage):
     def delete_file(self, remote_file):
         try:
             req = self.service.objects().delete(
-                            bucket = self.ldb.sm_gs_bucket,
+                            bucket = self.gs_bucket,
                             object = self.__build_gs_path(remote_file))
             resp = req.execute()
         except errors.HttpError, ex:
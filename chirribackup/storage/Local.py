@@ -28,10 +28,15 @@ from chirribackup.exceptions import ChirriException
 from chirribackup.Logger import logger
 import chirribackup.input
 import chirribackup.storage.BaseStorage
+import errno
 import shutil
 import os
 import stat
 
+# CONSTANTS
+READ_BLOCKSIZE = (1024*1024)
+
+
 class DirectoryNotFoundLocalStorageException(ChirriException):
     """Exception launched when directory is not found"""
 
@@ -43,6 +48,7 @@ class Local(chirribackup.storage.BaseStorage.BaseStorage):
 
     # class attributes
     name = "Local storage"
+    sync_jobs = 4
     storage_status_keys = {
         "sm_local_storage_dir": { "save": 1, "type": "str", "value": None },
     }
@@ -70,7 +76,12 @@ class Local(chirribackup.storage.BaseStorage.BaseStorage):
         target_dir = os.path.dirname(target_file)
         if not os.path.exists(target_dir):
             if create_dir:
-                os.makedirs(target_dir, 0770)
+                try:
+                    os.makedirs(target_dir, 0770)
+                except OSError, ex:
+                    # other thread may have created it
+                    if ex.errno != errno.EEXIST:
+                        raise
             else:
                 raise DirectoryNotFoundLocalStorageException("Directory %s not found." % target_dir)
         elif not os.path.isdir(target_dir):
@@ -108,7 +119,7 @@ class Local(chirribackup.storage.BaseStorage.BaseStorage):
         try:
             for f in os.listdir(self.__build_ls_path(path)):
                 if os.path.isdir(self.__build_ls_path([ path, f ])):
-                    l.extend(self.get_listing(self.path_join(path, f)))
+                    l.extend(self.__get_listing(self.path_join(path, f)))
                 else:
                     statinfo = os.lstat(self.__build_ls_path([ path, f ]))
                     l.append({
@@ -137,6 +148,12 @@ class Local(chirribackup.storage.BaseStorage.BaseStorage):
         """download a file to disk"""
         shutil.copyfile(self.__build_ls_path(remote_file, False), local_path)
 
+    def download_stream(self, remote_file, f):
+        """download a file to a file-like object"""
+        with open(self.__build_ls_path(remote_file, False), "rb") as ifile:
+            shutil.copyfileobj(ifile, f, READ_BLOCKSIZE)
+
+
     def download_data(self, remote_file):
         with open(self.__build_ls_path(remote_file, False), "r") as f:
             data = f.read()
@@ -23,31 +23,63 @@
 #   with this program. If not, see <http://www.gnu.org/licenses/>.
 # 
 ###############################################################################
+import collections
+import heapq
 import json
+import multiprocessing
 import os
+import random
 import time
 import traceback
 
 import chirribackup.chunk
 import chirribackup.compression
 import chirribackup.snapshot
+import chirribackup.workers
 from chirribackup.Logger import logger
 from chirribackup.exceptions import ChirriException, \
                                     ChunkNotFoundException, \
                                     ChunkBadFilenameException, \
                                     StorageTemporaryCommunicationException
 
+# CONSTANTS
+# chunks failing by temporary errors are retried up to SYNC_RETRIES times;
+# the n-th retry waits a random time between 0 and
+# min(SYNC_BACKOFF_MAX, SYNC_BACKOFF_BASE * 2^n) seconds
+SYNC_RETRIES      = 5
+SYNC_BACKOFF_BASE = 1.0
+SYNC_BACKOFF_MAX  = 60.0
+# compressed chunks waiting for upload (per upload worker)
+SYNC_COMPRESSED_BACKLOG = 2
+
+
+class MultiWriter(object):
+    """file-like object writing the same data to several file-like objects"""
+
+    outputs = None
+
+    def __init__(self, outputs):
+        self.outputs = outputs
+
+
+    def write(self, data):
+        for o in self.outputs:
+            o.write(data)
+
 
 class Syncer(object):
 
     ldb = None
     sm  = None
     counters = None
+    advisor  = None
+    released = None
 
     def __init__(self, ldb):
         self.ldb = ldb
         logger.debug("Initializing syncer")
         self.sm = self.ldb.get_storage_manager()
+        self.released = []
         self.counters = {
             "bytes"           : 0,
             "files"           : 0,
@@ -77,87 +109,164 @@ class Syncer(object):
                 if snp.status == 4:
                     # prepare snapshot for upload
                     snp.set_attribute("signed_tstamp", int(time.time()))
-                    desc = snp.desc_print()
-                    if snp.compression is None:
-                        if self.ldb.compression is not None:
-                            c = chirribackup.compression.Compressor(self.ldb.compression)
-                            zdesc = c.compress(desc)
-                            zdesc += c.close()
-                            if len(zdesc) < len(desc):
-                                snp.set_attribute("compression", self.ldb.compression)
-                                desc = zdesc
-                    else:
-                        c = chirribackup.compression.Compressor(snp.compression)
-                        desc = c.compress(desc)
-                        desc += c.close()
+                    desc_file, size = self.sync_snapshot_desc(snp)
 
                     # upload!
-                    self.sm.upload_data("snapshots/%s" % snp.get_filename(), desc)
+                    try:
+                        self.sm.upload_file("snapshots/%s" % snp.get_filename(), desc_file)
+                    finally:
+                        os.unlink(desc_file)
                     snp.set_status(5)
                     logger.info("[UPD] Snapshot %d" % snp.snapshot_id)
 
                     # update counters
-                    self.counters["bytes"]     += len(desc)
+                    self.counters["bytes"]     += size
                     self.counters["snapshots"] += 1
                     self.counters["files"]     += 1
 
             # commit on each operation
-            self.ldb.connection.commit()
-
-
-    def sync_chunk(self, chunk):
-        while True:
-            # get paths
-            local_chunk = os.path.realpath(os.path.join(self.ldb.chunks_dir, chunk.get_filename()))
-            remote_chunk = "chunks/%s" % chunk.get_filename()
-
-            if chunk.status == 0:
-                # try to compress chunk and confirm compression algorithm
-                if chunk.compress(self.ldb.compression):
-                    logger.info("%s: compressed with %s (%d => %d; ratio %.2f)" \
-                        % (chunk.hash_format(),
-                           chunk.compression,
-                           chunk.size,
-                           chunk.csize,
-                           (float(chunk.csize) / float(chunk.size)) \
-                            if chunk.size > 0 else float('NaN')))
-                chunk.set_status(1)
-                self.ldb.connection.commit()
-
-            elif chunk.status == 1:
-                # not uploaded chunk...
-                if chunk.refcount > 0:
-                    logger.info("%s: uploading" % chunk.hash_format())
-                    # referenced chunk, not uploaded => upload
-                    try:
-                        self.sm.upload_file(remote_chunk, local_chunk)
-                        chunk.set_status(2)
-                        # NOTE: this commit is important: sets file as uploaded, then
-                        # after the local chunk may be unlinked.
-                        self.ldb.connection.commit()
-                        os.unlink(local_chunk)
-                        self.counters["bytes"]  += chunk.size
-                        self.counters["chunks"] += 1
-                        self.counters["files"]  += 1
-                    except StorageTemporaryCommunicationException, ex:
-                        logger.error("Temporary error when uploading %s (%s): %s" \
-                                        % (chunk.hash_format(), chunk.first_seen_as, ex))
-                        return False
-                else:
-                    # not referenced chunk, not uploaded => local delete
-                    logger.info("%s: deleting not-referenced local chunk" % chunk.hash_format())
-                    os.unlink(local_chunk)
-                    chunk.destroy()
-                    self.ldb.connection.commit()
-
-            elif chunk.refcount == 0:
+            self.ldb.commit()
+
+
+    def sync_snapshot_desc(self, snp):
+        """writes the description of a snapshot in a temporary file, ready
+           for upload, and returns a tuple (file, size). The description is
+           compressed while it is written, and it is kept uncompressed if
+           compression does not reduce its size (then the plain copy, written
+           at the same time, is used)"""
+        desc_file = os.path.join(self.ldb.chunks_dir, "snapshot-%d.tmp" % snp.snapshot_id)
+        compression = snp.compression if snp.compression is not None else self.ldb.compression
+        # NOTE: the format (like compression) is kept on later uploads, so
+        # the file name does not change
+        desc_format = snp.desc_format if snp.desc_format is not None else self.ldb.snapshot_desc_format
+        if desc_format is None:
+            desc_format = "txt"
+        snp.set_attribute("desc_format", desc_format)
+        if compression is None:
+            with open(desc_file, "wb") as ofile:
+                snp.desc_write(ofile, desc_format)
+            return (desc_file, os.path.getsize(desc_file))
+
+        # snapshots compressed previously are always compressed
+        zdesc_file = desc_file + ".z"
+        c = chirribackup.compression.Compressor(compression, zdesc_file)
+        try:
+            if snp.compression is not None:
+                snp.desc_write(c, desc_format)
+                c.close()
+            else:
+                with open(desc_file, "wb") as ofile:
+                    snp.desc_write(MultiWriter([ ofile, c ]), desc_format)
+                c.close()
+                if c.bytes_out >= c.bytes_in:
+                    os.unlink(zdesc_file)
+                    return (desc_file, c.bytes_in)
+                snp.set_attribute("compression", compression)
+                os.unlink(desc_file)
+            os.rename(zdesc_file, desc_file)
+            return (desc_file, c.bytes_out)
+
+        except:
+            c.close()
+            for f in [ desc_file, zdesc_file ]:
+                if os.path.exists(f):
+                    os.unlink(f)
+            raise
+
+
+    def sync_chunk_compress(self, chunk, compression):
+        """compresses a chunk into a temporary file (it runs in the worker
+           threads, see Chunk.compress_stage())"""
+        return chunk.compress_stage(compression, self.advisor)
+
+
+    def sync_chunk_compressed(self, chunk, staged):
+        """confirms the compression algorithm of a chunk compressed by
+           sync_chunk_compress(). The chunk becomes ready for upload"""
+        if staged is not None and chunk.compress_commit(staged):
+            logger.info("%s: compressed with %s (%d => %d; ratio %.2f)" \
+                % (chunk.hash_format(),
+                   chunk.compression,
+                   chunk.size,
+                   chunk.csize,
+                   (float(chunk.csize) / float(chunk.size)) \
+                    if chunk.size > 0 else float('NaN')))
+        chunk.set_status(1)
+        if self.advisor is not None:
+            self.advisor.flush()
+        self.ldb.maybe_commit()
+
+
+    def sync_chunk_forget(self, chunk):
+        """deletes a not referenced and not uploaded chunk. Parts released
+           by it (if it is a manifest) are forgotten too, or kept in
+           'released' if they are uploaded"""
+        logger.info("%s: deleting not-referenced local chunk" % chunk.hash_format())
+        local_chunk = os.path.realpath(os.path.join(self.ldb.chunks_dir, chunk.get_filename()))
+        released = chunk.destroy()
+        self.ldb.unlink_on_commit(local_chunk)
+        for part in released:
+            if part.status == 2:
+                self.released.append(part)
+            else:
+                self.sync_chunk_forget(part)
+        self.ldb.maybe_commit()
+
+
+    def sync_chunk_transfer(self, chunk):
+        """uploads (or deletes) a chunk without touching the database (it
+           runs in the worker threads). Returns a dict with the work done,
+           which is applied by sync_chunk_apply()"""
+        r = {
+            "uploaded" : False,
+            "deleted"  : False,
+            "error"    : None,
+        }
+        try:
+            if chunk.status == 1 and chunk.refcount > 0:
+                # referenced chunk, not uploaded => upload
+                logger.info("%s: uploading" % chunk.hash_format())
+                self.sm.upload_file(
+                        "chunks/%s" % chunk.get_filename(),
+                        os.path.realpath(os.path.join(self.ldb.chunks_dir, chunk.get_filename())))
+                r["uploaded"] = True
+
+            elif chunk.status == 2 and chunk.refcount == 0:
                 # uploaded chunk not referenced => delete from server
                 logger.warning("%s: deleting not-referenced REMOTE chunk" % chunk.hash_format())
-                self.sm.delete_file(remote_chunk)
-                chunk.destroy()
-            else:
-                # optimization: avoids execution of a meaningless commit
-                return True
+                self.sm.delete_file("chunks/%s" % chunk.get_filename())
+                r["deleted"] = True
+
+        except StorageTemporaryCommunicationException, ex:
+            r["error"] = ex
+
+        return r
+
+
+    def sync_chunk_apply(self, chunk, r):
+        """applies in the database the work done by sync_chunk_transfer().
+           Returns False if the chunk must be retried later"""
+        if r["uploaded"]:
+            chunk.set_status(2)
+            # NOTE: the local chunk is unlinked only after the commit that
+            # sets the file as uploaded.
+            self.ldb.unlink_on_commit(
+                os.path.realpath(os.path.join(self.ldb.chunks_dir, chunk.get_filename())))
+            self.ldb.maybe_commit()
+            self.counters["bytes"]  += chunk.size
+            self.counters["chunks"] += 1
+            self.counters["files"]  += 1
+
+        elif r["deleted"]:
+            # parts released by a manifest are deleted in this same sync
+            # (see sync_chunks())
+            self.released.extend(chunk.destroy())
+            self.ldb.commit()
+
+        if r["error"] is not None:
+            logger.error("Temporary error when uploading %s (%s): %s" \
+                            % (chunk.hash_format(), chunk.first_seen_as, r["error"]))
+            return False
 
         return True
 
@@ -165,31 +274,140 @@ class Syncer(object):
     def sync_chunks(self):
         logger.info("Syncing chunks")
 
-        # build list of chunks not uploaded yet
-        try_list = []
+        # build lists of chunks to compress and chunks to upload (or
+        # uploaded chunks that are not referenced anymore). Chunks not
+        # referenced and not uploaded are deleted right now.
+        # NOTE: not referenced chunks are forgotten first, because
+        # forgotten manifests release their parts.
+        for chunk in chirribackup.chunk.Chunk.list(self.ldb, status = 1, refcount = 0) \
+                   + chirribackup.chunk.Chunk.list(self.ldb, status = 0, refcount = 0):
+            self.sync_chunk_forget(chunk)
+        self.released = []
+        compress_queue = collections.deque()
+        upload_queue = collections.deque()
         for chunk in chirribackup.chunk.Chunk.list(self.ldb, status = 1) \
-                   + chirribackup.chunk.Chunk.list(self.ldb, status = 0):
-            try_list.append([ chunk, 0 ])
-
-        # try to upload files
-        while len(try_list) > 0:
-            try_item = try_list.pop(0)
-
-            logger.info("%s: Uploading (try %d) (%s):" \
-                            % (try_item[0].hash_format(),
-                               try_item[1],
-                               try_item[0].first_seen_as))
+                   + chirribackup.chunk.Chunk.list(self.ldb, status = 0) \
+                   + chirribackup.chunk.Chunk.list(self.ldb, status = 2, refcount = 0):
+            if chunk.status == 0:
+                compress_queue.append(chunk)
+            else:
+                upload_queue.append((chunk, 0))
+
+        # sync is a pipeline: up to 'compress_jobs' workers compress chunks
+        # while up to 'upload_jobs' workers upload them. This thread applies
+        # the results in the database. Compressed chunks wait for upload in
+        # a bounded queue (so compression does not run far ahead of uploads
+        # filling the local disk), and are uploaded before other chunks.
+        # Chunks failing by temporary errors are retried after an
+        # exponential backoff (with full jitter, so retries do not hit the
+        # server at once).
+        compression = self.ldb.compression
+        if compression is not None and self.ldb.compression_sampling:
+            self.advisor = chirribackup.compression.CompressionAdvisor(self.ldb)
+        compress_jobs = self.ldb.compress_jobs
+        if compress_jobs is None or compress_jobs == 0:
+            compress_jobs = multiprocessing.cpu_count()
+        upload_jobs = self.ldb.sync_jobs
+        if upload_jobs is None or upload_jobs == 0:
+            upload_jobs = self.sm.sync_jobs
+        compressed_max = max(compress_jobs, upload_jobs * SYNC_COMPRESSED_BACKLOG)
+        logger.debug("Syncing chunks using %d compression and %d upload workers" \
+                        % (compress_jobs, upload_jobs))
+
+        pool = chirribackup.workers.WorkerPool(compress_jobs + upload_jobs)
+        pool.start(lambda job: \
+                    self.sync_chunk_compress(job[1], compression) if job[0] == "compress" \
+                    else self.sync_chunk_transfer(job[1]))
+        compressed_queue = collections.deque()
+        forgotten = []
+        compressing = 0
+        uploading = 0
+        delayed = []
+        try:
+            while len(compress_queue) > 0 \
+            or len(compressed_queue) > 0 \
+            or len(upload_queue) > 0 \
+            or len(delayed) > 0 \
+            or pool.pending > 0:
+                # requeue chunks whose backoff has expired
+                now = time.time()
+                while len(delayed) > 0 and delayed[0][0] <= now:
+                    when, h, chunk, tries = heapq.heappop(delayed)
+                    upload_queue.append((chunk, tries))
+
+                # feed compression workers
+                while len(compress_queue) > 0 \
+                and compressing < compress_jobs \
+                and compressing + len(compressed_queue) < compressed_max:
+                    pool.put(("compress", compress_queue.popleft(), 0))
+                    compressing += 1
+
+                # feed upload workers (compressed chunks first)
+                while uploading < upload_jobs \
+                and (len(compressed_queue) > 0 or len(upload_queue) > 0):
+                    if len(compressed_queue) > 0:
+                        chunk, tries = compressed_queue.popleft()
+                    else:
+                        chunk, tries = upload_queue.popleft()
+                    logger.info("%s: Syncing (try %d) (%s)" \
+                                    % (chunk.hash_format(), tries, chunk.first_seen_as))
+                    pool.put(("upload", chunk, tries))
+                    uploading += 1
+
+                # wait for next finished job (or next retry)
+                timeout = max(0.0, delayed[0][0] - now) if len(delayed) > 0 else None
+                if pool.pending == 0:
+                    time.sleep(timeout)
+                    continue
+                r = pool.get(timeout)
+                if r is None:
+                    continue
+                seq, (op, chunk, tries), result, ex = r
+                if op == "compress":
+                    compressing -= 1
+                else:
+                    uploading -= 1
+                if ex is not None:
+                    raise ex
+
+                if op == "compress":
+                    self.sync_chunk_compressed(chunk, result)
+                    compressed_queue.append((chunk, 0))
+
+                elif not self.sync_chunk_apply(chunk, result):
+                    tries += 1
+                    if tries > SYNC_RETRIES:
+                        logger.error("%s: After %d retries, cancelling upload." \
+                                        % (chunk.hash_format(), SYNC_RETRIES))
+                    else:
+                        delay = random.uniform(0, min(SYNC_BACKOFF_MAX, SYNC_BACKOFF_BASE * 2 ** tries))
+                        logger.warning("%s: Upload cancelled by temporary error -- I will retry in %.1f seconds" \
+                                        % (chunk.hash_format(), delay))
+                        heapq.heappush(delayed, (time.time() + delay, chunk.hash, chunk, tries))
+
+                # parts released by deleted manifests: uploaded parts are
+                # deleted from the server now, local parts (that could be
+                # in the queues) are forgotten when the pipeline finishes
+                while len(self.released) > 0:
+                    part = self.released.pop()
+                    if part.status == 2:
+                        upload_queue.append((part, 0))
+                    else:
+                        forgotten.append(part)
+        finally:
+            pool.stop()
 
-            if not self.sync_chunk(try_item[0]):
-                try_item[1] += 1
+        for part in forgotten:
+            try:
+                part = chirribackup.chunk.Chunk(self.ldb, part.hash)
+            except ChunkNotFoundException:
+                continue
+            if part.status != 2 and part.refcount == 0:
+                self.sync_chunk_forget(part)
 
-                if try_item[1] > 5:
-                    logger.error("%s: After 5 retries, cancelling upload." \
-                                    % try_item[0].hash_format())
-                else:
-                    logger.warning("%s: Upload cancelled by temporary error -- I will retry later" \
-                                    % try_item[0].hash_format())
-                    try_list.append(try_item)
+        # commit uploads (and run pending unlinks) before looking for
+        # forgotten chunks
+        self.ldb.commit()
 
         # delete forgotten chunks in disk
         for fname in os.listdir(os.path.realpath(self.ldb.chunks_dir)):
@@ -197,8 +415,8 @@ class Syncer(object):
                 cbi = chirribackup.chunk.Chunk.parse_filename(fname)
                 c = chirribackup.chunk.Chunk(self.ldb, cbi["hash"])
 
-                if c.status == 1:
-                    # this local chunk should not exist
+                if c.status == 2:
+                    # this local chunk is already uploaded, it should not exist
                     logger.warning("[LDL] Unlinking forgotten local chunk %s." % c.hash_format())
                     os.unlink(os.path.join(self.ldb.chunks_dir, c.get_filename()))
 
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# chirribackup/walker.py
+#
+#   Iterative filesystem walker. It uses scandir (os.scandir or the scandir
+#   backport) when available, so directory entry types are known without
+#   extra syscalls. It never follows symlinks.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import stat
+
+from chirribackup.Logger import logger
+
+# scandir is part of os since python 3.5; for older versions try the
+# backport, and if it is not installed fall back to os.listdir()
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+        logger.debug("scandir not available -- using os.listdir()")
+
+
+def walk(base, target_path = "", prune = None):
+    """generator that yields a tuple (rel_path, abs_path, statinfo) for
+       'target_path' (relative to 'base', "" means 'base' itself, which is
+       not yielded) and every file under it. Statinfo is the lstat() of the
+       entry. If 'prune' is declared and prune(rel_path, is_dir) returns
+       True, the entry (and its contents) is ignored"""
+    # 'base' is joined only once, so paths are built by concatenation
+    base = os.path.join(base, "")
+
+    # target_path itself
+    if target_path != "":
+        if prune is not None and prune(target_path, None):
+            return
+        abs_path = base + target_path
+        statinfo = os.lstat(abs_path)
+        yield target_path, abs_path, statinfo
+        if not stat.S_ISDIR(statinfo.st_mode):
+            return
+
+    # explicit stack of directories to process
+    stack = [ target_path ]
+    while len(stack) > 0:
+        dir_path = stack.pop()
+        rel_prefix = os.path.join(dir_path, "") if dir_path != "" else ""
+        abs_prefix = base + rel_prefix
+
+        if scandir is not None:
+            for entry in scandir(abs_prefix):
+                rel_path = rel_prefix + entry.name
+                is_dir = entry.is_dir(follow_symlinks = False)
+                if prune is not None and prune(rel_path, is_dir):
+                    continue
+                yield rel_path, entry.path, entry.stat(follow_symlinks = False)
+                if is_dir:
+                    stack.append(rel_path)
+        else:
+            for name in os.listdir(abs_prefix):
+                rel_path = rel_prefix + name
+                abs_path = abs_prefix + name
+                statinfo = os.lstat(abs_path)
+                is_dir = stat.S_ISDIR(statinfo.st_mode)
+                if prune is not None and prune(rel_path, is_dir):
+                    continue
+                yield rel_path, abs_path, statinfo
+                if is_dir:
+                    stack.append(rel_path)
+
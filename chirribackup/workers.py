@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# chirribackup/workers.py
+#
+#   Tiny pool of worker threads. It is used for running the CPU and I/O
+#   bound parts of the hashing and syncing (sha512, compression, file reads
+#   and network transfers release the GIL), while the main thread keeps
+#   being the only writer of the database.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import Queue
+import multiprocessing
+import threading
+
+from chirribackup.exceptions import ChirriException, BadValueException
+
+
+class WorkerPool(object):
+    """Runs a function over a list of items using several threads"""
+
+    jobs    = None
+    backlog = None
+    pending = 0
+    qin     = None
+    qout    = None
+    seq     = 0
+    threads = None
+
+    def __init__(self, jobs = None, backlog = None):
+        if jobs is None or jobs == 0:
+            jobs = multiprocessing.cpu_count()
+        jobs = int(jobs)
+        if jobs < 1:
+            raise BadValueException("Bad number of jobs %d." % jobs)
+        self.jobs = jobs
+        self.backlog = int(backlog) if backlog is not None else jobs * 4
+
+
+    def __worker(self, func, qin, qout):
+        while True:
+            job = qin.get()
+            if job is None:
+                return
+            seq, item = job
+            try:
+                qout.put((seq, item, func(item), None))
+            except Exception, ex:
+                qout.put((seq, item, None, ex))
+
+
+    def start(self, func):
+        """starts the worker threads, which will run 'func' over each item
+           sent with put()"""
+        if self.threads is not None:
+            raise ChirriException("Worker pool already started.")
+        self.qin = Queue.Queue()
+        self.qout = Queue.Queue()
+        self.pending = 0
+        self.seq = 0
+        self.threads = []
+        for i in range(0, self.jobs):
+            t = threading.Thread(target = self.__worker, args = (func, self.qin, self.qout))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+
+    def put(self, item):
+        """queues 'item' and returns its sequence number"""
+        seq = self.seq
+        self.qin.put((seq, item))
+        self.seq += 1
+        self.pending += 1
+        return seq
+
+
+    def full(self):
+        return self.pending >= self.backlog
+
+
+    def get(self, timeout = None):
+        """waits for the next finished item (in completion order) and returns
+           a tuple (seq, item, result, exception), or None if 'timeout'
+           seconds elapse first"""
+        try:
+            r = self.qout.get(True, timeout) if timeout is not None else self.qout.get()
+        except Queue.Empty:
+            return None
+        self.pending -= 1
+        return r
+
+
+    def stop(self):
+        """forgets queued items and stops the worker threads (items being
+           processed are waited for, but their results are dropped)"""
+        if self.threads is None:
+            return
+        try:
+            while True:
+                self.qin.get_nowait()
+        except Queue.Empty:
+            pass
+        for t in self.threads:
+            self.qin.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = None
+        self.pending = 0
+
+
+    def imap(self, func, iterable):
+        """generator that yields a tuple (item, result, exception) for each
+           item in 'iterable', in the same order. No more than 'backlog'
+           items are pending at the same time"""
+        self.start(func)
+        try:
+            it = iter(iterable)
+            done = 0
+            ready = {}
+            exhausted = False
+            while True:
+                # feed workers
+                while not exhausted and self.seq - done < self.backlog:
+                    try:
+                        item = it.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    self.put(item)
+                if done >= self.seq:
+                    break
+
+                # wait for next result (in order)
+                while done not in ready:
+                    seq, item, result, ex = self.get()
+                    ready[seq] = (item, result, ex)
+                r = ready.pop(done)
+                done += 1
+                yield r
+
+        finally:
+            # forget pending jobs and stop workers
+            self.stop()
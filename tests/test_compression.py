@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/test_compression.py
+#
+#   Compression advisor decisions.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import random
+import unittest
+
+import chirribackup.compression
+from chirribackup.exceptions import BadCompressionException
+
+from testlib import DbTestCase
+
+
+class CompressionAdvisorTest(DbTestCase):
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+
+    def test_incompressible_type(self):
+        advisor = chirribackup.compression.CompressionAdvisor(self.ldb)
+        size = chirribackup.compression.SAMPLE_MIN_SIZE
+        rnd = self.write("rnd.bin", os.urandom(size))
+        txt = self.write("txt.log", "hello world\n" * (size / 12))
+
+        # compressible
+        self.assertIsNotNone(advisor.check(txt, "x/txt.log", "zlib", size))
+
+        # not compressible, learned after a few samples
+        self.assertIsNone(advisor.predict("zlib", [ "ext:.bin" ]))
+        for i in range(0, chirribackup.compression.STATS_MIN_SAMPLES):
+            self.assertIsNone(advisor.check(rnd, "x/rnd%d.bin" % i, "zlib", size))
+        self.assertGreaterEqual(advisor.predict("zlib", [ "ext:.bin" ]),
+                                chirribackup.compression.SAMPLE_MAX_RATIO)
+
+        # learned ratios are saved in the database
+        advisor.flush()
+        advisor = chirribackup.compression.CompressionAdvisor(self.ldb)
+        self.assertGreaterEqual(advisor.predict("zlib", [ "ext:.bin" ]),
+                                chirribackup.compression.SAMPLE_MAX_RATIO)
+
+
+    def test_incompressible_type_is_sampled_again(self):
+        advisor = chirribackup.compression.CompressionAdvisor(self.ldb)
+        size = chirribackup.compression.SAMPLE_MIN_SIZE
+
+        # learn that '.log' files do not compress
+        rnd = self.write("rnd.log", os.urandom(size))
+        for i in range(0, chirribackup.compression.STATS_MIN_SAMPLES):
+            self.assertIsNone(advisor.check(rnd, "x/rnd%d.log" % i, "zlib", size))
+        self.assertGreaterEqual(advisor.predict("zlib", [ "ext:.log" ]),
+                                chirribackup.compression.SAMPLE_MAX_RATIO)
+
+        # but most of them compress well: the decision is undone
+        txt = self.write("txt.log", "hello world\n" * (size / 12))
+        compressed = 0
+        for i in range(0, chirribackup.compression.STATS_RESAMPLE * 10):
+            keys = advisor.check(txt, "x/txt%d.log" % i, "zlib", size)
+            if keys is not None:
+                compressed += 1
+                advisor.record("zlib", keys, size, size / 100)
+        self.assertLess(advisor.predict("zlib", [ "ext:.log" ]),
+                        chirribackup.compression.SAMPLE_MAX_RATIO)
+        self.assertGreater(compressed, chirribackup.compression.STATS_RESAMPLE * 5)
+
+
+    def text(self, size):
+        """compressible data (not trivially compressible, so each codec
+           achieves a different ratio)"""
+        rnd = random.Random(size)
+        words = [ "".join([ chr(rnd.randint(97, 122)) for i in range(0, 6) ])
+                    for j in range(0, 500) ]
+        data = ""
+        while len(data) < size:
+            data += " ".join([ rnd.choice(words) for i in range(0, 1000) ]) + "\n"
+        return data[:size]
+
+
+    def test_select(self):
+        size = chirribackup.compression.SAMPLE_MIN_SIZE
+        txt = self.write("txt.log", self.text(size))
+        rnd = self.write("rnd.bin", os.urandom(size))
+        small = self.write("small.log", self.text(size / 2))
+
+        # without candidates, the configured algorithm is used
+        advisor = chirribackup.compression.CompressionAdvisor(self.ldb)
+        self.assertEqual(advisor.select(txt, "txt.log", "lz4", size)[0], "lz4")
+
+        self.ldb.compression_candidates = "lzma, zlib"
+        advisor = chirribackup.compression.CompressionAdvisor(self.ldb)
+        self.assertEqual(advisor.candidates, [ "lzma", "zlib" ])
+        max_loss = chirribackup.compression.SELECT_MAX_LOSS
+        try:
+            # best ratio
+            chirribackup.compression.SELECT_MAX_LOSS = 0.0
+            self.assertEqual(advisor.select(txt, "txt.log", "lz4", size)[0], "lzma")
+        finally:
+            chirribackup.compression.SELECT_MAX_LOSS = max_loss
+
+        # not worth compressing, or too small for sampling
+        self.assertIsNone(advisor.select(rnd, "rnd.bin", "lz4", size))
+        self.assertEqual(advisor.select(small, "small.log", "lz4", size / 2)[0], "lz4")
+
+        self.ldb.compression_candidates = "lzma,nope"
+        self.assertRaises(BadCompressionException,
+                          chirribackup.compression.CompressionAdvisor, self.ldb)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/test_desc.py
+#
+#   Snapshot descriptions: written by a snapshot and loaded in a rebuilt
+#   database (as 'db rebuild' does) in each format.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import StringIO
+import unittest
+
+import chirribackup.bindesc
+import chirribackup.chunk
+import chirribackup.snapshot
+from chirribackup.exceptions import BadSnapshotDescException
+
+from testlib import DbTestCase, fake_hash
+
+
+# paths are stored as the bytes returned by the filesystem
+PATHS = [
+    "ascii.txt",
+    "caf\xc3\xa9.txt",                      # UTF-8
+    "caf\xe9.txt",                          # latin-1 (not valid UTF-8)
+    "dir \xe9t\xe9",
+    "dir \xe9t\xe9/semi;colon \"quoted\"",
+    "dir \xe9t\xe9/\xff\xfe",
+]
+
+
+class DescRoundTripTest(DbTestCase):
+
+    def setUp(self):
+        super(DescRoundTripTest, self).setUp()
+        for path in PATHS:
+            target = os.path.join(self.ldb.db_path, path)
+            if path.startswith("dir ") and "/" not in path:
+                os.mkdir(target)
+            else:
+                with open(target, "wb") as f:
+                    f.write("data of %r\n" % path)
+        os.symlink("caf\xe9.txt", os.path.join(self.ldb.db_path, "link \xe9"))
+        self.snp = chirribackup.snapshot.Snapshot(self.ldb)
+        self.snp.new()
+        self.snp.run()
+
+
+    def refs(self, snp):
+        return [ dict(r) for r in snp.refs(
+                    columns = [ "hash", "size", "perm", "uid", "gid", "mtime", "status" ]) ]
+
+
+    def round_trip(self, output_format):
+        desc = StringIO.StringIO()
+        self.snp.desc_write(desc, output_format)
+
+        # rebuilt database (chunks are found first in the remote listing)
+        ldb = self.new_ldb("rebuilt-%s" % output_format)
+        ldb.status = 1
+        for c in self.ldb.connection.execute("SELECT * FROM file_data"):
+            chirribackup.chunk.Chunk.insert(ldb, c["hash"], c["size"], c["csize"],
+                                            None, 2, 0, c["compression"])
+        snp = chirribackup.snapshot.Snapshot(ldb)
+        snp.new(snapshot_id = self.snp.snapshot_id)
+        snp.set_status(-1, False)
+        desc.seek(0)
+        snp.desc_load(desc)
+
+        self.assertEqual(self.refs(snp), self.refs(self.snp))
+        self.assertEqual(
+            sorted([ r["path"] for r in self.refs(snp) if r["path"] != "" ]),
+            sorted(PATHS + [ "link \xe9" ]))
+        ldb.connection.close()
+
+
+    def test_txt(self):
+        self.round_trip("txt")
+
+
+    def test_bin(self):
+        self.round_trip("bin")
+
+
+class BinDescTest(unittest.TestCase):
+
+    refs = [ {
+        "path"       : path,
+        "hash"       : fake_hash(path),
+        "hash_index" : 1,
+        "size"       : len(path),
+        "perm"       : 0644,
+        "uid"        : 1000,
+        "gid"        : 1000,
+        "mtime"      : 1460000000 + i,
+        "status"     : 1,
+    } for i, path in enumerate(sorted(PATHS)) ]
+
+
+    def write(self):
+        f = StringIO.StringIO()
+        w = chirribackup.bindesc.BinDescWriter(f)
+        w.write_details(1, 1460000000, 1460000001, None)
+        w.write_hashes(2, [ None, fake_hash("x") ])
+        w.write_refs(len(self.refs), self.refs)
+        w.close()
+        return f.getvalue()
+
+
+    def read(self, data):
+        r = chirribackup.bindesc.BinDescReader(StringIO.StringIO(data))
+        return r, list(r.refs())
+
+
+    def test_round_trip(self):
+        r, refs = self.read(self.write())
+        self.assertEqual(r.details["snapshot"], 1)
+        self.assertEqual(r.details["signed_tstamp"], None)
+        self.assertEqual([ x["path"] for x in refs ], [ x["path"] for x in self.refs ])
+        for x in refs:
+            self.assertTrue(isinstance(x["path"], str))
+            self.assertEqual(x["hash"], fake_hash("x"))
+
+
+    def test_corrupted(self):
+        data = self.write()
+        data = data[:-100] + chr(ord(data[-100]) ^ 1) + data[-99:]
+        self.assertRaises(BadSnapshotDescException, self.read, data)
+        self.assertRaises(BadSnapshotDescException, self.read, data[:-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
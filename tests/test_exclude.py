@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/test_exclude.py
+#
+#   ExcludeMatcher must exclude exactly the same paths as the old loop that
+#   compiled and tried each rule alone.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import fnmatch
+import re
+import unittest
+
+import chirribackup.exclude
+
+
+def rule_by_rule(rules):
+    """old matcher: every rule compiled (and tried) alone"""
+    xl = []
+    for exclude, expr_type, ignore_case in rules:
+        if expr_type > 0:
+            if expr_type == 1:
+                exclude = fnmatch.translate(exclude)
+                if exclude.startswith("\\/"):
+                    exclude = "^" + exclude[2:]
+                else:
+                    exclude = "(\\A|\\/)" + exclude
+            exclude = re.compile(exclude, re.IGNORECASE if ignore_case else 0)
+        xl.append(exclude)
+
+    def match(path):
+        for x in xl:
+            if isinstance(x, basestring):
+                if path == x:
+                    return True
+            elif x.search(path) is not None:
+                return True
+        return False
+
+    return match
+
+
+PATHS = [
+    "a.txt", "src/main.c", "src/main.o", "src/lib/util.pyc", "build/out.o",
+    "doc/build/index.html", "node_modules/x/index.js", "x/node_modules",
+    "Photos/IMG_0001.JPG", "photos/img_0002.jpg", "tmp", "tmp/cache/a",
+    "logs/2016-01-01.log", "logs/old/2015-12-31.log", "foo/bar/baz",
+    "foobar", "a/b/c/d.tar.gz", "release-1.2.3.zip", "abab/abab",
+]
+
+RULES = [
+    ("a.txt",                   "literal",  0),
+    ("node_modules",            "wildcard", 0),
+    ("*.pyc",                   "wildcard", 0),
+    ("*.jpg",                   "wildcard", 1),
+    ("/build/*.o",              "wildcard", 0),
+    ("t?p",                     "wildcard", 0),
+    ("^logs/old/",              "re",       0),
+    (r"\d{4}-\d{2}-\d{2}\.log", "re",       0),
+    (r"(?P<v>\d+)\.(?P=v)",     "re",       0),
+    (r"(?P<v>\d+)\.zip$",       "re",       0),
+    (r"(?P<v>ba)z$",            "re",       0),
+    (r"^(ab)\1/",               "re",       0),
+    (r"(?i)^FOO/",              "re",       0),
+    (r"(a)?(?(1)b|c)\.gz$",     "re",       0),
+]
+
+
+class ExcludeMatcherTest(unittest.TestCase):
+
+    def check(self, rules):
+        m = chirribackup.exclude.ExcludeMatcher()
+        for exclude, expr_type, ignore_case in rules:
+            m.add(exclude, expr_type, ignore_case)
+        old = rule_by_rule([ (x, chirribackup.exclude.Exclude.parse_expr_type(t), ic)
+                                for x, t, ic in rules ])
+        for path in PATHS:
+            self.assertEqual(m.match(path), old(path), "path '%s'" % path)
+        return m
+
+    def test_rules_alone(self):
+        for rule in RULES:
+            self.check([ rule ])
+
+    def test_rules_joined(self):
+        m = self.check(RULES)
+        self.assertTrue(m.match("release-1.2.3.zip"))
+        self.assertFalse(m.match("src/main.c"))
+
+    def test_same_named_group(self):
+        # each rule defines group 'v', so they cannot share a regex
+        m = self.check([ (r"(?P<v>\d+)\.zip$", "re", 0),
+                         (r"(?P<v>ba)z$",      "re", 0) ])
+        self.assertTrue(m.match("foo/bar/baz"))
+
+    def test_many_groups(self):
+        # more groups than python 2 supports in a single regex
+        self.check([ (r"(x)(y)%d$" % i, "re", 0) for i in range(0, 200) ])
+
+    def test_match_tree(self):
+        m = self.check(RULES)
+        self.assertTrue(m.match_tree("x/node_modules/y/z.js"))
+        self.assertFalse(m.match_tree("src/lib/util.py"))
+
+
+if __name__ == "__main__":
+    unittest.main()
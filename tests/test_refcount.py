@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/test_refcount.py
+#
+#   Chunk refcount changes applied in bulk (RefcountBatch), and manifests
+#   referencing (and releasing) their parts.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import unittest
+
+import chirribackup.cdc
+import chirribackup.chunk
+import chirribackup.snapshot
+from chirribackup.exceptions import ChirriException
+
+from testlib import DbTestCase, fake_hash
+
+
+class RefcountBatchTest(DbTestCase):
+
+    def setUp(self):
+        super(RefcountBatchTest, self).setUp()
+        self.hashes = [ fake_hash(i) for i in range(0, 4) ]
+        for h in self.hashes:
+            chirribackup.chunk.Chunk.insert(self.ldb, h, 10, 10, "f", 0, 1, None)
+
+
+    def refcount(self, h):
+        return chirribackup.chunk.Chunk(self.ldb, h).refcount
+
+
+    def test_flush(self):
+        b = chirribackup.chunk.RefcountBatch(self.ldb)
+        b.inc(self.hashes[0])
+        b.inc(self.hashes[0])
+        b.dec(self.hashes[1])
+        b.add_query("SELECT hash, 5 FROM file_data WHERE hash = :h",
+                    { "h" : self.hashes[2] })
+        b.inc(self.hashes[2])
+        self.assertEqual(b.flush(), {})
+        self.assertEqual([ self.refcount(h) for h in self.hashes ], [ 3, 0, 7, 1 ])
+
+        # nothing pending
+        self.assertEqual(b.flush(), {})
+        self.assertEqual([ self.refcount(h) for h in self.hashes ], [ 3, 0, 7, 1 ])
+
+
+    def test_missing(self):
+        b = chirribackup.chunk.RefcountBatch(self.ldb)
+        b.inc(fake_hash("unknown"))
+        b.inc(fake_hash("unknown"))
+        b.inc(self.hashes[0])
+        self.assertEqual(b.flush(), { fake_hash("unknown") : 2 })
+        self.assertEqual(self.refcount(self.hashes[0]), 2)
+
+
+    def test_negative(self):
+        b = chirribackup.chunk.RefcountBatch(self.ldb)
+        b.dec(self.hashes[0])
+        b.dec(self.hashes[0])
+        self.assertRaises(ChirriException, b.flush)
+
+        # failed changes are not flushed again
+        b.inc(self.hashes[1])
+        b.flush()
+        self.assertEqual(self.refcount(self.hashes[1]), 2)
+
+
+    def test_batches_do_not_mix(self):
+        a = chirribackup.chunk.RefcountBatch(self.ldb)
+        b = chirribackup.chunk.RefcountBatch(self.ldb)
+        a.add_query("SELECT hash, 1 FROM file_data", {})
+        b.add_query("SELECT hash, 2 FROM file_data WHERE hash = :h",
+                    { "h" : self.hashes[0] })
+        b.flush()
+        self.assertEqual([ self.refcount(h) for h in self.hashes ], [ 3, 1, 1, 1 ])
+        a.flush()
+        self.assertEqual([ self.refcount(h) for h in self.hashes ], [ 4, 2, 2, 2 ])
+
+
+    def test_snapshot_without_changes(self):
+        # read-only snapshots do not touch the database
+        changes = self.ldb.connection.total_changes
+        chirribackup.snapshot.Snapshot(self.ldb).refcounts.flush()
+        self.assertEqual(self.ldb.connection.total_changes, changes)
+
+
+class ManifestRefcountTest(DbTestCase):
+
+    def test_register_and_destroy(self):
+        parts = [ fake_hash(i) for i in range(0, 3) ]
+        for h in parts:
+            chirribackup.chunk.Chunk.insert(self.ldb, h, 10, 10, "f", 0, 0, None)
+        chirribackup.chunk.Chunk(self.ldb, parts[2]).refcount_inc()
+
+        manifest = chirribackup.cdc.Manifest()
+        for h in parts + [ parts[0] ]:
+            manifest.append(h, 10)
+        chirribackup.chunk.Chunk.insert(self.ldb, fake_hash("m"), 10, 10, "f", 0, 1, None)
+        m = chirribackup.chunk.Chunk(self.ldb, fake_hash("m"))
+        self.assertTrue(m.manifest_register(manifest))
+        self.assertFalse(m.manifest_register(manifest))
+        self.assertEqual([ chirribackup.chunk.Chunk(self.ldb, h).refcount for h in parts ],
+                         [ 2, 1, 2 ])
+
+        # parts only referenced by the manifest are released
+        released = m.destroy()
+        self.assertEqual(sorted([ c.hash for c in released ]), sorted(parts[0:2]))
+        self.assertEqual(chirribackup.chunk.Chunk(self.ldb, parts[2]).refcount, 1)
+        self.assertEqual(self.ldb.connection.execute(
+                            "SELECT COUNT(*) FROM file_chunks").fetchone()[0], 0)
+
+
+    def test_register_missing_part(self):
+        manifest = chirribackup.cdc.Manifest()
+        manifest.append(fake_hash("missing"), 10)
+        chirribackup.chunk.Chunk.insert(self.ldb, fake_hash("m"), 10, 10, "f", 0, 1, None)
+        m = chirribackup.chunk.Chunk(self.ldb, fake_hash("m"))
+        self.assertRaises(ChirriException, m.manifest_register, manifest)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/test_restore.py
+#
+#   Snapshot restore, and restores resumed using the restore journal.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import random
+import stat
+import unittest
+
+import chirribackup.snapshot
+import chirribackup.syncer
+from chirribackup.exceptions import ChirriException
+
+from testlib import DbTestCase
+
+
+def random_data(size):
+    rnd = random.Random(size)
+    return "".join([ chr(rnd.randint(0, 255)) for i in xrange(0, size) ])
+
+
+class RestoreTest(DbTestCase):
+
+    files = {
+        "a.txt"           : "hello\n",
+        "sub/b.txt"       : "hello\n",
+        "sub/c.txt"       : "bye\n" * 1000,
+        # big enough to be split in content defined chunks
+        "sub/deep/big.bin": random_data(300000),
+    }
+    # same contents, different attributes
+    modes = {
+        "a.txt"           : 0644,
+        "sub/b.txt"       : 0600,
+    }
+
+    def setUp(self):
+        super(RestoreTest, self).setUp()
+        self.ldb.cdc_min_file_size = 100000
+        self.ldb.cdc_avg_chunk_size = 65536
+        for path, data in self.files.items():
+            path = os.path.join(self.ldb.db_path, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data)
+        for path, mode in self.modes.items():
+            os.chmod(os.path.join(self.ldb.db_path, path), mode)
+        self.snp = chirribackup.snapshot.Snapshot(self.ldb)
+        self.snp.new()
+        self.snp.run()
+        chirribackup.syncer.Syncer(self.ldb).run()
+        self.snp = chirribackup.snapshot.Snapshot(self.ldb).load(self.snp.snapshot_id)
+        self.sm = self.ldb.get_storage_manager()
+        self.target = os.path.join(self.tmp_dir, "restored")
+
+
+    def check_target(self):
+        for path, data in self.files.items():
+            with open(os.path.join(self.target, path), "rb") as f:
+                self.assertEqual(f.read(), data, path)
+        self.assertEqual(self.snp.restore_journal_size(self.target), 0)
+
+
+    def remove_remote_chunks(self, parts_only = False):
+        """makes chunks unavailable, so any download fails"""
+        parts = set([ r["part"] for r in self.ldb.connection.execute(
+                                    "SELECT part FROM file_chunks") ])
+        chunks_dir = os.path.join(self.ldb.sm_local_storage_dir, "chunks")
+        for fname in os.listdir(chunks_dir):
+            if not parts_only or fname.split(".")[0] in parts:
+                os.unlink(os.path.join(chunks_dir, fname))
+
+
+    def test_restore(self):
+        self.assertTrue(self.ldb.connection.execute(
+                            "SELECT COUNT(*) FROM file_chunks").fetchone()[0] > 1)
+        self.snp.restore(self.sm, self.target)
+        self.check_target()
+
+
+    def test_hardlink(self):
+        self.snp.restore(self.sm, self.target, link_mode = "hardlink")
+        self.check_target()
+
+        # files with different attributes cannot share an inode
+        st = dict([ (path, os.lstat(os.path.join(self.target, path)))
+                        for path in self.modes.keys() ])
+        self.assertNotEqual(st["a.txt"].st_ino, st["sub/b.txt"].st_ino)
+        for path, mode in self.modes.items():
+            self.assertEqual(stat.S_IMODE(st[path].st_mode), mode, path)
+
+
+    def test_resume_journaled(self):
+        self.snp.restore(self.sm, self.target)
+
+        # simulate an interrupted restore: every file is journaled, so
+        # nothing is downloaded again
+        self.snp.restore_journal_add(self.target,
+                [ r for r in self.snp.refs(columns = [ "size", "mtime" ],
+                                           types = [ "regfile", "chunked" ]) ])
+        self.ldb.commit()
+        self.remove_remote_chunks()
+        self.snp.restore(self.sm, self.target)
+        self.check_target()
+
+
+    def test_resume_not_journaled(self):
+        self.snp.restore(self.sm, self.target)
+        os.unlink(os.path.join(self.target, "sub/c.txt"))
+        os.utime(os.path.join(self.target, "sub/deep/big.bin"), (0, 0))
+
+        # the file lost is downloaded again; the chunked file is checked
+        # against the hash in its manifest (parts are not downloaded)
+        self.remove_remote_chunks(parts_only = True)
+        self.snp.restore(self.sm, self.target, overwrite = True)
+        self.check_target()
+        self.assertEqual(int(os.lstat(os.path.join(self.target, "sub/deep/big.bin")).st_mtime),
+                         int(os.lstat(os.path.join(self.ldb.db_path, "sub/deep/big.bin")).st_mtime))
+
+
+    def test_existing_target(self):
+        os.mkdir(self.target)
+        with open(os.path.join(self.target, "a.txt"), "wb") as f:
+            f.write("bye\n")
+        self.assertRaises(ChirriException, self.snp.restore, self.sm, self.target)
+        self.snp.restore(self.sm, self.target, overwrite = True)
+        self.check_target()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/test_snapshot.py
+#
+#   Snapshots of a directory: file discovery and hashing.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import unittest
+
+import chirribackup.snapshot
+
+from testlib import DbTestCase
+
+
+class SnapshotTest(DbTestCase):
+
+    nfiles = 50
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        for i in range(0, self.nfiles):
+            with open(os.path.join(self.ldb.db_path, "file%03d.txt" % i), "wb") as f:
+                f.write("contents of file %d\n" % (i % 10))
+
+        # small pages and a commit after each change
+        self.page_size = chirribackup.snapshot.REFS_PAGE_SIZE
+        self.hasher_batch = chirribackup.snapshot.HASHY_HASHER_BATCH
+        chirribackup.snapshot.REFS_PAGE_SIZE = 7
+        chirribackup.snapshot.HASHY_HASHER_BATCH = 3
+        self.ldb.commit_rows = 1
+
+
+    def tearDown(self):
+        chirribackup.snapshot.REFS_PAGE_SIZE = self.page_size
+        chirribackup.snapshot.HASHY_HASHER_BATCH = self.hasher_batch
+        super(SnapshotTest, self).tearDown()
+
+
+    def snapshot(self):
+        snp = chirribackup.snapshot.Snapshot(self.ldb)
+        snp.new()
+        snp.run()
+        return snp
+
+
+    def chunks(self):
+        return dict([ (r["hash"], r["refcount"]) for r in self.ldb.connection.execute(
+                            "SELECT hash, refcount FROM file_data") ])
+
+
+    def test_hashy_hasher(self):
+        snp = self.snapshot()
+        refs = [ r for r in snp.refs(columns = [ "size" ], types = [ "regfile" ]) ]
+        self.assertEqual(len(refs), self.nfiles)
+        chunks = self.chunks()
+        self.assertEqual(len(chunks), 10)
+        self.assertEqual(sorted(chunks.values()), [ self.nfiles / 10 ] * 10)
+        self.assertEqual(self.ldb.connection.execute(
+                            "SELECT COUNT(*) FROM file_ref WHERE hash IS NULL").fetchone()[0], 0)
+
+
+    def test_unchanged_files(self):
+        old = dict([ (r["path"], r) for r in self.snapshot().refs() ])
+        changed = os.path.join(self.ldb.db_path, "file000.txt")
+        with open(changed, "wb") as f:
+            f.write("new contents\n")
+        os.utime(changed, (0, 0))
+        os.unlink(os.path.join(self.ldb.db_path, "file001.txt"))
+
+        # unchanged files are carried forward from the previous snapshot
+        new = dict([ (r["path"], r) for r in self.snapshot().refs() ])
+        self.assertEqual(sorted(new.keys()),
+                         sorted([ p for p in old.keys() if p != "file001.txt" ]))
+        for path, r in new.items():
+            if path == "file000.txt":
+                self.assertNotEqual(r["hash"], old[path]["hash"])
+            else:
+                self.assertEqual(dict(r), dict(old[path]), path)
+        self.assertEqual(self.ldb.connection.execute(
+                            "SELECT COUNT(*) FROM file_ref WHERE inode IS NULL").fetchone()[0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/test_storage.py
+#
+#   Storage managers used from worker threads (as the syncer and restore
+#   do), where the local database cannot be used.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import StringIO
+import os
+import threading
+import unittest
+
+import chirribackup.chunk
+import chirribackup.snapshot
+import chirribackup.syncer
+
+from testlib import DbTestCase
+
+
+class StorageThreadTest(DbTestCase):
+
+    def in_thread(self, func, *args):
+        """runs func(*args) in another thread, returning its result (or
+           raising its exception)"""
+        r = {}
+        def run():
+            try:
+                r["result"] = func(*args)
+            except Exception, ex:
+                r["ex"] = ex
+        t = threading.Thread(target = run)
+        t.start()
+        t.join()
+        if "ex" in r:
+            raise r["ex"]
+        return r.get("result")
+
+
+    def test_storage_manager(self):
+        # the storage manager (and its config) is loaded in this thread
+        sm = self.ldb.get_storage_manager()
+        local_file = os.path.join(self.tmp_dir, "local")
+        with open(local_file, "wb") as f:
+            f.write("file data")
+
+        self.in_thread(sm.upload_data, "chunks/a", "some data")
+        self.in_thread(sm.upload_file, "chunks/b", local_file)
+        self.assertEqual(sorted([ os.path.basename(x["name"]) for x in self.in_thread(sm.get_listing_chunks) ]),
+                         [ "a", "b" ])
+        f = StringIO.StringIO()
+        self.in_thread(sm.download_stream, "chunks/b", f)
+        self.assertEqual(f.getvalue(), "file data")
+        self.assertEqual(self.in_thread(sm.download_data, "chunks/a"), "some data")
+        self.in_thread(sm.delete_file, "chunks/a")
+        self.assertEqual([ os.path.basename(x["name"]) for x in self.in_thread(sm.get_listing_chunks) ], [ "b" ])
+
+
+    def test_restore_chunk(self):
+        with open(os.path.join(self.ldb.db_path, "a.txt"), "wb") as f:
+            f.write("hello\n")
+        snp = chirribackup.snapshot.Snapshot(self.ldb)
+        snp.new()
+        snp.run()
+        chirribackup.syncer.Syncer(self.ldb).run()
+        sm = self.ldb.get_storage_manager()
+
+        # what a restore worker does with a chunk loaded by the main thread
+        refs = list(snp.refs(columns = [ "size", "perm", "uid", "gid", "mtime" ],
+                             types = [ "regfile" ]))
+        c = chirribackup.chunk.Chunk(self.ldb, snp.file_ref_chunk(refs[0]["hash"]))
+        target = os.path.join(self.tmp_dir, "restored")
+        os.mkdir(target)
+        pending, found = self.in_thread(snp.restore_chunk,
+                                        sm, target, (c.hash, c, None, refs, {}), False, "copy")
+        self.assertEqual(len(pending), 1)
+        with open(os.path.join(target, "a.txt"), "rb") as f:
+            self.assertEqual(f.read(), "hello\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+###############################################################################
+# tests/testlib.py
+#
+#   Helpers shared by the tests: temporary local databases (with a local
+#   storage) and chunk hashes.
+#
+# -----------------------------------------------------------------------------
+# Chirri Backup - Cheap and ugly backup tool
+#   Copyright (C) 2016 Gerardo Garcia Peña <killabytenow@gmail.com>
+#
+#   This program is free software; you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by the Free
+#   Software Foundation, either version 3 of the License, or (at your option)
+#   any later version.
+#
+#   This program is distributed in the hope that it will be useful, but WITHOUT
+#   ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+#   FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+#   more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import chirribackup.LocalDatabase
+from chirribackup.Logger import logger
+
+logger.setLogLevel("CRITICAL")
+
+
+def fake_hash(s):
+    """a well formed chunk hash"""
+    return hashlib.sha512(str(s)).hexdigest()
+
+
+class DbTestCase(unittest.TestCase):
+    """creates a local database (using a local storage) in a temporary
+       directory for each test"""
+
+    tmp_dir = None
+    ldb     = None
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix = "chirri-test.")
+        self.ldb = self.new_ldb("data")
+
+
+    def tearDown(self):
+        self.ldb.connection.close()
+        shutil.rmtree(self.tmp_dir)
+
+
+    def new_ldb(self, name):
+        path = os.path.join(self.tmp_dir, name)
+        os.mkdir(path)
+        ldb = chirribackup.LocalDatabase.LocalDatabase(
+                    path,
+                    init = True,
+                    storage_type = "Local")
+        ldb.storage_type = "Local"
+        ldb.sm_local_storage_dir = os.path.join(self.tmp_dir, "storage")
+        ldb.compression = None
+        ldb.commit()
+        return ldb